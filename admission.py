@@ -0,0 +1,150 @@
+import threading
+import time
+
+
+class AdmissionPolicy(object):
+	"""Admission options of one stream, the "admission" object of its config.
+
+	Under CPU pressure streams of lower priority are throttled first, their
+	analysis fps is halved step by step down to min_fps. E.g.
+	{"admission": {"priority": 10, "min_fps": 2}}.
+	"""
+
+	def __init__(self, priority=0, min_fps=1.0):
+		self.priority = priority
+		self.min_fps = min_fps
+
+	@classmethod
+	def from_spec(cls, spec):
+		config = getattr(spec, 'config', None) or {}
+		return cls(**config.get('admission', {}))
+
+
+class AdmissionController(object):
+	"""Node-wide CPU budget for process(), applied by Manager.
+
+	update() measures the load of every running stream, seconds of process()
+	per second of wall time, and the frames per second it analyses, both
+	smoothed over updates. While the total is over budget (in cores) the
+	analysis fps of streams is halved, one step per stream and update, lowest
+	priority and most expensive first, down to their min_fps. Streams at
+	min_fps that still don't fit are reported overloaded. Once the total is
+	under low_water of the budget throttled streams get their fps doubled
+	back, highest priority first, as far as the predicted load stays under
+	low_water.
+
+	A new stream is admitted when its estimated cost (the mean load of the
+	running streams, new_stream_cost before any is measured) fits, or when
+	running streams of lower priority can still be throttled to make room.
+	Otherwise it is rejected and reported, and admitted by a later update()
+	once there is room.
+
+	Without a budget loads are only measured and reported.
+	"""
+
+	def __init__(self, budget=None, low_water=0.7, smoothing=0.5, new_stream_cost=0.05):
+		self.budget = budget
+		self.low_water = low_water
+		self.smoothing = smoothing
+		self.new_stream_cost = new_stream_cost
+		self.lock = threading.Lock()
+		# Estimated cost of streams admitted since the last reconcile
+		self.pending = 0.0
+		self.load = 0.0
+
+	def measure(self, stream, now):
+		capture = stream.capture
+		sample = (capture.process_time, capture.frames.processed, now)
+		last, stream.load_sample = stream.load_sample, sample
+		if last is None or now <= last[2]:
+			return
+		elapsed = now - last[2]
+		load = (sample[0] - last[0]) / elapsed
+		fps = (sample[1] - last[1]) / elapsed
+		a = self.smoothing
+		stream.load = a * stream.load + (1 - a) * load
+		stream.fps = a * stream.fps + (1 - a) * fps
+
+	def update(self, streams, now=None):
+		"""Measure running streams and throttle or relax them to fit the budget"""
+		now = time.monotonic() if now is None else now
+		running = [s for s in streams if s.capture is not None]
+		with self.lock:
+			for stream in running:
+				self.measure(stream, now)
+			self.load = total = sum(s.load for s in running)
+			if self.budget is None:
+				return
+			if total > self.budget:
+				self._throttle(running, total)
+			elif total < self.budget * self.low_water:
+				self._relax(running, total)
+			else:
+				for stream in running:
+					if stream.admission == 'overloaded':
+						stream.admission = 'throttled'
+
+	def _throttle(self, running, total):
+		for stream in sorted(running, key=lambda s: (s.policy.priority, -s.load)):
+			if total <= self.budget:
+				break
+			current = stream.capture.analysis_fps or stream.fps
+			fps = max(stream.policy.min_fps, current / 2)
+			if current <= 0 or fps >= current:
+				continue
+			total -= stream.load * (1 - fps / current)
+			stream.capture.set_analysis_fps(fps)
+			stream.admission = 'throttled'
+			print(f"[Admission] {stream.name}: load {stream.load:.3f}, analysis fps {current:.1f} -> {fps:.1f}")
+		for stream in running:
+			if total > self.budget and stream.capture.analysis_fps is not None and stream.capture.analysis_fps <= stream.policy.min_fps:
+				stream.admission = 'overloaded'
+
+	def _relax(self, running, total):
+		limit = self.budget * self.low_water
+		for stream in sorted(running, key=lambda s: (-s.policy.priority, s.load)):
+			current = stream.capture.analysis_fps
+			if current is None:
+				continue
+			fps = current * 2
+			added = stream.load * (fps / current - 1)
+			if total + added > limit:
+				break
+			total += added
+			if fps >= stream.capture.metrics.fps:
+				fps = None
+				stream.admission = 'admitted'
+			else:
+				stream.admission = 'throttled'
+			stream.capture.set_analysis_fps(fps)
+			print(f"[Admission] {stream.name}: analysis fps {current:.1f} -> {fps or 'unlimited'}")
+
+	def estimate(self, running):
+		measured = [s.load for s in running if s.load_sample is not None and s.load > 0]
+		if not measured:
+			return self.new_stream_cost
+		return sum(measured) / len(measured)
+
+	def admit(self, stream, streams):
+		"""True when the stream fits the budget, counts its estimated cost until the next reconcile"""
+		with self.lock:
+			if self.budget is None:
+				return True
+			running = [s for s in streams if s.capture is not None and s is not stream]
+			estimate = self.estimate(running)
+			total = sum(s.load for s in running) + self.pending
+			fits = total + estimate <= self.budget
+			if not fits:
+				# Lower priority streams that can still give up frames make room
+				fits = any(s.policy.priority < stream.policy.priority and
+					(s.capture.analysis_fps or s.fps) > s.policy.min_fps for s in running)
+			if fits:
+				self.pending += estimate
+				stream.load = estimate
+			return fits
+
+	def stats(self):
+		return {
+			'budget': self.budget,
+			'load': round(self.load, 3),
+		}
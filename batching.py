@@ -0,0 +1,151 @@
+import collections
+import contextlib
+import threading
+import time
+
+
+class BatchScheduler(object):
+	"""Collects frames of many streams into batches for Capture.process_batch().
+
+	Drop-in replacement for FrameDispatcher as Capture.dispatcher. Every stream
+	has one latest-wins slot of pending frames. A batch is formed from streams
+	of the same Capture class once max_batch of them have a frame pending, or
+	when the oldest pending frame has waited max_wait seconds. A stream whose
+	previous frame is still in a running batch is not batched again until it
+	completes, so process_batch() sees at most one frame per stream.
+	"""
+
+	def __init__(self, max_batch=8, max_wait=0.02, workers=1):
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.workers = workers
+		self._cond = threading.Condition()
+		# capture -> time its oldest pending frame arrived, in arrival order
+		self._pending = collections.OrderedDict()
+		self._threads = []
+		# batch size -> [batches, busy seconds, latency sum, latency max]
+		self._batch_stats = {}
+
+	def submit(self, capture, frame):
+		queue = capture.frames
+		now = time.monotonic()
+		with self._cond:
+			if not self._threads:
+				self._start()
+			queue.received += 1
+			if len(queue.items) >= queue.maxsize:
+				queue.items.popleft()
+				queue.dropped += 1
+			queue.items.append((frame, now))
+			capture.metrics.queue_depth.observe(len(queue.items))
+			if capture not in self._pending:
+				self._pending[capture] = now
+			self._cond.notify()
+
+	def cancel(self, capture):
+		with self._cond:
+			capture.frames.items.clear()
+			self._pending.pop(capture, None)
+
+	def stats(self):
+		"""Latency and throughput of batches, keyed by batch size"""
+		with self._cond:
+			batch_stats = {size: list(v) for size, v in self._batch_stats.items()}
+		result = {}
+		for size, (batches, busy, latency_sum, latency_max) in sorted(batch_stats.items()):
+			result[size] = {
+				'batches': batches,
+				'frames_per_second': round(batches * size / busy, 1) if busy else None,
+				'latency_avg_ms': round(latency_sum / (batches * size) * 1000, 1),
+				'latency_max_ms': round(latency_max * 1000, 1),
+			}
+		return {'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000, 'batch_sizes': result}
+
+	def _start(self):
+		for i in range(self.workers):
+			t = threading.Thread(target=self._work, name=f"batch-worker-{i}", daemon=True)
+			t.start()
+			self._threads.append(t)
+		print(f"[Dispatcher] Started {self.workers} batch worker(s), max batch {self.max_batch}, max wait {self.max_wait*1000:.0f}ms")
+
+	def _next_batch(self):
+		"""Wait for the next batch, called with the lock held"""
+		while True:
+			ready = [c for c in self._pending if not c.frames.scheduled]
+			if not ready:
+				self._cond.wait()
+				continue
+			cls = type(ready[0])
+			batch = [c for c in ready if type(c) is cls][:self.max_batch]
+			wait = self._pending[ready[0]] + self.max_wait - time.monotonic()
+			if len(batch) < self.max_batch and wait > 0:
+				self._cond.wait(wait)
+				continue
+			items = []
+			for capture in batch:
+				del self._pending[capture]
+				queue = capture.frames
+				items.append((capture, queue.items.popleft()))
+				queue.scheduled = True
+				if queue.items:
+					self._pending[capture] = queue.items[0][1]
+			return cls, items
+
+	def _work(self):
+		while True:
+			with self._cond:
+				cls, items = self._next_batch()
+			processed = True
+			try:
+				processed = self._run(cls, items)
+			except Exception as e:
+				print(f"[Dispatcher] Error processing batch of {len(items)} {cls.__name__} frame(s): {type(e).__name__}: {e}")
+			with self._cond:
+				for capture, _ in items:
+					if processed:
+						capture.frames.processed += 1
+					else:
+						capture.frames.dropped += 1
+					capture.frames.scheduled = False
+				self._cond.notify_all()
+
+	def _run(self, cls, items):
+		"""Process a batch, False when its results had to be dropped"""
+		from capture import Capture
+
+		with contextlib.ExitStack() as stack:
+			captures, images, timestamps, submitted = [], [], [], []
+			for capture, ((sample, utc_ns), submitted_at) in items:
+				if capture.should_stop:
+					continue
+				img = stack.enter_context(capture.mapped_frame(sample))
+				if img is None:
+					continue
+				captures.append(capture)
+				images.append(img.copy() if capture.copy_frames else img)
+				timestamps.append(utc_ns)
+				submitted.append(submitted_at)
+			if not captures:
+				return True
+			t1 = time.perf_counter()
+			results = list(cls.process_batch(captures, images, timestamps))
+			busy = time.perf_counter() - t1
+		done = time.monotonic()
+		if len(results) != len(captures):
+			# Results can't be matched to their frames, none are committed
+			print(f"[Dispatcher] {cls.__name__}.process_batch() returned {len(results)} result(s) for {len(captures)} frame(s), dropping the batch")
+			return False
+
+		for capture, episodes in zip(captures, results):
+			capture.process_time += busy / len(captures)
+			capture.metrics.process.observe(busy / len(captures))
+			Capture.append_episodes(episodes)
+
+		latencies = [done - s for s in submitted]
+		with self._cond:
+			stats = self._batch_stats.setdefault(len(captures), [0, 0.0, 0.0, 0.0])
+			stats[0] += 1
+			stats[1] += busy
+			stats[2] += sum(latencies)
+			stats[3] = max(stats[3], max(latencies))
+		return True
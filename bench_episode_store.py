@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""Concurrency stress test of EpisodeStore.
+
+Writer threads append episodes and update random ones of their own, while
+poller threads long-poll with wait_since() and reader threads take
+snapshots, like the capture workers and HTTP threads of a node do. Checks
+after every read that results are ordered by updated_at, hold no duplicate
+or evicted entries, and at the end that the store holds exactly the latest
+version of at most limit episodes. Reports commit throughput.
+
+Before that, two streams open episodes on the same frame times with ids
+from EpisodeIds, once sharing a process and once from two inference
+processes, and every episode of both must be in the store.
+
+Then a store with an EpisodeJournal of --journal-records episodes is paged
+through from the start, like Central catching up, while a writer keeps
+committing: every episode must come exactly once and in order. Reports the
+time per page and the longest commit, which must not wait for the pages.
+Without a journal, since() must serve what is left after evictions.
+
+	python3 bench_episode_store.py --writers 8 --pollers 32 --seconds 5
+"""
+
+import argparse
+import itertools
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from episode_journal import EpisodeJournal
+from episode_store import Episode, EpisodeIds, EpisodeStore
+
+
+class Stress(object):
+	def __init__(self, store):
+		self.store = store
+		self.clock = itertools.count(1)
+		self.stop = threading.Event()
+		self.errors = []
+		self.appends = 0
+		self.updates = 0
+		self.reads = 0
+		# episode_id -> payload of its last commit, every writer owns its ids
+		self.latest = {}
+		self.lock = threading.Lock()
+
+	def fail(self, message):
+		with self.lock:
+			if len(self.errors) < 20:
+				self.errors.append(message)
+
+	def check(self, where, episodes):
+		seen = set()
+		previous = None
+		for ep in episodes:
+			if ep is None:
+				self.fail(f"{where}: evicted entry returned")
+				return
+			if ep.episode_id in seen:
+				self.fail(f"{where}: duplicate episode {ep.episode_id}")
+			seen.add(ep.episode_id)
+			if previous is not None and ep.updated_at < previous:
+				self.fail(f"{where}: updated_at goes back {previous} -> {ep.updated_at}")
+			previous = ep.updated_at
+
+	def writer(self, n, update_ratio):
+		rng = random.Random(n)
+		mine = []
+		appends = updates = 0
+		while not self.stop.is_set():
+			if mine and rng.random() < update_ratio:
+				episode_id = rng.choice(mine)
+				payload = f"{n}:{episode_id}:{updates}"
+				if self.store.update(episode_id, updated_at=next(self.clock), payload=payload) is not None:
+					self.latest[episode_id] = payload
+				updates += 1
+			else:
+				episode_id = n * 10**9 + appends
+				payload = f"{n}:{episode_id}"
+				now = next(self.clock)
+				self.latest[episode_id] = payload
+				self.store.append(Episode(episode_id=episode_id, media=f"cam{n}", opened_at=now, updated_at=now, payload=payload))
+				mine.append(episode_id)
+				# Only recent episodes are still in the store
+				if len(mine) > 2 * self.store.limit:
+					del mine[:self.store.limit]
+				appends += 1
+		with self.lock:
+			self.appends += appends
+			self.updates += updates
+
+	def poller(self):
+		updated_at_gt = 0
+		reads = 0
+		while not self.stop.is_set():
+			episodes = self.store.wait_since(updated_at_gt, 0.1)
+			self.check('wait_since', episodes)
+			if episodes:
+				updated_at_gt = episodes[-1].updated_at
+			reads += 1
+		with self.lock:
+			self.reads += reads
+
+	def reader(self):
+		reads = 0
+		while not self.stop.is_set():
+			episodes = self.store.snapshot()
+			self.check('snapshot', episodes)
+			if len(episodes) > self.store.limit:
+				self.fail(f"snapshot: {len(episodes)} episodes over limit {self.store.limit}")
+			self.check('since', self.store.since(0))
+			reads += 1
+		with self.lock:
+			self.reads += reads
+
+	def verify(self):
+		episodes = self.store.snapshot()
+		self.check('final', episodes)
+		if len(episodes) != len(self.store) or len(episodes) != min(self.store.limit, len(self.latest)):
+			self.fail(f"final: {len(episodes)} in snapshot, len() {len(self.store)}, {len(self.latest)} committed")
+		for ep in episodes:
+			if ep.payload != self.latest.get(ep.episode_id):
+				self.fail(f"final: episode {ep.episode_id} has {ep.payload!r}, last commit {self.latest.get(ep.episode_id)!r}")
+			if self.store.get(ep.episode_id) is not ep:
+				self.fail(f"final: index doesn't point at episode {ep.episode_id}")
+
+
+def two_streams(frames=1000, codes=3):
+	"""Errors of two streams opening codes episodes per frame on the same frame times"""
+	errors = []
+	# Streams of one process share its allocator, streams of inference
+	# processes 0 and 1 have their own, like worker_main() sets them up
+	for label, ids in (('one process', [EpisodeIds()] * 2), ('two processes', [EpisodeIds(1, 3), EpisodeIds(2, 3)])):
+		store = EpisodeStore(limit=2 * frames * codes)
+		start = threading.Barrier(2)
+
+		def stream(n):
+			start.wait()
+			for frame in range(frames):
+				utc_ns = 1720204525414799000 + frame * 40 * 10**6
+				for _ in range(codes):
+					now = utc_ns // 10**6
+					store.append(Episode(episode_id=ids[n].next(utc_ns), media=f"cam{n}", opened_at=now, updated_at=now))
+
+		threads = [threading.Thread(target=stream, args=(n,)) for n in range(2)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		for n in range(2):
+			count = len(store.query(media=f"cam{n}")[0])
+			if count != frames * codes:
+				errors.append(f"two streams, {label}: cam{n} has {count} of {frames * codes} episodes")
+	return errors
+
+
+def journal_catch_up(records, page=500):
+	"""(errors, seconds per page, longest commit in seconds) of paging a journal-backed store from the start"""
+	errors = []
+	path = tempfile.mkdtemp(prefix='episodes-')
+	# Recent times, older segments would be dropped by age
+	now = int(time.time() * 1000)
+	try:
+		store = EpisodeStore(limit=1000, journal=EpisodeJournal(path, segment_size=1 << 20))
+		for i in range(records):
+			# Several episodes per millisecond, so pages end inside groups
+			store.append(Episode(episode_id=i + 1, media=f"cam{i % 4}", opened_at=now + i // 4, updated_at=now + i // 4))
+		stop = threading.Event()
+		commits = []
+
+		def writer():
+			i = records
+			while not stop.is_set():
+				t1 = time.perf_counter()
+				store.append(Episode(episode_id=i + 1, media='cam0', opened_at=now + i // 4, updated_at=now + i // 4))
+				commits.append(time.perf_counter() - t1)
+				i += 1
+				time.sleep(0.001)
+
+		thread = threading.Thread(target=writer)
+		thread.start()
+		seen = []
+		after = 0
+		pages = 0
+		t1 = time.perf_counter()
+		while len(seen) < records:
+			episodes, _ = store.query(after, limit=page)
+			pages += 1
+			if not episodes:
+				break
+			seen += [ep.episode_id for ep in episodes]
+			after = (episodes[-1].updated_at, episodes[-1].episode_id)
+		elapsed = time.perf_counter() - t1
+		stop.set()
+		thread.join()
+		if seen[:records] != list(range(1, records + 1)):
+			errors.append(f"journal: catch-up returned {len(seen)} episodes, not 1..{records} in order")
+		store.journal.close()
+	finally:
+		shutil.rmtree(path, ignore_errors=True)
+
+	# Without a journal, evicted episodes are gone and since() serves the rest
+	store = EpisodeStore(limit=10)
+	for i in range(25):
+		store.append(Episode(episode_id=i + 1, media='cam0', opened_at=i, updated_at=i))
+	if [ep.episode_id for ep in store.since(0)] != list(range(16, 26)):
+		errors.append("no journal: since(0) after eviction doesn't return the last 10 episodes")
+	return errors, elapsed / pages, max(commits, default=0.0)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--writers', type=int, default=8)
+	parser.add_argument('--pollers', type=int, default=32)
+	parser.add_argument('--readers', type=int, default=4)
+	parser.add_argument('--limit', type=int, default=1000)
+	parser.add_argument('--update-ratio', type=float, default=0.5)
+	parser.add_argument('--seconds', type=float, default=5.0)
+	parser.add_argument('--journal-records', type=int, default=20000)
+	args = parser.parse_args()
+
+	# Switch threads often, so races show up
+	sys.setswitchinterval(1e-5)
+	stress = Stress(EpisodeStore(limit=args.limit))
+	threads = [threading.Thread(target=stress.writer, args=(n, args.update_ratio)) for n in range(args.writers)]
+	threads += [threading.Thread(target=stress.poller) for _ in range(args.pollers)]
+	threads += [threading.Thread(target=stress.reader) for _ in range(args.readers)]
+	t1 = time.monotonic()
+	for t in threads:
+		t.start()
+	time.sleep(args.seconds)
+	stress.stop.set()
+	for t in threads:
+		t.join()
+	elapsed = time.monotonic() - t1
+	stress.verify()
+	stress.errors += two_streams()
+	errors, per_page, longest_commit = journal_catch_up(args.journal_records)
+	stress.errors += errors
+
+	print(f"writers={args.writers} pollers={args.pollers} readers={args.readers} limit={args.limit}")
+	print(f"appends {stress.appends} ({stress.appends / elapsed:.0f}/s), updates {stress.updates} ({stress.updates / elapsed:.0f}/s), reads {stress.reads}")
+	print(f"journal catch-up of {args.journal_records} episodes: {per_page * 1000:.1f}ms per page, longest commit {longest_commit * 1000:.1f}ms")
+	for message in stress.errors:
+		print(f"FAIL {message}")
+	print("FAILED" if stress.errors else "OK")
+	sys.exit(1 if stress.errors else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Long-poll load test for the /episodes endpoint.
+
+Starts the episodes server on a local port, parks N keep-alive pollers on it
+and commits episodes at a fixed interval. Reports commit-to-delivery latency,
+process CPU and thread count while all pollers are idle and while episodes
+are committed. Pollers run as asyncio tasks in one client thread, so the
+thread count is the server's.
+
+	python3 bench_episodes.py --pollers 1000 --server threading
+	python3 bench_episodes.py --pollers 1000 --server async
+	python3 bench_episodes.py --pollers 300 --legacy   # old sleep(1)/rescan loop
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from episode_store import Episode, EpisodeStore, cursor_key
+from episodes_server import AsyncHTTPServer, HttpGetHandler, run_http
+
+
+class LegacyEpisodeStore(EpisodeStore):
+	"""Emulates the former list scan + time.sleep(1) polling loop"""
+
+	def query(self, after=0, limit=None, media=None, episode_type=None):
+		after = cursor_key(after)
+		episodes = [e for e in self.snapshot() if (e.updated_at, e.episode_id) > after]
+		return episodes, len(episodes)
+
+	def wait_query(self, timeout, after=0, **kwargs):
+		t1 = time.monotonic()
+		while True:
+			episodes, count = self.query(after)
+			if episodes or time.monotonic() - t1 >= timeout:
+				return episodes, count
+			time.sleep(1)
+
+
+class QuietHandler(HttpGetHandler):
+	def log_message(self, format, *args):
+		pass
+
+
+class BenchHTTPServer(ThreadingHTTPServer):
+	daemon_threads = True
+	request_queue_size = 4096
+
+
+SERVERS = {
+	'threading': BenchHTTPServer,
+	'async': AsyncHTTPServer,
+}
+
+
+def free_port():
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+
+def cpu_seconds():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+
+async def read_response(reader):
+	head = await reader.readuntil(b'\r\n\r\n')
+	headers = {}
+	for line in head.decode('latin-1').split('\r\n')[1:]:
+		if ':' in line:
+			k, v = line.split(':', 1)
+			headers[k.strip().lower()] = v.strip()
+	if headers.get('transfer-encoding') == 'chunked':
+		body = b''
+		while True:
+			size = int((await reader.readuntil(b'\r\n'))[:-2], 16)
+			if not size:
+				await reader.readuntil(b'\r\n')
+				return body
+			body += (await reader.readexactly(size + 2))[:-2]
+	if 'content-length' in headers:
+		return await reader.readexactly(int(headers['content-length']))
+	return await reader.read()
+
+
+async def poller(port, published, latencies):
+	updated_at_gt = int(time.time() * 1000)
+	reader = writer = None
+	try:
+		while True:
+			try:
+				if writer is None:
+					reader, writer = await asyncio.open_connection('127.0.0.1', port)
+				writer.write(f'GET /vision/api/v3/episodes?poll_timeout=30&updated_at_gt={updated_at_gt} HTTP/1.1\r\n'
+					'Host: bench\r\n\r\n'.encode())
+				body = await read_response(reader)
+			except (OSError, asyncio.IncompleteReadError):
+				if writer is not None:
+					writer.close()
+				reader = writer = None
+				await asyncio.sleep(0.1)
+				continue
+			received = time.monotonic()
+			episodes = json.loads(body)['episodes']
+			for ep in episodes:
+				latencies.append(received - published[ep['episode_id']])
+			if episodes:
+				updated_at_gt = episodes[-1]['updated_at']
+	finally:
+		if writer is not None:
+			writer.close()
+
+
+def run_pollers(count, port, published, latencies, started, stop):
+	async def main():
+		tasks = []
+		for _ in range(count):
+			tasks.append(asyncio.create_task(poller(port, published, latencies)))
+			# Don't overflow the listen backlog of the server
+			await asyncio.sleep(0.001)
+		started.set()
+		while not stop.is_set():
+			await asyncio.sleep(0.1)
+		for t in tasks:
+			t.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+	asyncio.run(main())
+
+
+def percentile(values, p):
+	if not values:
+		return float('nan')
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--pollers', type=int, default=1000)
+	parser.add_argument('--events', type=int, default=20)
+	parser.add_argument('--interval', type=float, default=0.25, help='seconds between commits')
+	parser.add_argument('--idle', type=float, default=5.0, help='idle window for CPU measurement, seconds')
+	parser.add_argument('--server', choices=sorted(SERVERS), default='threading')
+	parser.add_argument('--legacy', action='store_true')
+	args = parser.parse_args()
+
+	# Client and server sockets of every poller live in this process
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+	store = LegacyEpisodeStore() if args.legacy else EpisodeStore()
+	port = free_port()
+	threading.Thread(target=run_http, args=(store, port),
+		kwargs={'server_class': SERVERS[args.server], 'handler_class': QuietHandler}, daemon=True).start()
+	time.sleep(0.5)
+
+	published = {}
+	latencies = []
+	started = threading.Event()
+	stop = threading.Event()
+	threading.Thread(target=run_pollers, args=(args.pollers, port, published, latencies, started, stop), daemon=True).start()
+	started.wait()
+	# Let every poller park on the server before measuring
+	time.sleep(2.0)
+
+	cpu0, wall0 = cpu_seconds(), time.monotonic()
+	time.sleep(args.idle)
+	idle_cpu = (cpu_seconds() - cpu0) / (time.monotonic() - wall0)
+	threads = threading.active_count()
+
+	cpu0, wall0 = cpu_seconds(), time.monotonic()
+	for i in range(args.events):
+		now_ms = int(time.time() * 1000)
+		episode_id = now_ms * 1000 + i
+		published[episode_id] = time.monotonic()
+		store.append(Episode(episode_id=episode_id, media='bench', opened_at=now_ms, updated_at=now_ms))
+		time.sleep(args.interval)
+	time.sleep(1.5)
+	busy_cpu = (cpu_seconds() - cpu0) / (time.monotonic() - wall0)
+	stop.set()
+
+	delivered = list(latencies)
+	expected = args.pollers * args.events
+	print(f"server={args.server} store={'legacy' if args.legacy else 'indexed'} pollers={args.pollers} events={args.events}")
+	print(f"delivered {len(delivered)}/{expected}, threads {threads}")
+	print(f"latency ms: p50={percentile(delivered, 50)*1000:.1f} p90={percentile(delivered, 90)*1000:.1f} "
+		f"p99={percentile(delivered, 99)*1000:.1f} max={max(delivered, default=float('nan'))*1000:.1f}")
+	print(f"cpu: idle={idle_cpu*100:.1f}% busy={busy_cpu*100:.1f}% of one core")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Cost of Manager.reconfigure() with thousands of streams.
+
+Serves a /streams config of N streams from a local config_external (with
+ETag support unless --no-etag) and runs a Manager whose captures are stubs:
+run() blocks until stop(), and stopping takes --stop-delay seconds like a
+GStreamer pipeline teardown. Reports the time of the initial launch, CPU per
+reconfigure() while the config is unchanged, the time to apply a config with
+--changed URLs replaced and --removed streams deleted, and how many HTTP
+connections the manager opened.
+
+	python3 bench_manager.py --streams 2000 --changed 500
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from manager import Manager
+
+
+class ConfigHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	body = b'{"streams":[]}'
+	etag = True
+	connections = 0
+
+	def setup(self):
+		super().setup()
+		ConfigHandler.connections += 1
+
+	def do_GET(self):
+		body = ConfigHandler.body
+		tag = '"%s"' % hashlib.md5(body).hexdigest()
+		if ConfigHandler.etag and self.headers.get('If-None-Match') == tag:
+			self.send_response(304)
+			self.send_header('ETag', tag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		if ConfigHandler.etag:
+			self.send_header('ETag', tag)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class StubCapture(object):
+	stop_delay = 0.5
+
+	def __init__(self, spec):
+		self.name = spec.name
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run)
+		self.thread.start()
+
+	def join(self, timeout=None):
+		self.thread.join(timeout)
+		return not self.thread.is_alive()
+
+	def run(self):
+		self.stopped.wait()
+		time.sleep(StubCapture.stop_delay)
+
+	def stop(self):
+		self.stopped.set()
+
+	def stats(self):
+		return {}
+
+
+class BenchManager(Manager):
+	def launch(self, spec):
+		return StubCapture(spec)
+
+
+def make_config(count, version=0, changed=0, removed=0):
+	streams = []
+	for i in range(removed, count):
+		url = f"rtsp://media.local/cam{i}" + (f"?v={version}" if i < changed + removed else "")
+		streams.append({'name': f"cam{i}", 'inputs': [{'url': url}]})
+	return json.dumps({'streams': streams}).encode()
+
+
+def cpu_seconds():
+	return time.process_time()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--streams', type=int, default=2000)
+	parser.add_argument('--changed', type=int, default=500)
+	parser.add_argument('--removed', type=int, default=100)
+	parser.add_argument('--polls', type=int, default=50, help='reconfigure() calls with an unchanged config')
+	parser.add_argument('--stop-delay', type=float, default=0.5)
+	parser.add_argument('--no-etag', action='store_true', help='config_external without ETag support')
+	args = parser.parse_args()
+
+	ConfigHandler.etag = not args.no_etag
+	ConfigHandler.body = make_config(args.streams)
+	StubCapture.stop_delay = args.stop_delay
+	server = ThreadingHTTPServer(('127.0.0.1', 0), ConfigHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	manager = BenchManager(f"http://127.0.0.1:{server.server_address[1]}")
+
+	t1 = time.monotonic()
+	manager.reconfigure()
+	launch = time.monotonic() - t1
+
+	cpu0 = cpu_seconds()
+	for _ in range(args.polls):
+		manager.reconfigure()
+	unchanged_cpu = (cpu_seconds() - cpu0) / args.polls
+
+	ConfigHandler.body = make_config(args.streams, 1, args.changed, args.removed)
+	t1 = time.monotonic()
+	manager.reconfigure()
+	apply = time.monotonic() - t1
+	active = len(manager.streams)
+	StubCapture.stop_delay = 0
+	for stream in manager.streams:
+		stream.capture.stop()
+
+	print(f"streams={args.streams} changed={args.changed} removed={args.removed} etag={'off' if args.no_etag else 'on'} stop_delay={args.stop_delay}s")
+	print(f"initial launch {launch*1000:.0f}ms")
+	print(f"unchanged config: {unchanged_cpu*1000:.2f}ms cpu per reconfigure")
+	print(f"apply change: {apply:.2f}s, {active} streams active (expected {args.streams - args.removed})")
+	print(f"http connections opened: {ConfigHandler.connections} for {args.polls + 2} fetches")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Offline throughput of a Capture subclass on recorded or synthetic video.
+
+Replays a local file through N copies of the capture at once, along the same
+path as a live stream: appsink callback, Capture.dispatcher and process().
+Only the source differs, filesrc ! decodebin instead of rtspsrc, so no
+network or media server is needed. Frames get a simulated NTP timestamp,
+a fixed base plus the buffer PTS. For every stream count it reports the
+processed fps, latency from appsink callback to the end of process(), CPU
+in cores, peak RSS and peak OS threads of the process. --main-loops drives
+the pipelines from that many shared GLib loops instead of a thread each.
+
+	python3 bench_replay.py clip.mp4 --streams 1 8 32 64
+	python3 bench_replay.py --synthetic 20                 # generated clip with QR codes
+	python3 bench_replay.py clip.mp4 --realtime --config '{"sampling":{"enabled":false}}'
+	python3 bench_replay.py clip.mp4 --realtime --main-loops 2 --config '{"pipeline":{"decoder_threads":1}}'
+"""
+
+import argparse
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from capture import Capture
+from episode_store import EpisodeStore
+from mainloop import MainLoopPool
+
+# Simulated NTP time of the first frame of every replay
+BASE_NS = 1720000000 * 10**9
+
+
+class Replay(object):
+	"""Mixed in front of the benchmarked Capture class"""
+	realtime = False
+	# End of the clip ends the run
+	reconnect = False
+	# Arrivals kept per stream, dropped and skipped frames never reach handle_frame()
+	max_arrivals = 256
+
+	def __init__(self, spec, **kwargs):
+		super().__init__(spec, **kwargs)
+		# PTS -> time the appsink callback got the frame
+		self.arrivals = {}
+		self.arrivals_lock = threading.Lock()
+		self.latencies = []
+
+	def source_chain(self):
+		chain = 'filesrc name=ingress ! decodebin ! '
+		if self.realtime:
+			# Hand out frames at the pace of their timestamps, like a camera
+			chain += 'identity sync=true ! '
+		return chain + self.pipeline_config.convert_chain()
+
+	def frame_timestamp(self, buffer):
+		with self.arrivals_lock:
+			self.arrivals[buffer.pts] = time.perf_counter()
+			# Oldest first, a frame this far behind was dropped
+			while len(self.arrivals) > self.max_arrivals:
+				del self.arrivals[next(iter(self.arrivals))]
+		return BASE_NS + buffer.pts
+
+	def handle_frame(self, sample, utc_ns):
+		super().handle_frame(sample, utc_ns)
+		with self.arrivals_lock:
+			arrived = self.arrivals.pop(utc_ns - BASE_NS, None)
+		if arrived is not None:
+			self.latencies.append(time.perf_counter() - arrived)
+
+
+def rss_bytes():
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def os_threads():
+	with open('/proc/self/status') as f:
+		for line in f:
+			if line.startswith('Threads:'):
+				return int(line.split()[1])
+	return 0
+
+
+def percentile(values, p):
+	if not values:
+		return float('nan')
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def replay(cls, path, count, config, seconds):
+	Capture.episodes = EpisodeStore(limit=10**6)
+	captures = [cls(SimpleNamespace(name=f"replay{i}", url=path, config=config)) for i in range(count)]
+
+	rss0 = rss_bytes()
+	peak_rss = [rss0]
+	peak_threads = [os_threads()]
+	done = threading.Event()
+
+	def sample_rss():
+		while not done.wait(0.1):
+			peak_rss[0] = max(peak_rss[0], rss_bytes())
+			peak_threads[0] = max(peak_threads[0], os_threads())
+	threading.Thread(target=sample_rss, daemon=True).start()
+
+	cpu0, wall0 = time.process_time(), time.monotonic()
+	for c in captures:
+		c.start()
+	deadline = wall0 + seconds
+	for c in captures:
+		c.join(max(0.0, deadline - time.monotonic()))
+	# Let the workers finish the frames still queued at end of stream
+	while time.monotonic() < deadline and any(c.frames.items or c.frames.scheduled for c in captures):
+		time.sleep(0.01)
+	for c in captures:
+		c.stop()
+	for c in captures:
+		c.join(5.0)
+	wall = time.monotonic() - wall0
+	cpu = time.process_time() - cpu0
+	done.set()
+
+	latencies = [l for c in captures for l in c.latencies]
+	return {
+		'streams': count,
+		'received': sum(c.frames.received for c in captures),
+		'processed': sum(c.frames.processed for c in captures),
+		'dropped': sum(c.frames.dropped for c in captures),
+		'wall': wall,
+		'cpu': cpu,
+		'rss': peak_rss[0],
+		'rss_per_stream': (peak_rss[0] - rss0) / count,
+		'threads': peak_threads[0],
+		'latencies': latencies,
+		'episodes': len(Capture.episodes),
+	}
+
+
+def synthetic_file(seconds):
+	"""Write the synthetic QR clip of bench_sampling to a temporary MJPEG AVI"""
+	import cv2
+	from bench_sampling import synthetic_clip
+
+	path = os.path.join(tempfile.mkdtemp(prefix='bench_replay_'), 'synthetic.avi')
+	writer = None
+	for frame, fps in synthetic_clip(seconds):
+		if writer is None:
+			writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (frame.shape[1], frame.shape[0]))
+		writer.write(frame)
+	writer.release()
+	return path
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('clip', nargs='?')
+	parser.add_argument('--synthetic', type=float, metavar='SECONDS', help='replay a generated clip of this length')
+	parser.add_argument('--streams', type=int, nargs='+', default=[1, 8, 32, 64])
+	parser.add_argument('--capture', default='qr_recognizer:QrRecognizer', help='module:Class of the Capture subclass')
+	parser.add_argument('--config', default='{}', help='stream config JSON, e.g. pipeline or sampling options')
+	parser.add_argument('--realtime', action='store_true', help='replay at the clip frame rate instead of as fast as possible')
+	parser.add_argument('--workers', type=int, help='dispatcher worker threads, default number of CPUs')
+	parser.add_argument('--main-loops', type=int, help='shared GLib loops driving the pipelines, default a thread per stream')
+	parser.add_argument('--seconds', type=float, default=120.0, help='stop a run after this long')
+	args = parser.parse_args()
+	if bool(args.clip) == bool(args.synthetic):
+		parser.error('give a clip to replay or --synthetic')
+
+	path = os.path.abspath(args.clip) if args.clip else synthetic_file(args.synthetic)
+	module, name = args.capture.split(':')
+	base = getattr(importlib.import_module(module), name)
+	cls = type(f"Replay{base.__name__}", (Replay, base), {'realtime': args.realtime})
+	config = json.loads(args.config)
+	if args.workers:
+		Capture.dispatcher.workers = args.workers
+	if args.main_loops:
+		Capture.main_loops = MainLoopPool(size=args.main_loops)
+
+	results = [replay(cls, path, count, config, args.seconds) for count in args.streams]
+
+	print(f"clip={path} capture={args.capture} realtime={args.realtime} workers={Capture.dispatcher.workers} main_loops={args.main_loops or 'off'} cpus={os.cpu_count()}")
+	print(f"{'streams':>7} {'fps':>8} {'fps/stream':>10} {'dropped':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'cpu cores':>9} {'rss MB':>7} {'MB/stream':>9} {'threads':>7} {'episodes':>8}")
+	for r in results:
+		latencies = r['latencies']
+		fps = r['processed'] / r['wall']
+		print(f"{r['streams']:>7} {fps:>8.1f} {fps / r['streams']:>10.1f} {r['dropped']:>8} "
+			f"{percentile(latencies, 50)*1000:>8.1f} {percentile(latencies, 90)*1000:>8.1f} {percentile(latencies, 99)*1000:>8.1f} "
+			f"{r['cpu'] / r['wall']:>9.2f} {r['rss'] / 2**20:>7.0f} {r['rss_per_stream'] / 2**20:>9.1f} {r['threads']:>7} {r['episodes']:>8}")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""CPU and recall of QrRecognizer with and without sampling and tracking.
+
+Replays recorded clips frame by frame through QrRecognizer.process() twice:
+once with SamplingPolicy and CodeTracker disabled (every frame fully
+decoded) and once with the defaults. Reports CPU time, analysed and tracked
+frames and whether the same QR episodes were produced, with the worst
+open/close time difference.
+
+	python3 bench_sampling.py clip1.mp4 clip2.mkv
+	python3 bench_sampling.py --synthetic 120   # generated static scene with QR codes
+	python3 bench_sampling.py --synthetic 120 --only tracking
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from capture import Capture
+from episode_store import EpisodeStore
+from qr_recognizer import QrRecognizer
+
+
+def synthetic_clip(seconds, fps=25, size=(1280, 720)):
+	"""Static noisy scene, a QR code shows up for 2s every 20s, then another one in its place for 1s"""
+	encoder = cv2.QRCodeEncoder.create()
+	rng = np.random.default_rng(1)
+	background = np.full((size[1], size[0], 3), 120, dtype=np.uint8)
+	cv2.rectangle(background, (100, 100), (500, 400), (60, 90, 30), -1)
+	for i in range(int(seconds * fps)):
+		frame = background.copy()
+		t = i / fps
+		if t % 20 >= 8 and t % 20 < 11.5:
+			# Nearly the same data, so the swap is only told by a few modules
+			qr = encoder.encode(f"https://example.com/{int(t // 20)}" + ("" if t % 20 < 10.5 else "x"))
+			qr = cv2.resize(qr, (qr.shape[1] * 6, qr.shape[0] * 6), interpolation=cv2.INTER_NEAREST)
+			qr = cv2.copyMakeBorder(qr, 24, 24, 24, 24, cv2.BORDER_CONSTANT, value=255)
+			y, x = 200, 700
+			frame[y:y + qr.shape[0], x:x + qr.shape[1]] = qr[:, :, None]
+		noise = rng.normal(0, 2, frame.shape).astype(np.int16)
+		yield np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8), fps
+
+
+def clip_frames(path):
+	cap = cv2.VideoCapture(path)
+	fps = cap.get(cv2.CAP_PROP_FPS) or 25
+	while True:
+		ok, frame = cap.read()
+		if not ok:
+			break
+		yield frame, fps
+	cap.release()
+
+
+# Same timestamps for both runs, so open/close times are comparable
+BASE_NS = 1720000000 * 10**9
+
+
+def replay(frames, config):
+	Capture.episodes = EpisodeStore(limit=10**6)
+	spec = SimpleNamespace(name='bench', url='file://', config=config)
+	recognizer = QrRecognizer(spec)
+	cpu = 0.0
+	count = 0
+	for i, (frame, fps) in enumerate(frames):
+		utc_ns = BASE_NS + int(i * 1e9 / fps)
+		# Only process() is measured, not decoding or generating the clip
+		cpu0 = time.process_time()
+		episodes = recognizer.process(frame, utc_ns)
+		cpu += time.process_time() - cpu0
+		Capture.append_episodes(episodes)
+		count += 1
+	episodes = [(e.payload['qr_url'], e.opened_at, e.closed_at) for e in Capture.episodes.snapshot()]
+	return cpu, count, recognizer.sampling.analysed, recognizer.tracker.verified, episodes
+
+
+def compare(name, load, only=None):
+	off = {'enabled': False}
+	config = {'sampling': off if only == 'tracking' else {}, 'tracking': off if only == 'sampling' else {}}
+	cpu_all, frames, analysed_all, _, baseline = replay(load(), {'sampling': off, 'tracking': off})
+	cpu_gated, _, analysed_gated, tracked, gated = replay(load(), config)
+
+	matched = 0
+	worst_open = worst_close = 0
+	remaining = list(gated)
+	for payload, opened_at, closed_at in baseline:
+		candidates = [e for e in remaining if e[0] == payload]
+		if not candidates:
+			continue
+		best = min(candidates, key=lambda e: abs(e[1] - opened_at))
+		remaining.remove(best)
+		matched += 1
+		worst_open = max(worst_open, abs(best[1] - opened_at))
+		if best[2] is not None and closed_at is not None:
+			worst_close = max(worst_close, abs(best[2] - closed_at))
+
+	print(f"{name}: {frames} frames")
+	print(f"  every frame: cpu {cpu_all:.2f}s, analysed {analysed_all}, episodes {len(baseline)}")
+	print(f"  {only or 'sampled+tracked'}: cpu {cpu_gated:.2f}s, analysed {analysed_gated}, tracked {tracked}, episodes {len(gated)}")
+	print(f"  cpu reduction {cpu_all / max(cpu_gated, 1e-9):.1f}x, recall {matched}/{len(baseline)}, "
+		f"extra episodes {len(remaining)}, worst open/close diff {worst_open}/{worst_close} ms")
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('clips', nargs='*')
+	parser.add_argument('--synthetic', type=float, metavar='SECONDS', help='also replay a generated clip')
+	parser.add_argument('--only', choices=('sampling', 'tracking'), help='enable only one of them')
+	args = parser.parse_args()
+	if not args.clips and not args.synthetic:
+		parser.error('give clips to replay or --synthetic')
+	for path in args.clips:
+		compare(path, lambda: clip_frames(path), args.only)
+	if args.synthetic:
+		compare('synthetic', lambda: synthetic_clip(args.synthetic), args.only)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Startup time of the node and memory of every registered detector.
+
+Starts main.py a few times with an unreachable CONFIG_EXTERNAL and reports
+the time from spawning the process to the first answer of
+/monitoring/liveness, next to the bare interpreter start. Then, in a fresh
+process per analytics of MyManager's registry, it imports the Capture class,
+builds --detectors detectors from its pool and runs one detection pass with
+each on a frame with a QR code, and reports import time, build time and RSS
+per detector right after building and after the first pass.
+
+	python3 bench_startup.py
+	python3 bench_startup.py --runs 10 --detectors 32
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from types import SimpleNamespace
+
+LIVENESS = 'http://127.0.0.1:8020/vision/api/v3/monitoring/liveness'
+
+
+def rss_bytes():
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def time_to_liveness(timeout=30.0):
+	env = dict(os.environ, CONFIG_EXTERNAL='http://127.0.0.1:9/')
+	t0 = time.perf_counter()
+	node = subprocess.Popen([sys.executable, 'main.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		while time.perf_counter() - t0 < timeout:
+			try:
+				with urllib.request.urlopen(LIVENESS, timeout=1.0) as r:
+					r.read()
+					return time.perf_counter() - t0
+			except OSError:
+				if node.poll() is not None:
+					raise RuntimeError(f"main.py exited with {node.returncode}")
+				time.sleep(0.002)
+		raise RuntimeError("no liveness answer")
+	finally:
+		node.kill()
+		node.wait()
+
+
+def interpreter_start():
+	t0 = time.perf_counter()
+	subprocess.run([sys.executable, '-c', 'pass'], check=True)
+	return time.perf_counter() - t0
+
+
+def qr_frame(width=1280, height=720):
+	import cv2
+	import numpy as np
+
+	frame = np.full((height, width, 3), 120, dtype=np.uint8)
+	qr = cv2.QRCodeEncoder.create().encode("https://example.com/startup")
+	qr = cv2.resize(qr, (qr.shape[1] * 6, qr.shape[0] * 6), interpolation=cv2.INTER_NEAREST)
+	qr = cv2.copyMakeBorder(qr, 24, 24, 24, 24, cv2.BORDER_CONSTANT, value=255)
+	frame[100:100 + qr.shape[0], 200:200 + qr.shape[1]] = qr[:, :, None]
+	return frame
+
+
+def measure_detector(name, count):
+	"""Runs in a process of its own, prints JSON"""
+	from main import MyManager
+
+	rss0 = rss_bytes()
+	t1 = time.perf_counter()
+	cls = MyManager('http://127.0.0.1:9/').analytics.resolve(SimpleNamespace(config={'analytics': name}))
+	import_time = time.perf_counter() - t1
+	rss1 = rss_bytes()
+	pool = getattr(cls, 'detectors', None)
+	if pool is None:
+		print(json.dumps({'name': name}))
+		return
+	frame = qr_frame()
+
+	rss2 = rss_bytes()
+	t1 = time.perf_counter()
+	detectors = [pool.factory() for _ in range(count)]
+	build_time = (time.perf_counter() - t1) / count
+	rss3 = rss_bytes()
+	t1 = time.perf_counter()
+	decoded = sum(bool(d.detectAndDecodeMulti(frame)[0]) for d in detectors)
+	first_pass = (time.perf_counter() - t1) / count
+	rss4 = rss_bytes()
+	print(json.dumps({
+		'name': name,
+		'class': f"{cls.__module__}:{cls.__name__}",
+		'import_ms': import_time * 1000,
+		'import_mb': (rss1 - rss0) / 2**20,
+		'build_us': build_time * 1e6,
+		'built_kb': (rss3 - rss2) / count / 1024,
+		'first_pass_ms': first_pass * 1000,
+		'in_use_kb': (rss4 - rss2) / count / 1024,
+		'decoded': decoded,
+	}))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--runs', type=int, default=5, help='node starts to time')
+	parser.add_argument('--detectors', type=int, default=16, help='detectors built per analytics')
+	parser.add_argument('--measure', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	os.chdir(os.path.dirname(os.path.abspath(__file__)))
+	if args.measure:
+		measure_detector(args.measure, args.detectors)
+		return
+
+	interpreter = [interpreter_start() for _ in range(args.runs)]
+	liveness = [time_to_liveness() for _ in range(args.runs)]
+	print(f"{'start':<22} {'p50 ms':>8} {'min ms':>8} {'max ms':>8}")
+	for label, values in (('python3 -c pass', interpreter), ('main.py to liveness', liveness)):
+		print(f"{label:<22} {percentile(values, 50)*1000:>8.1f} {min(values)*1000:>8.1f} {max(values)*1000:>8.1f}")
+
+	from main import MyManager
+	names = sorted(MyManager('http://127.0.0.1:9/').analytics.targets)
+	print()
+	print(f"{'analytics':<14} {'import ms':>9} {'import MB':>9} {'build us':>8} {'built KB':>8} {'pass ms':>7} {'in use KB':>9} {'decoded':>7}")
+	for name in names:
+		out = subprocess.run([sys.executable, __file__, '--measure', name, '--detectors', str(args.detectors)],
+			capture_output=True, text=True)
+		lines = out.stdout.strip().splitlines()
+		try:
+			r = json.loads(lines[-1])
+		except (IndexError, ValueError):
+			print(f"{name:<14} failed: {out.stderr.strip().splitlines()[-1:] or lines[-1:]}")
+			continue
+		if 'build_us' not in r:
+			print(f"{name:<14} no detector pool")
+			continue
+		print(f"{name:<14} {r['import_ms']:>9.1f} {r['import_mb']:>9.1f} {r['build_us']:>8.1f} {r['built_kb']:>8.1f} "
+			f"{r['first_pass_ms']:>7.1f} {r['in_use_kb']:>9.1f} {r['decoded']:>4}/{args.detectors}")
+
+
+if __name__ == '__main__':
+	main()
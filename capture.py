@@ -1,117 +1,443 @@
 
-import sys
+import contextlib
+import random
+import threading
 import time
-import gi
-gi.require_version('Gst', '1.0')
-from gi.repository import Gst
-from gi.repository import GLib
-import numpy as np
 
+from episode_store import Episode, EpisodeIds, EpisodeStore
+from dispatch import FrameDispatcher, FrameQueue
+from frame_clock import FrameClock, ntp_to_utc_ns
+from metrics import RateLimitedLog, StreamMetrics
 
-Gst.init(None)
+# Set by load_gstreamer()
+Gst = GstVideo = GLib = np = None
+_load_lock = threading.Lock()
 
-class Episode(object):
-	GENERIC="generic"
-	QR_CODE="qr_code"
 
-	def __init__(self, **kwargs):
-		self.episode_id = kwargs['episode_id']
-		self.media = kwargs['media']
-		self.opened_at = kwargs['opened_at']
-		self.updated_at = kwargs['updated_at']
-		self.payload = ""
-		self.episode_type = kwargs.get('episode_type', Episode.GENERIC)		
+def load_gstreamer():
+	"""Import and init GStreamer (and numpy) once, called by the first Capture.
+
+	Not done on import, so the node serves HTTP before they are loaded.
+	"""
+	global Gst, GstVideo, GLib, np
+	with _load_lock:
+		if Gst is not None:
+			return
+		t1 = time.perf_counter()
+		import gi
+		gi.require_version('Gst', '1.0')
+		gi.require_version('GstVideo', '1.0')
+		from gi.repository import Gst as gst
+		gst.init(None)
+		from gi.repository import GstVideo
+		from gi.repository import GLib
+		import numpy as np
+		# Last, it marks the load as done
+		Gst = gst
+		print(f"[Capture] {Gst.version_string()} loaded in {(time.perf_counter() - t1)*1000:.0f}ms")
+
+class PipelineConfig(object):
+	"""Decode part of the capture pipeline, set per stream.
+
+	Comes from the optional "pipeline" object of the stream config, e.g.
+	{"codec": "h265", "width": 960, "format": "GRAY8", "decoder_threads": 2,
+	"keyframes_only": true}, or is passed to Capture by Manager.launch().
+	"""
+	CODECS = {
+		'h264': 'rtph264depay ! h264parse',
+		'h265': 'rtph265depay ! h265parse',
+	}
+	FORMATS = ('BGR', 'GRAY8')
+
+	def __init__(self, codec='h264', width=None, height=None, format=None, decoder_threads=0, keyframes_only=False):
+		if codec not in self.CODECS:
+			raise ValueError(f"Unsupported codec {codec}, expected one of {list(self.CODECS)}")
+		if format is not None and format not in self.FORMATS:
+			raise ValueError(f"Unsupported format {format}, expected one of {list(self.FORMATS)}")
+		self.codec = codec
+		self.width = width
+		self.height = height
+		self.format = format
+		self.decoder_threads = decoder_threads
+		self.keyframes_only = keyframes_only
+
+	@classmethod
+	def from_spec(cls, spec):
+		config = getattr(spec, 'config', None) or {}
+		return cls(**config.get('pipeline', {}))
+
+	def decode_chain(self):
+		chain = self.CODECS[self.codec]
+		if self.keyframes_only:
+			# Delta frames are dropped before the decoder, so only key frames
+			# are decoded at all
+			chain += ' ! identity drop-buffer-flags=delta-unit'
+		chain += f' ! avdec_{self.codec} max-threads={int(self.decoder_threads)}'
+		return chain + ' ! ' + self.convert_chain()
+
+	def convert_chain(self):
+		"""Raw video to the frames process() gets: scale, convert, caps"""
+		chain = ''
+		if self.width or self.height:
+			# Scale before converting, so videoconvert works on the small frame
+			chain += 'videoscale ! '
+		# videoconvert is required to change from I420 to BGR
+		chain += 'videoconvert ! '
+		if self.format is None and not (self.width or self.height):
+			return chain + 'video/x-raw, format=(string){BGR, GRAY8}; video/x-bayer,format=(string){rggb,bggr,grbg,gbrg}'
+		caps = f'video/x-raw, format=(string){self.format or "BGR"}'
+		if self.width:
+			caps += f', width=(int){int(self.width)}'
+		if self.height:
+			caps += f', height=(int){int(self.height)}'
+		return chain + caps
 
-		for k,v in kwargs.items():
-			setattr(self,k,v)
 
 class Capture(object):
 	NTP_EPOCH_DELTA=2208988800
-	episodes = []
+	# Frames handed to process() are read-only views of the mapped Gst.Buffer and
+	# are only valid until process() returns. Subclasses that keep frames around
+	# (or write into them) set this to True to get a private copy instead.
+	copy_frames = False
+	# process() runs on this shared worker pool, the appsink callback only
+	# enqueues into a per-stream latest-wins queue of queue_size frames
+	dispatcher = FrameDispatcher()
+	queue_size = 1
 	episodes_limit = 1000
+	# Supervision: a stream without frames for stall_timeout seconds (or
+	# connect_timeout before the first frame) is rebuilt after a jittered
+	# exponential backoff between backoff_base and backoff_max seconds
+	reconnect = True
+	connect_timeout = 10.0
+	stall_timeout = 5.0
+	backoff_base = 0.5
+	backoff_max = 30.0
+	# When set to a mainloop.MainLoopPool, start() drives the pipeline from the
+	# pool's shared main loops instead of a thread of its own
+	main_loops = None
+	# JPEG previews of episodes, a snapshots.SnapshotStore when enabled
+	snapshots = None
+	episodes = EpisodeStore(limit=episodes_limit)
+	# Ids of new episodes, unique across streams, see new_episode_id()
+	episode_ids = EpisodeIds()
 
 	def append_episode(episode):
 		Capture.episodes.append(episode)
-		if len(Capture.episodes) > Capture.episodes_limit:
-			Capture.episodes = Capture.episodes[1:]
+
+	def append_episodes(result):
+		"""Commit what process() returned: None, an Episode or a list of them"""
+		if isinstance(result, Episode):
+			Capture.episodes.append(result)
+		elif result:
+			for episode in result:
+				Capture.episodes.append(episode)
 	
 	def update_episode(episode_id, **kwargs):
-		"""Update existing episode by episode_id"""
-		for ep in Capture.episodes:
-			if ep.episode_id == episode_id:
-				for k, v in kwargs.items():
-					setattr(ep, k, v)
-				return ep
-		return None
+		"""Update existing episode by episode_id, returns the committed copy or None"""
+		return Capture.episodes.update(episode_id, **kwargs)
+
+	def new_episode_id(utc_ns):
+		"""Id for an episode opened on the frame of utc_ns, unique across all streams of the node"""
+		return Capture.episode_ids.next(utc_ns)
+
+	def snapshot_episode(episode_id, image, roi=None):
+		"""Queue a JPEG preview of the frame (or its roi, x0, y0, x1, y1) for the episode, never blocks"""
+		if Capture.snapshots is None:
+			return False
+		return Capture.snapshots.submit(episode_id, image, roi)
 
-	def __init__(self, spec):
+	def __init__(self, spec, pipeline=None):
+		load_gstreamer()
+		self.spec = spec
+		self.pipeline_config = pipeline or PipelineConfig.from_spec(spec)
 		self.rtsp_url = spec.url
 		self.name = spec.name
 		self.frame_count = 0
-		self.last_log_time = time.time()
+		self.log = RateLimitedLog(self.name, 5.0)
 		self.should_stop = False
 		self.loop = None
 		self.pipeline = None
+		# Thread running run(), or the shared loop driving the capture
+		self.thread = None
+		self.main = None
+		self._watchdog = None
+		self._retry = None
+		self._done = threading.Event()
+		# connecting, playing, stalled (waiting to reconnect) or stopped
+		self.state = 'connecting'
+		self.reconnects = 0
+		self.failures = 0
+		self.last_error = None
+		self.last_frame_at = time.monotonic()
+		self.frames_since_connect = 0
+		# PTS to UTC of the current pipeline, for frames without NTP meta
+		self.clock = FrameClock()
+		self.wallclock_timestamps = 0
+		self._wakeup = threading.Event()
+		self._caps = None
+		self._video_info = None
+		self.frames = FrameQueue(maxsize=self.queue_size)
+		# Frames per second handed to process(), None for all. Set by
+		# admission control when the node is over its CPU budget
+		self.analysis_fps = None
+		self.frames_throttled = 0
+		self._analysis_interval = 0.0
+		self._next_analysis = 0.0
+		# Seconds spent in process(), used to balance streams across workers
+		self.process_time = 0.0
+		self.created_at = time.monotonic()
+		self.metrics = StreamMetrics(self.queue_size)
 
-	def run(self):
-		print(f"[{self.name}] Capture started for stream: {self.name}, RTSP URL: {self.rtsp_url}")
-		# videoconvert is required to change from I420 to BGR
+	def source_chain(self):
+		"""Pipeline up to the raw frames, a source element named ingress gets the URL as location"""
 		# https://gstreamer.freedesktop.org/documentation/rtsp/rtspsrc.html?gi-language=c#rtspsrc:add-reference-timestamp-meta
-		gstreamer_cmd = ('rtspsrc name=ingress latency=0 protocols=tcp tcp-timeout=5000000 drop-on-latency=true '
+		return ('rtspsrc name=ingress latency=0 protocols=tcp tcp-timeout=5000000 drop-on-latency=true '
 			'add-reference-timestamp-meta=true ! '
-			'rtph264depay ! h264parse ! avdec_h264 ! videoconvert ! '
-			'video/x-raw, format=(string){BGR, GRAY8}; video/x-bayer,format=(string){rggb,bggr,grbg,gbrg} !'
+			f'{self.pipeline_config.decode_chain()}')
+
+	def start(self):
+		"""Play the stream in the background, returns without waiting for it.
+
+		On the shared loops of Capture.main_loops when it is set, in a thread
+		running run() otherwise.
+		"""
+		if Capture.main_loops is None:
+			self.thread = threading.Thread(target=self.run, name=self.name)
+			self.thread.start()
+			return
+		self.main = Capture.main_loops.assign()
+		print(f"[{self.name}] Capture started on {self.main.name} for stream: {self.name}, RTSP URL: {self.rtsp_url}")
+		self.main.call_soon(self.connect)
+
+	def join(self, timeout=None):
+		"""Wait until the capture has stopped, True if it has"""
+		return self._done.wait(timeout)
+
+	def run(self):
+		"""Play the stream until stop(), reconnecting whenever it fails or stalls"""
+		print(f"[{self.name}] Capture started for stream: {self.name}, RTSP URL: {self.rtsp_url}")
+		while not self.should_stop:
+			self.play_once()
+			if self.should_stop or not self.reconnect:
+				break
+			self._wakeup.wait(self.next_backoff())
+		self.finish()
+
+	def play_once(self):
+		"""Build the pipeline and run it until EOS, an error, a stall or stop()"""
+		# A context of this thread's own, the default one would be shared by
+		# every capture thread and dispatch their bus messages anywhere
+		context = GLib.MainContext.new()
+		context.push_thread_default()
+		try:
+			if self.build_pipeline() is None:
+				return
+			self.loop = GLib.MainLoop.new(context, False)
+			self._watchdog = GLib.timeout_source_new(500)
+			self._watchdog.set_callback(lambda *_: self.on_watchdog())
+			self._watchdog.attach(context)
+			try:
+				if not self.set_playing() or self.should_stop:
+					return
+				print(f"[{self.name}] Pipeline state set to PLAYING, waiting for frames...")
+				self.loop.run()
+			except KeyboardInterrupt:
+				print(f"[{self.name}] Interrupted by user")
+				self.should_stop = True
+			except Exception as e:
+				self.last_error = f"{type(e).__name__}: {e}"
+				print(f"[{self.name}] Error in main loop: {e}")
+			finally:
+				# Already removed when the watchdog ended the attempt
+				if self._watchdog is not None:
+					self._watchdog.destroy()
+					self._watchdog = None
+				self.loop = None
+				self.teardown()
+		finally:
+			context.pop_thread_default()
+
+	def connect(self):
+		"""One connection attempt on the shared loop, the bus and the watchdog end it"""
+		self._retry = None
+		if self.should_stop:
+			self.finish()
+			return
+		if self.build_pipeline() is None or not self.set_playing():
+			self.disconnect()
+			return
+		self._watchdog = self.main.call_later(0.5, self.on_watchdog)
+
+	def disconnect(self):
+		"""End the attempt on the shared loop, then reconnect after the backoff or finish"""
+		if self._done.is_set():
+			return
+		if self.pipeline is not None:
+			if self._watchdog is not None:
+				self._watchdog.destroy()
+				self._watchdog = None
+			self.teardown()
+		elif self._retry is not None:
+			if not self.should_stop:
+				# Already waiting to reconnect
+				return
+			self._retry.destroy()
+			self._retry = None
+		if self.should_stop or not self.reconnect:
+			self.finish()
+		else:
+			self._retry = self.main.call_later(self.next_backoff(), self.connect)
+
+	def build_pipeline(self):
+		"""Create the pipeline of one attempt with its bus watch, None if it can't be built"""
+		self.state = 'connecting'
+		self.frames_since_connect = 0
+		self.last_frame_at = time.monotonic()
+		# PTS of a new pipeline start over
+		self.clock.reset()
+		gstreamer_cmd = (f'{self.source_chain()} ! '
 			'appsink name=egress emit-signals=True sync=False drop=true max-lateness=500000000 max-buffers=4')
+		print(f"[{self.name}] Pipeline: {gstreamer_cmd}")
 
-		pipeline = Gst.parse_launch(gstreamer_cmd)
+		try:
+			pipeline = Gst.parse_launch(gstreamer_cmd)
+		except GLib.Error as e:
+			self.last_error = f"parse: {e.message}"
+			print(f"[{self.name}] ERROR: Failed to build pipeline: {e.message}")
+			return None
 
 		source = pipeline.get_by_name('ingress')
-		source.set_property('location', self.rtsp_url)
+		if source is not None:
+			source.set_property('location', self.rtsp_url)
 
 		sink = pipeline.get_by_name('egress')
 		# sink.connect("new-sample", aaa)
 		sink.connect("new-sample", self.on_new_sample)
 
 		print(f"[{self.name}] Pipeline created, setting state to PLAYING...")
-		self.loop = GLib.MainLoop()
+		# End of stream, errors and the watchdog end this attempt, messages
+		# posted before the loop runs are kept on the bus. The watch attaches
+		# to the thread default context: the shared loop's or the default one
+		bus = pipeline.get_bus()
+		bus.add_signal_watch()
+		bus.connect("message::eos", self.on_bus_eos)
+		bus.connect("message::error", self.on_bus_error)
 		self.pipeline = pipeline
-		
-		# Set pipeline to PLAYING and wait for state change
-		ret = pipeline.set_state(Gst.State.PLAYING)
+		return pipeline
+
+	def set_playing(self):
+		# Live sources complete the change asynchronously, this doesn't block
+		ret = self.pipeline.set_state(Gst.State.PLAYING)
 		if ret == Gst.StateChangeReturn.FAILURE:
+			self.last_error = "failed to set PLAYING"
 			print(f"[{self.name}] ERROR: Failed to set pipeline to PLAYING state")
+			return False
+		return True
+
+	def teardown(self):
+		print(f"[{self.name}] Stopping pipeline...")
+		pipeline, self.pipeline = self.pipeline, None
+		pipeline.get_bus().remove_signal_watch()
+		pipeline.set_state(Gst.State.NULL)
+		if not self.should_stop:
+			self.state = 'stalled'
+		print(f"[{self.name}] Pipeline stopped. Frames received: {self.frames_since_connect}")
+
+	def next_backoff(self):
+		"""Seconds to wait before the next attempt, jittered exponential"""
+		# A connection that delivered frames starts the backoff over
+		self.failures = 0 if self.frames_since_connect else self.failures + 1
+		delay = min(self.backoff_max, self.backoff_base * 2 ** self.failures) * random.uniform(0.5, 1.0)
+		self.reconnects += 1
+		print(f"[{self.name}] Reconnecting in {delay:.1f}s (attempt {self.failures + 1}, reason: {self.last_error})")
+		return delay
+
+	def finish(self):
+		if self._done.is_set():
 			return
-		elif ret == Gst.StateChangeReturn.ASYNC:
-			# Wait for state change to complete
-			ret = pipeline.get_state(timeout=Gst.SECOND * 5)
-			if ret[0] == Gst.StateChangeReturn.FAILURE:
-				print(f"[{self.name}] ERROR: Pipeline failed to transition to PLAYING state")
-				return
-			elif ret[0] == Gst.StateChangeReturn.TIMEOUT:
-				print(f"[{self.name}] WARNING: Pipeline state change timed out")
-			else:
-				state_name = "NULL" if ret[1] == Gst.State.NULL else "READY" if ret[1] == Gst.State.READY else "PLAYING" if ret[1] == Gst.State.PLAYING else "PAUSED"
-				print(f"[{self.name}] Pipeline state: {state_name}")
-		
-		print(f"[{self.name}] Pipeline state set to PLAYING, waiting for frames...")
-		try:
-			self.loop.run()
-		except KeyboardInterrupt:
-			print(f"[{self.name}] Interrupted by user")
-		except Exception as e:
-			print(f"[{self.name}] Error in main loop: {e}")
-		finally:
-			print(f"[{self.name}] Stopping pipeline...")
-			if self.pipeline:
-				self.pipeline.set_state(Gst.State.NULL)
-			print(f"[{self.name}] Pipeline stopped. Total frames processed: {self.frame_count}")
+		self.state = 'stopped'
+		if self.main is not None:
+			Capture.main_loops.release(self.main)
+		print(f"[{self.name}] Capture finished. Total frames received: {self.frame_count}")
+		self._done.set()
+
+	def end_attempt(self):
+		"""The source is gone: quit the loop of run(), or disconnect on the shared loop"""
+		if self.main is not None:
+			self.disconnect()
+		elif self.loop:
+			self.loop.quit()
+
+	def on_bus_eos(self, bus, message):
+		print(f"[{self.name}] End of stream")
+		self.last_error = "end of stream"
+		self.end_attempt()
+
+	def on_bus_error(self, bus, message):
+		err, debug = message.parse_error()
+		print(f"[{self.name}] Pipeline error from {message.src.get_name()}: {err.message}")
+		self.last_error = err.message
+		self.end_attempt()
+
+	def on_watchdog(self):
+		"""No frame for stall_timeout (connect_timeout before the first one) means the source is gone"""
+		timeout = self.stall_timeout if self.frames_since_connect else self.connect_timeout
+		silent = time.monotonic() - self.last_frame_at
+		if silent >= timeout and self.pipeline is not None:
+			self.last_error = f"no frames for {silent:.1f}s"
+			print(f"[{self.name}] Stalled: {self.last_error}")
+			# Returning False removes the source, it must not be removed again
+			self._watchdog = None
+			self.end_attempt()
+			return False
+		return True
 
 	def stop(self):
 		"""Stop the capture gracefully"""
 		print(f"[{self.name}] Stop requested")
 		self.should_stop = True
-		if self.loop:
-			self.loop.quit()
+		self.state = 'stopped'
+		Capture.dispatcher.cancel(self)
+		self._wakeup.set()
+		if self.main is not None:
+			# Torn down on the shared loop, which keeps running
+			self.main.call_soon(self.disconnect)
+			return
+		loop = self.loop
+		if loop:
+			# Quit from the loop itself: a quit() before run() starts is lost
+			source = GLib.idle_source_new()
+			source.set_callback(lambda *_: loop.quit())
+			source.attach(loop.get_context())
+
+	def stats(self):
+		"""Frame counters: dropped grows when process() can't keep up"""
+		stats = {
+			'state': self.state,
+			'reconnects': self.reconnects,
+			'frames_received': self.frames.received,
+			'frames_processed': self.frames.processed,
+			'frames_dropped': self.frames.dropped,
+			'process_load': round(self.process_load(), 3),
+			'frames_throttled': self.frames_throttled,
+			# Where frame times came from: NTP meta, PTS mapped by the clock, wall clock
+			'timestamps_meta': self.clock.exact,
+			'timestamps_interpolated': self.clock.interpolated,
+			'timestamps_wallclock': self.wallclock_timestamps,
+		}
+		if self.frames.worker is not None:
+			stats['worker'] = self.frames.worker
+		if self.last_error:
+			stats['last_error'] = self.last_error
+		return stats
+
+	def set_analysis_fps(self, fps):
+		self.analysis_fps = fps
+		self._analysis_interval = 1.0 / fps if fps else 0.0
+
+	def process_load(self):
+		"""Average seconds of process() per second of wall time"""
+		return self.process_time / max(time.monotonic() - self.created_at, 1.0)
 
 	def on_new_sample(self, appsink):
 		if self.should_stop:
@@ -119,49 +445,142 @@ class Capture(object):
 		sample = appsink.emit("pull-sample")
 		if sample:
 			buffer = sample.get_buffer()
-			caps = sample.get_caps()
-			meta = buffer.get_reference_timestamp_meta(None)
-			
-			# Extract image dimensions and data
-			height = caps.get_structure(0).get_value('height')
-			width = caps.get_structure(0).get_value('width')
-			
-			img = np.ndarray(
-	            (height, width, 3),
-	            buffer=buffer.extract_dup(0, buffer.get_size()),
-	            dtype=np.uint8)
-
-			# Get timestamp - use meta if available, otherwise use current time
-			if meta:
-				# timestamp/x-ntp
-				tsmeta = buffer.get_reference_timestamp_meta(None)
-				utc_ns = tsmeta.timestamp - Capture.NTP_EPOCH_DELTA*1e9
+			now_ns = time.time_ns()
+			latency_ns = 0
+			clock = appsink.get_clock()
+			if clock is not None and buffer.pts != Gst.CLOCK_TIME_NONE:
+				running_time = sample.get_segment().to_running_time(Gst.Format.TIME, buffer.pts)
+				latency_ns = clock.get_time() - appsink.get_base_time() - running_time
+				self.metrics.decode_latency.observe(latency_ns / 1e9)
+
+			utc_ns = self.frame_timestamp(buffer)
+			if utc_ns is not None:
+				self.metrics.observe_skew((now_ns - utc_ns) / 1e9)
 			else:
-				# Fallback to current time if no timestamp meta
-				utc_ns = int(time.time() * 1e9)
-				# Log when timestamp meta is missing (but less frequently)
-				if self.frame_count == 0:
-					print(f"[{self.name}] Warning: First frame has no timestamp meta, using current time")
-				elif self.frame_count % 100 == 0:
-					print(f"[{self.name}] Warning: Frame #{self.frame_count} has no timestamp meta, using current time")
+				# No NTP time seen on this connection yet: wall clock when the
+				# frame entered the pipeline, not when decoding finished
+				utc_ns = now_ns - max(latency_ns, 0)
+				self.wallclock_timestamps += 1
+				if self.log.due('no_timestamp_meta'):
+					self.log.emit('no_timestamp_meta', frame=self.frame_count)
 
 			self.frame_count += 1
-			current_time = time.time()
-			# Log frame info every 5 seconds
-			if current_time - self.last_log_time >= 5.0:
-				print(f"[{self.name}] Processing frame #{self.frame_count}, size: {width}x{height}, timestamp: {utc_ns/1e9:.3f}s")
-				self.last_log_time = current_time
+			self.frames_since_connect += 1
+			now = time.monotonic()
+			self.last_frame_at = now
+			if self.state == 'connecting':
+				self.state = 'playing'
+			self.metrics.count_frame(now)
+			if self.log.due('frames'):
+				self.log.emit('frames', received=self.frame_count, timestamp=utc_ns/1e9, fps=self.metrics.fps,
+					processed=self.frames.processed, dropped=self.frames.dropped)
 
-			# Process frame regardless of timestamp meta presence
-			episode = self.process(img, utc_ns)
-			if episode:
-				Capture.append_episode(episode)
+			if self._analysis_interval:
+				if now < self._next_analysis:
+					self.frames_throttled += 1
+					return Gst.FlowReturn.OK
+				# Advance by the interval, so the cap holds on average despite jitter
+				self._next_analysis = max(self._next_analysis + self._analysis_interval, now)
+
+			# The sample keeps the buffer alive until a worker gets to it
+			Capture.dispatcher.submit(self, (sample, utc_ns))
 		else:
 			# Log when sample is None (should not happen often)
-			if self.frame_count == 0:
-				print(f"[{self.name}] Warning: Received None sample on first attempt")
+			self.log('none_sample', frame=self.frame_count)
 		return Gst.FlowReturn.OK
 
+	def frame_timestamp(self, buffer):
+		"""Integer UTC nanoseconds of the frame, None when it can't be told.
+
+		From the NTP reference timestamp when the frame has one, mapped from
+		the PTS by self.clock otherwise.
+		"""
+		meta = buffer.get_reference_timestamp_meta(None)
+		has_pts = buffer.pts != Gst.CLOCK_TIME_NONE
+		if meta:
+			# timestamp/x-ntp
+			utc_ns = ntp_to_utc_ns(meta.timestamp)
+			if has_pts:
+				self.clock.observe(buffer.pts, utc_ns)
+			return utc_ns
+		if has_pts:
+			return self.clock.utc_ns(buffer.pts)
+		return None
+
+	def handle_frame(self, sample, utc_ns):
+		"""Runs on a dispatcher worker: wraps the sample into ndarray and calls process()"""
+		if self.should_stop:
+			return
+		with self.mapped_frame(sample) as img:
+			if img is None:
+				return
+			if self.copy_frames:
+				img = img.copy()
+			# Process frame regardless of timestamp meta presence
+			t1 = time.perf_counter()
+			episodes = self.process(img, utc_ns)
+			duration = time.perf_counter() - t1
+			self.process_time += duration
+			self.metrics.process.observe(duration)
+		Capture.append_episodes(episodes)
+
+	@contextlib.contextmanager
+	def mapped_frame(self, sample):
+		"""Map the sample buffer read-only and yield it as ndarray without copying.
+
+		The mapping is released when the block exits, yields None if the buffer
+		can't be mapped.
+		"""
+		buffer = sample.get_buffer()
+		caps = sample.get_caps()
+		# Parse caps only when they change, not on every frame
+		if self._caps is None or not caps.is_equal(self._caps):
+			self._caps = caps
+			self._video_info = GstVideo.VideoInfo.new_from_caps(caps)
+			print(f"[{self.name}] Negotiated format: {self._video_info.finfo.name} {self._video_info.width}x{self._video_info.height}")
+
+		ok, mapinfo = buffer.map(Gst.MapFlags.READ)
+		if not ok:
+			print(f"[{self.name}] Warning: Failed to map buffer")
+			yield None
+			return
+		try:
+			yield self.frame_view(mapinfo.data, GstVideo.buffer_get_video_meta(buffer))
+		finally:
+			buffer.unmap(mapinfo)
+
+	def frame_view(self, data, video_meta=None):
+		"""Wrap mapped frame memory into ndarray honouring plane offset and row stride"""
+		info = self._video_info
+		if video_meta:
+			# Upstream may pad rows differently from the default layout for caps
+			offset, stride = video_meta.offset[0], video_meta.stride[0]
+		else:
+			offset, stride = info.offset[0], info.stride[0]
+		channels = info.finfo.pixel_stride[0]
+		if channels == 1:
+			shape, strides = (info.height, info.width), (stride, 1)
+		else:
+			shape, strides = (info.height, info.width, channels), (stride, channels, 1)
+		return np.ndarray(shape, dtype=np.uint8, buffer=data, offset=offset, strides=strides)
+
+	@classmethod
+	def process_batch(cls, captures, images, timestamps):
+		"""Process frames of several streams of this class at once.
+
+		Called by BatchScheduler, returns one process() result (None, an
+		episode or a list of them) per frame.
+		Override it to run batched inference, e.g. a single cv2.dnn forward pass,
+		and hand each stream its own result. The default calls process() of
+		every stream in turn.
+		"""
+		return [capture.process(image, utc_ns) for capture, image, utc_ns in zip(captures, images, timestamps)]
+
 	def process(self, image, timestamp):
+		"""Analyse one frame, returns None, a new Episode or a list of new episodes.
+
+		Episodes returned are appended to the store. Episodes that change
+		later (updated_at, closed_at) are committed with Capture.update_episode.
+		"""
 		return None
 
@@ -0,0 +1,150 @@
+import importlib
+import os
+import threading
+import time
+
+
+def rss_bytes():
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class DetectorRegistry(object):
+	"""Capture classes by analytics name, selected per stream by the "analytics" field of its config.
+
+	Classes are registered as "module:Class" and imported when the first
+	stream selects them, so cv2, GStreamer and model files are loaded after
+	the node serves HTTP, and only for the analytics in use. Streams without
+	the field get default, e.g. {"name": "cam2", "url": "rtsp://...",
+	"analytics": "qr_code"}.
+	"""
+
+	def __init__(self, default=None):
+		self.default = default
+		# name -> Capture subclass or "module:Class"
+		self.targets = {}
+		self.classes = {}
+		# name -> seconds its module took to import
+		self.load_times = {}
+		self.lock = threading.Lock()
+
+	def register(self, name, target):
+		with self.lock:
+			self.targets[name] = target
+			self.classes.pop(name, None)
+
+	def analytics(self, spec):
+		config = getattr(spec, 'config', None) or {}
+		return config.get('analytics', self.default)
+
+	def resolve(self, spec):
+		"""Capture class of the stream, imported on first use"""
+		name = self.analytics(spec)
+		with self.lock:
+			cls = self.classes.get(name)
+			if cls is not None:
+				return cls
+			target = self.targets.get(name)
+			if target is None:
+				raise ValueError(f"Unknown analytics {name!r}, expected one of {sorted(self.targets)}")
+			if isinstance(target, str):
+				t1 = time.perf_counter()
+				module, _, attr = target.partition(':')
+				cls = getattr(importlib.import_module(module), attr)
+				self.load_times[name] = time.perf_counter() - t1
+				print(f"[Analytics] Loaded {name} ({target}) in {self.load_times[name]*1000:.0f}ms")
+			else:
+				cls = target
+			self.classes[name] = cls
+			return cls
+
+	def stats(self):
+		with self.lock:
+			loaded = dict(self.classes)
+		stats = {}
+		for name in self.targets:
+			entry = {'loaded': name in loaded}
+			if name in self.load_times:
+				entry['load_time'] = round(self.load_times[name], 4)
+			pool = getattr(loaded.get(name), 'detectors', None)
+			if isinstance(pool, DetectorPool):
+				entry['detectors'] = pool.stats()
+			stats[name] = entry
+		return stats
+
+
+class DetectorPool(object):
+	"""Detector instances for the threads that run process(), one per thread.
+
+	Detectors like cv2.QRCodeDetector keep buffers between calls and must not
+	be used by two threads at once, while a stream's frames are processed by
+	any dispatcher worker. get() returns the calling thread's own instance,
+	taken from the warm pool on its first call, or built when the pool is
+	empty. warm(count) builds instances in the background ahead of the first
+	frames, so a detector that loads a model doesn't stall them. Memory is
+	the growth of RSS while building, approximate when other threads allocate
+	at the same time.
+	"""
+
+	def __init__(self, factory, name=None):
+		self.factory = factory
+		self.name = name or getattr(factory, '__name__', 'detector')
+		self.idle = []
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.built = 0
+		self.building = 0
+		self.build_time = 0.0
+		self.build_memory = 0
+
+	def get(self):
+		detector = getattr(self.local, 'detector', None)
+		if detector is None:
+			with self.lock:
+				detector = self.idle.pop() if self.idle else None
+			if detector is None:
+				detector = self.build()
+			self.local.detector = detector
+		return detector
+
+	def build(self):
+		rss0 = rss_bytes()
+		t1 = time.perf_counter()
+		detector = self.factory()
+		elapsed = time.perf_counter() - t1
+		with self.lock:
+			self.built += 1
+			self.build_time += elapsed
+			self.build_memory += max(0, rss_bytes() - rss0)
+		return detector
+
+	def warm(self, count):
+		"""Build instances in the background until count exist"""
+		with self.lock:
+			missing = count - self.built - self.building
+			if missing <= 0:
+				return
+			self.building += missing
+		threading.Thread(target=self._warm, args=(missing,), name=f"warm-{self.name}", daemon=True).start()
+
+	def _warm(self, count):
+		for _ in range(count):
+			try:
+				detector = self.build()
+			except Exception as e:
+				print(f"[Analytics] Error building {self.name}: {type(e).__name__}: {e}")
+				detector = None
+			with self.lock:
+				self.building -= 1
+				if detector is not None:
+					self.idle.append(detector)
+
+	def stats(self):
+		with self.lock:
+			return {
+				'name': self.name,
+				'built': self.built,
+				'idle': len(self.idle),
+				'build_time': round(self.build_time, 4),
+				'memory_per_detector': self.build_memory // self.built if self.built else 0,
+			}
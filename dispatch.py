@@ -0,0 +1,93 @@
+import collections
+import os
+import threading
+
+
+class FrameQueue(object):
+	"""Bounded latest-wins queue of frames of one stream.
+
+	When the queue is full the oldest pending frame is dropped, so a slow
+	detector always gets the freshest frame and never stalls the pipeline.
+	Counters are updated by FrameDispatcher under its lock.
+	"""
+
+	def __init__(self, maxsize=1):
+		self.maxsize = maxsize
+		self.items = collections.deque()
+		self.scheduled = False
+		# Index of the inference process serving the stream, see ProcessDispatcher
+		self.worker = None
+		self.received = 0
+		self.dropped = 0
+		self.processed = 0
+
+
+class FrameDispatcher(object):
+	"""Worker pool that runs Capture.handle_frame() off the GStreamer thread.
+
+	Frames of one stream are never processed concurrently, because process()
+	keeps per-stream state. Different streams are spread over the workers.
+	Threads are started lazily on the first submitted frame.
+	"""
+
+	def __init__(self, workers=None):
+		self.workers = workers or os.cpu_count() or 1
+		self._cond = threading.Condition()
+		self._ready = collections.deque()
+		self._threads = []
+
+	def submit(self, capture, frame):
+		"""Called from the appsink callback, only enqueues"""
+		queue = capture.frames
+		with self._cond:
+			if not self._threads:
+				self._start()
+			queue.received += 1
+			if len(queue.items) >= queue.maxsize:
+				queue.items.popleft()
+				queue.dropped += 1
+			queue.items.append(frame)
+			capture.metrics.queue_depth.observe(len(queue.items))
+			if not queue.scheduled:
+				queue.scheduled = True
+				self._ready.append(capture)
+				self._cond.notify()
+
+	def cancel(self, capture):
+		"""Forget pending frames of a stopped capture"""
+		with self._cond:
+			capture.frames.items.clear()
+
+	def stats(self):
+		with self._cond:
+			return {'workers': self.workers, 'streams_waiting': len(self._ready)}
+
+	def _start(self):
+		for i in range(self.workers):
+			t = threading.Thread(target=self._work, name=f"frame-worker-{i}", daemon=True)
+			t.start()
+			self._threads.append(t)
+		print(f"[Dispatcher] Started {self.workers} frame worker(s)")
+
+	def _work(self):
+		while True:
+			with self._cond:
+				while not self._ready:
+					self._cond.wait()
+				capture = self._ready.popleft()
+				queue = capture.frames
+				if not queue.items:
+					queue.scheduled = False
+					continue
+				frame = queue.items.popleft()
+			try:
+				capture.handle_frame(*frame)
+			except Exception as e:
+				print(f"[{capture.name}] Error processing frame: {type(e).__name__}: {e}")
+			with self._cond:
+				queue.processed += 1
+				if queue.items:
+					self._ready.append(capture)
+					self._cond.notify()
+				else:
+					queue.scheduled = False
@@ -0,0 +1,353 @@
+import bisect
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from episode_store import Episode
+
+
+# Record: magic, payload length, updated_at, episode_id, then the episode wire JSON
+RECORD = struct.Struct('<IIqq')
+RECORD_MAGIC = 0x31495045  # "EPI1"
+# Sparse index entry: record ordinal, running max of updated_at, record
+# offset, smallest updated_at of the block. The first entry of a .idx file
+# is its header: record count, running max, size, INDEX_VERSION.
+INDEX_ENTRY = struct.Struct('<qqqq')
+INDEX_VERSION = 2
+
+
+class _Segment(object):
+	def __init__(self, path):
+		self.path = path
+		self.size = 0
+		self.count = 0
+		# Largest updated_at of this and all previous segments
+		self.max_updated_at = 0
+		self.index = []
+		# Smallest updated_at of the records of every index block, and of
+		# the segment
+		self.mins = []
+		self.min_updated_at = math.inf
+		self._map = None
+		self._mapped = 0
+
+	@property
+	def index_path(self):
+		return self.path[:-len('.seg')] + '.idx'
+
+	def view(self, size):
+		"""mmap covering size bytes of the segment, remapped when the file has grown.
+
+		A reader keeps the map it got: remapping or dropping the segment only
+		lets go of the reference, the old map is closed with its last reader.
+		"""
+		view = self._map
+		if view is None or self._mapped < size:
+			with open(self.path, 'rb') as f:
+				view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+			self._map, self._mapped = view, size
+		return view
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+			self._mapped = 0
+
+	def scan(self, running_max, index_every):
+		"""Rebuild the sparse index from record headers, drop a torn tail"""
+		file_size = os.path.getsize(self.path)
+		self.size = file_size
+		self.index = []
+		self.mins = []
+		self.min_updated_at = math.inf
+		self.count = 0
+		offset = 0
+		if file_size:
+			buf = self.view(file_size)
+			while offset + RECORD.size <= file_size:
+				magic, length, updated_at, _ = RECORD.unpack_from(buf, offset)
+				if magic != RECORD_MAGIC or offset + RECORD.size + length > file_size:
+					break
+				self.add(updated_at, running_max, offset, index_every)
+				running_max = max(running_max, updated_at)
+				self.count += 1
+				offset += RECORD.size + length
+		if offset != file_size:
+			print(f"[EpisodeJournal] Truncating torn tail of {self.path} at {offset} of {file_size} bytes")
+			self.close()
+			os.truncate(self.path, offset)
+		self.size = offset
+		self.max_updated_at = running_max
+		return running_max
+
+	def add(self, updated_at, running_max, offset, index_every):
+		"""Index the record about to be added at offset"""
+		if self.count % index_every == 0:
+			self.index.append((self.count, running_max, offset))
+			self.mins.append(updated_at)
+		elif updated_at < self.mins[-1]:
+			self.mins[-1] = updated_at
+		self.min_updated_at = min(self.min_updated_at, updated_at)
+
+	def write_index(self):
+		with open(self.index_path, 'wb') as f:
+			f.write(INDEX_ENTRY.pack(self.count, self.max_updated_at, self.size, INDEX_VERSION))
+			for entry, block_min in zip(self.index, self.mins):
+				f.write(INDEX_ENTRY.pack(*entry, block_min))
+
+	def read_index(self):
+		"""Load the index written when the segment was sealed, False if unusable"""
+		try:
+			with open(self.index_path, 'rb') as f:
+				data = f.read()
+		except OSError:
+			return False
+		if len(data) < INDEX_ENTRY.size or len(data) % INDEX_ENTRY.size:
+			return False
+		self.count, self.max_updated_at, self.size, version = INDEX_ENTRY.unpack_from(data, 0)
+		if version != INDEX_VERSION or self.size != os.path.getsize(self.path):
+			return False
+		entries = [INDEX_ENTRY.unpack_from(data, o) for o in range(INDEX_ENTRY.size, len(data), INDEX_ENTRY.size)]
+		self.index = [entry[:3] for entry in entries]
+		self.mins = [entry[3] for entry in entries]
+		self.min_updated_at = min(self.mins, default=math.inf)
+		return True
+
+
+class EpisodeJournal(object):
+	"""Append-only on-disk episode journal, read through mmap.
+
+	Every append()/update() of the EpisodeStore writes the whole episode as a
+	new record, the latest record of an episode_id wins. Records live in
+	segment files of segment_size bytes. Every index_every records a sparse
+	index entry keeps the running max of updated_at, so updated_at_gt queries
+	start scanning right where matching records can begin, and the smallest
+	updated_at of its block, so a page stops scanning as soon as no record
+	left can sort in front of its last episode. Sealed segments
+	keep their index in a .idx file, so opening the journal only scans the
+	active segment's headers and never parses payloads.
+
+	Retention is by total size (max_bytes) and age (max_age seconds of the
+	newest record in a segment), whole segments are dropped.
+
+	append() is called under the EpisodeStore lock. Readers take the
+	journal's own lock only to snapshot the segments and their sizes, then
+	read the mmaps without it, so a long query never holds up appends.
+	"""
+
+	def __init__(self, path, segment_size=16 << 20, max_bytes=1 << 30, max_age=7 * 24 * 3600, index_every=64):
+		self.path = path
+		self.segment_size = segment_size
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.index_every = index_every
+		self.segments = []
+		self._file = None
+		self.lock = threading.Lock()
+		os.makedirs(path, exist_ok=True)
+		t1 = time.perf_counter()
+		self._open()
+		print(f"[EpisodeJournal] Opened {path}: {len(self.segments)} segment(s), {len(self)} record(s) in {(time.perf_counter()-t1)*1000:.1f}ms")
+
+	def __len__(self):
+		return sum(seg.count for seg in self.segments)
+
+	@property
+	def max_updated_at(self):
+		return self.segments[-1].max_updated_at if self.segments else 0
+
+	def _open(self):
+		names = sorted(n for n in os.listdir(self.path) if n.endswith('.seg'))
+		running_max = 0
+		for i, name in enumerate(names):
+			seg = _Segment(os.path.join(self.path, name))
+			active = i == len(names) - 1
+			if active or not seg.read_index():
+				running_max = seg.scan(running_max, self.index_every)
+				if not active:
+					seg.write_index()
+			running_max = max(running_max, seg.max_updated_at)
+			self.segments.append(seg)
+		if not self.segments:
+			self._roll()
+		else:
+			self._file = open(self.segments[-1].path, 'ab')
+			self._retain()
+
+	def _roll(self):
+		if self.segments:
+			self._file.close()
+			self.segments[-1].write_index()
+			seq = int(os.path.basename(self.segments[-1].path)[:-len('.seg')]) + 1
+		else:
+			seq = 1
+		seg = _Segment(os.path.join(self.path, f"{seq:010d}.seg"))
+		seg.max_updated_at = self.max_updated_at
+		self._file = open(seg.path, 'ab')
+		self.segments.append(seg)
+
+	def append(self, episode):
+		payload = episode.wire or episode.encode()
+		with self.lock:
+			self._append(episode, payload)
+
+	def _append(self, episode, payload):
+		seg = self.segments[-1]
+		if seg.size and seg.size + RECORD.size + len(payload) > self.segment_size:
+			self._roll()
+			seg = self.segments[-1]
+			self._retain()
+		seg.add(episode.updated_at, seg.max_updated_at, seg.size, self.index_every)
+		self._file.write(RECORD.pack(RECORD_MAGIC, len(payload), episode.updated_at, episode.episode_id) + payload)
+		self._file.flush()
+		seg.size += RECORD.size + len(payload)
+		seg.count += 1
+		seg.max_updated_at = max(seg.max_updated_at, episode.updated_at)
+
+	def _retain(self):
+		now_ms = int(time.time() * 1000)
+		total = sum(seg.size for seg in self.segments)
+		while len(self.segments) > 1:
+			oldest = self.segments[0]
+			# Largest updated_at inside the segment is bounded by its running max
+			expired = oldest.max_updated_at < now_ms - self.max_age * 1000
+			if total <= self.max_bytes and not expired:
+				break
+			# Readers of the segment keep their map, the file goes with it
+			oldest._map = None
+			for path in (oldest.path, oldest.index_path):
+				try:
+					os.unlink(path)
+				except OSError:
+					pass
+			total -= oldest.size
+			self.segments.pop(0)
+			print(f"[EpisodeJournal] Dropped segment {oldest.path} ({oldest.count} records)")
+
+	def _snapshot(self):
+		"""(segment, size, index entries, running max) of every segment, as of now.
+
+		Block mins past the snapshot can only get smaller, so reading them
+		later gives a lower bound that still holds for the snapshot.
+		"""
+		with self.lock:
+			return [(seg, seg.size, len(seg.index), seg.max_updated_at) for seg in self.segments]
+
+	def _records(self, buf, offset, end):
+		while offset < end:
+			_, length, updated_at, episode_id = RECORD.unpack_from(buf, offset)
+			start = offset + RECORD.size
+			yield updated_at, episode_id, buf, start, length
+			offset = start + length
+
+	def _decode(self, buf, start, length):
+		return Episode.decode(buf[start:start + length])
+
+	def since(self, updated_at_gt):
+		"""Latest version of episodes with updated_at > updated_at_gt, oldest first"""
+		return self.query((updated_at_gt, float('inf')))[0]
+
+	def query(self, after, limit=None, match=None):
+		"""(episodes, estimated_count) of the latest versions with (updated_at, episode_id) > after.
+
+		Episodes are ordered by that key. Blocks are read in file order until
+		limit episodes that match(episode) are found below the smallest
+		updated_at of all blocks left, so a page costs about its own size
+		plus the records out of order around it, not the rest of the
+		journal. An episode updated after the end of the scan comes in its
+		earlier version, and again in its latest on a later page, like live
+		pollers see updates. Without a match only the page is decoded.
+		estimated_count is an upper bound of the matching episodes after the
+		cursor.
+		"""
+		updated_at_gt = after[0]
+		segments = self._snapshot()
+		# Segments and index entries are ordered by running max, everything in
+		# front of the last entry with running max < updated_at_gt is older
+		first = bisect.bisect_left([max_updated_at for _, _, _, max_updated_at in segments], updated_at_gt)
+		segments = segments[first:]
+		# Smallest updated_at of segments k and later
+		later_mins = [math.inf] * (len(segments) + 1)
+		for k in range(len(segments) - 1, -1, -1):
+			later_mins[k] = min(later_mins[k + 1], segments[k][0].min_updated_at)
+		# Sorted keys of the candidates, their records by key and their key by episode_id
+		keys = []
+		records = {}
+		candidates = {}
+		unread = None
+		for k, (seg, size, entries, _) in enumerate(segments):
+			if unread is not None:
+				unread += seg.count
+				continue
+			if not entries:
+				continue
+			view = seg.view(size)
+			i = max(0, bisect.bisect_left([e[1] for e in seg.index[:entries]], updated_at_gt) - 1)
+			# Smallest updated_at of block j and everything after it
+			suffix_mins = seg.mins[i:entries]
+			low = later_mins[k + 1]
+			for j in range(len(suffix_mins) - 1, -1, -1):
+				low = suffix_mins[j] = min(suffix_mins[j], low)
+			for j in range(i, entries):
+				if limit is not None and len(keys) >= limit and keys[limit - 1][0] < suffix_mins[j - i]:
+					# Nothing left can sort in front of the page
+					unread = seg.count - seg.index[j][0]
+					break
+				end = seg.index[j + 1][2] if j + 1 < entries else size
+				for updated_at, episode_id, buf, start, length in self._records(view, seg.index[j][2], end):
+					old = candidates.pop(episode_id, None)
+					if old is not None:
+						del keys[bisect.bisect_left(keys, old)]
+						del records[old]
+					key = (updated_at, episode_id)
+					if key <= after:
+						continue
+					episode = None
+					if match is not None:
+						episode = self._decode(buf, start, length)
+						if not match(episode):
+							continue
+					candidates[episode_id] = key
+					records[key] = (episode, buf, start, length)
+					# Records are mostly in key order, so this is usually an append
+					bisect.insort(keys, key)
+		episodes = []
+		for key in keys[:limit]:
+			episode, buf, start, length = records[key]
+			episodes.append(episode if episode is not None else self._decode(buf, start, length))
+		return episodes, len(keys) + (unread or 0)
+
+	def tail(self, limit):
+		"""Latest version of the last limit episodes and the largest (updated_at, episode_id) before them"""
+		found = {}
+		before = (0, 0)
+		segments = self._snapshot()
+		for i in range(len(segments) - 1, -1, -1):
+			seg, size, _, _ = segments[i]
+			records = list(self._records(seg.view(size), 0, size)) if size else []
+			for updated_at, episode_id, buf, start, length in reversed(records):
+				if episode_id in found:
+					continue
+				if len(found) >= limit:
+					before = max(before, (updated_at, episode_id))
+					continue
+				found[episode_id] = (updated_at, buf, start, length)
+			if len(found) >= limit:
+				# Older segments only matter for their running max
+				if i > 0:
+					before = max(before, (segments[i - 1][3], math.inf))
+				break
+		episodes = sorted(found.values(), key=lambda r: r[0])
+		return [self._decode(buf, start, length) for _, buf, start, length in episodes], before
+
+	def close(self):
+		with self.lock:
+			if self._file:
+				self._file.close()
+				self._file = None
+			for seg in self.segments:
+				seg.close()
@@ -0,0 +1,332 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+
+class Episode(object):
+	"""Analytics event served to Central.
+
+	Only fields of the wire schema exist. The JSON fragment of an episode is
+	cached in wire by EpisodeStore on every append/update, so responses are
+	assembled from bytes. Committed episodes are never changed in place,
+	Capture.update_episode commits a changed copy made by replace().
+	"""
+	GENERIC="generic"
+	QR_CODE="qr_code"
+	# Wire schema, fields that are None are left out
+	FIELDS = ('episode_id', 'media', 'episode_type', 'opened_at', 'started_at', 'updated_at', 'closed_at', 'payload')
+	__slots__ = FIELDS + ('wire',)
+
+	def __init__(self, **kwargs):
+		self.episode_id = kwargs['episode_id']
+		self.media = kwargs['media']
+		self.opened_at = kwargs['opened_at']
+		self.updated_at = kwargs['updated_at']
+		self.payload = ""
+		self.episode_type = kwargs.get('episode_type', Episode.GENERIC)
+		self.started_at = None
+		self.closed_at = None
+		self.wire = None
+
+		for k,v in kwargs.items():
+			if k not in Episode.FIELDS:
+				raise TypeError(f"Episode has no field '{k}'")
+			setattr(self,k,v)
+
+	def encode(self):
+		"""Serialize to the JSON wire fragment and cache it"""
+		data = {}
+		for k in Episode.FIELDS:
+			v = getattr(self, k)
+			if v is not None:
+				data[k] = v
+		self.wire = json.dumps(data, separators=(',', ':')).encode()
+		return self.wire
+
+	def replace(self, **kwargs):
+		"""Copy with some fields changed, the wire fragment is not copied"""
+		fields = {k: getattr(self, k) for k in Episode.FIELDS}
+		fields.update(kwargs)
+		return Episode(**fields)
+
+	@classmethod
+	def decode(cls, wire):
+		episode = cls(**json.loads(wire))
+		episode.wire = bytes(wire)
+		return episode
+
+
+class EpisodeIds(object):
+	"""Episode ids unique across the streams of a node, close to the frame time in microseconds.
+
+	Streams share one store keyed by episode_id, so two streams opening an
+	episode on the same microsecond get consecutive ids instead of one
+	overwriting the other. Every process of the node takes ids from its own
+	residue class, slot of slots, so inference processes don't collide.
+	"""
+
+	def __init__(self, slot=0, slots=1):
+		self.slot = slot
+		self.slots = slots
+		self.last = -1
+		self.lock = threading.Lock()
+
+	def next(self, utc_ns):
+		with self.lock:
+			base = max(int(utc_ns) // 1000, self.last + 1)
+			self.last = base + (self.slot - base) % self.slots
+			return self.last
+
+
+def cursor_key(after):
+	"""(updated_at, episode_id) key after which a query starts, from such a key or an updated_at_gt value"""
+	if isinstance(after, tuple):
+		return after
+	return (after, math.inf)
+
+
+class EpisodeStore(object):
+	"""Bounded ring of episodes ordered by (updated_at, episode_id).
+
+	Captures commit episodes with append()/update(), the HTTP server reads them
+	with query()/wait_query() (since()/wait_since() without paging or filters).
+	Waiting pollers are parked on a condition variable and woken as soon as a
+	commit happens, so there is no sleep/rescan loop. The episode_id in the
+	key breaks ties of episodes updated in the same millisecond, so a page
+	that ends inside such a group continues right after its last episode.
+
+	One instance is shared by all captures and the HTTP server, every method
+	takes the store lock. Queries reaching into the journal read it with the
+	lock released, so disk reads don't hold up commits. Readers get lists of committed episodes, which stay
+	valid while the store keeps changing: update() replaces an episode with
+	a copy instead of changing it.
+
+	Sorted key lists per media and per episode_type serve filtered queries
+	without scanning other streams' episodes.
+	"""
+	INDEXED = ('media', 'episode_type')
+
+	def __init__(self, limit=1000, journal=None):
+		self.limit = limit
+		self._cond = threading.Condition()
+		# Parallel lists sorted by (updated_at, episode_id). Evicted and
+		# superseded entries are set to None and compacted away in bulk, so
+		# neither eviction nor update shifts the lists on every commit. _head
+		# is the first entry that is not evicted.
+		self._keys = []
+		self._episodes = []
+		self._head = 0
+		# episode_id -> episode, for live episodes only
+		self._by_id = {}
+		# field -> value -> sorted keys of live episodes
+		self._indexes = {field: {} for field in self.INDEXED}
+		# With a journal, queries from a cursor below the largest key
+		# (updated_at, episode_id) that is no longer in memory are served from
+		# disk
+		self.journal = journal
+		self._evicted_max_key = (0, 0)
+		# Commits so far, tells a waiter that one came while it read the journal
+		self._commits = 0
+		self._listeners = []
+		if journal is not None:
+			episodes, self._evicted_max_key = journal.tail(limit)
+			for episode in episodes:
+				self._insert(episode)
+
+	def __len__(self):
+		with self._cond:
+			return len(self._by_id)
+
+	def __iter__(self):
+		return iter(self.snapshot())
+
+	def __contains__(self, episode_id):
+		with self._cond:
+			return episode_id in self._by_id
+
+	def get(self, episode_id):
+		with self._cond:
+			return self._by_id.get(episode_id)
+
+	def add_listener(self, callback):
+		"""callback() is called on every commit, under the store lock, so it must be quick"""
+		with self._cond:
+			self._listeners.append(callback)
+
+	def snapshot(self):
+		with self._cond:
+			return [ep for ep in self._episodes[self._head:] if ep is not None]
+
+	def append(self, episode):
+		episode.encode()
+		with self._cond:
+			if episode.episode_id in self._by_id:
+				self._remove(self._by_id[episode.episode_id])
+			if self.journal is not None:
+				self.journal.append(episode)
+			self._insert(episode)
+			self._evict()
+			self._notify()
+
+	def update(self, episode_id, **kwargs):
+		"""Commit a changed copy of the episode with episode_id, returns it or None"""
+		with self._cond:
+			old = self._by_id.get(episode_id)
+			if old is None:
+				return None
+			# Episodes already handed out to readers stay as they were
+			ep = old.replace(**kwargs)
+			ep.encode()
+			self._remove(old)
+			if self.journal is not None:
+				self.journal.append(ep)
+			self._insert(ep)
+			self._compact()
+			self._notify()
+			return ep
+
+	def since(self, updated_at_gt):
+		"""Episodes with updated_at > updated_at_gt, oldest first"""
+		return self.query(updated_at_gt)[0]
+
+	def wait_since(self, updated_at_gt, timeout):
+		"""Like since(), but blocks up to timeout seconds until something matches"""
+		return self.wait_query(timeout, updated_at_gt)[0]
+
+	def query(self, after=0, limit=None, media=None, episode_type=None):
+		"""(episodes, estimated_count): a page after a cursor, oldest first.
+
+		after is an updated_at_gt value or the (updated_at, episode_id) key of
+		the last episode of the previous page. estimated_count is the number
+		of matching episodes after the cursor, page included, it may count
+		superseded entries.
+		"""
+		with self._cond:
+			return self._locked_query(cursor_key(after), limit, media, episode_type)
+
+	def query_memory(self, after=0, limit=None, media=None, episode_type=None):
+		"""query() when it is served from memory, None when it has to read the journal.
+
+		The store lock is never held during journal reads, so this only
+		waits for commits and other in-memory queries, an event loop can
+		call it.
+		"""
+		after = cursor_key(after)
+		with self._cond:
+			if self.journal is not None and after < self._evicted_max_key:
+				return None
+			return self._query(after, limit, media, episode_type)
+
+	def wait_query(self, timeout, after=0, limit=None, media=None, episode_type=None):
+		"""Like query(), but blocks up to timeout seconds until something matches"""
+		after = cursor_key(after)
+		deadline = time.monotonic() + timeout
+		with self._cond:
+			while True:
+				commits = self._commits
+				episodes, count = self._locked_query(after, limit, media, episode_type)
+				if episodes:
+					return episodes, count
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return episodes, count
+				# A commit made while the journal was read isn't waited for
+				if commits == self._commits:
+					self._cond.wait(remaining)
+
+	def _notify(self):
+		self._commits += 1
+		self._cond.notify_all()
+		for callback in self._listeners:
+			callback()
+
+	def _locked_query(self, after, limit=None, media=None, episode_type=None):
+		"""_query() or a journal query, called with the store lock held, released while the journal is read"""
+		if self.journal is None or after >= self._evicted_max_key:
+			return self._query(after, limit, media, episode_type)
+		self._cond.release()
+		try:
+			match = None
+			if media is not None or episode_type is not None:
+				match = lambda ep: (media is None or ep.media == media) and (episode_type is None or ep.episode_type == episode_type)
+			return self.journal.query(after, limit, match)
+		finally:
+			self._cond.acquire()
+
+	def _query(self, after, limit=None, media=None, episode_type=None):
+		"""Page of the episodes in memory, with the store lock held"""
+		filters = [(field, value) for field, value in (('media', media), ('episode_type', episode_type)) if value is not None]
+		episodes = []
+		if not filters:
+			i = bisect.bisect_right(self._keys, after, lo=self._head)
+			for ep in self._episodes[i:]:
+				if limit is not None and len(episodes) >= limit:
+					break
+				if ep is not None:
+					episodes.append(ep)
+			return episodes, len(self._keys) - i
+
+		# Walk the shortest index, check the other filters per episode
+		keys, field, value = min(((self._indexes[f].get(v, ()), f, v) for f, v in filters), key=lambda t: len(t[0]))
+		others = [(f, v) for f, v in filters if f != field]
+		i = bisect.bisect_right(keys, after)
+		for j in range(i, len(keys)):
+			if limit is not None and len(episodes) >= limit:
+				break
+			ep = self._by_id[keys[j][1]]
+			if all(getattr(ep, f) == v for f, v in others):
+				episodes.append(ep)
+		return episodes, len(keys) - i
+
+	def _insert(self, episode):
+		# Episodes mostly arrive in updated_at order, so this is usually an append
+		key = (episode.updated_at, episode.episode_id)
+		i = bisect.bisect_right(self._keys, key, lo=self._head)
+		self._keys.insert(i, key)
+		self._episodes.insert(i, episode)
+		self._by_id[episode.episode_id] = episode
+		for field in self.INDEXED:
+			bisect.insort(self._indexes[field].setdefault(getattr(episode, field), []), key)
+
+	def _remove(self, episode):
+		"""Leave a hole where episode is, its key stays for bisect"""
+		key = (episode.updated_at, episode.episode_id)
+		i = bisect.bisect_left(self._keys, key, lo=self._head)
+		while self._episodes[i] is not episode:
+			i += 1
+		self._episodes[i] = None
+		self._forget(episode, key)
+
+	def _forget(self, episode, key):
+		del self._by_id[episode.episode_id]
+		for field in self.INDEXED:
+			index = self._indexes[field]
+			value = getattr(episode, field)
+			keys = index[value]
+			del keys[bisect.bisect_left(keys, key)]
+			if not keys:
+				del index[value]
+
+	def _evict(self):
+		excess = len(self._by_id) - self.limit
+		i = self._head
+		while excess > 0:
+			ep = self._episodes[i]
+			if ep is not None:
+				self._evicted_max_key = max(self._evicted_max_key, self._keys[i])
+				self._episodes[i] = None
+				self._forget(ep, self._keys[i])
+				excess -= 1
+			i += 1
+		self._head = i
+		self._compact()
+
+	def _compact(self):
+		if len(self._episodes) <= 2 * self.limit + 16:
+			return
+		live = [i for i in range(self._head, len(self._episodes)) if self._episodes[i] is not None]
+		self._keys = [self._keys[i] for i in live]
+		self._episodes = [self._episodes[i] for i in live]
+		self._head = 0
@@ -1,20 +1,34 @@
 from http.server import BaseHTTPRequestHandler
 from http.server import ThreadingHTTPServer
+import asyncio
+import base64
+import http
 import json
 from urllib.parse import urlparse, parse_qs
-from datetime import datetime
 import time
+import zlib
+
+from metrics import OpenMetricsWriter, render_openmetrics
 
 class HttpGetHandler(BaseHTTPRequestHandler):
 	API_PREFIX = "/vision/api/v3"
+	# HTTP/1.1 for chunked episode responses and keep-alive, so every
+	# response carries Content-Length or is chunked
+	protocol_version = "HTTP/1.1"
+	# Episode responses are streamed in chunks of about this size
+	CHUNK_SIZE = 64 * 1024
+	# Episodes per /episodes response, also the default limit of cursor requests
+	MAX_PAGE_SIZE = 1000
+	# Seconds clients may reuse a preview before revalidating it by ETag
+	PREVIEW_MAX_AGE = 60
+	snapshots = None
 
 	def do_GET(self):
 		parsed_path = urlparse(self.path)
 		path = parsed_path.path
 
 		if not path.startswith(self.API_PREFIX):
-			self.send_response(404)
-			self.end_headers()
+			self.send_not_found()
 			return
 
 		# Remove prefix to get the actual endpoint
@@ -26,95 +40,435 @@ class HttpGetHandler(BaseHTTPRequestHandler):
 			self.handle_streams()
 		elif endpoint == "/monitoring/liveness":
 			self.handle_liveness()
+		elif endpoint == "/monitoring/dispatcher":
+			self.handle_dispatcher()
+		elif endpoint == "/monitoring/metrics":
+			self.handle_metrics()
+		elif endpoint.startswith("/episodes/") and endpoint.endswith("/preview"):
+			self.handle_preview(endpoint)
 		else:
-			self.send_response(404)
-			self.end_headers()
+			self.send_not_found()
 
-	def handle_episodes(self, parsed_path):
-		query = parse_qs(parsed_path.query)
+	def send_not_found(self):
+		self.send_response(404)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
 
+	def send_json(self, response_data):
+		self.send_body((json.dumps(response_data)+"\n").encode())
+
+	def send_body(self, body, content_type="application/json"):
 		self.send_response(200)
-		self.send_header("Content-type", "application/json")
+		self.send_header("Content-type", content_type)
+		self.send_header("Content-Length", str(len(body)))
 		self.end_headers()
+		self.wfile.write(body)
+
+	def handle_episodes(self, parsed_path):
+		try:
+			poll_timeout, query = self.parse_episodes_query(parse_qs(parsed_path.query))
+		except ValueError:
+			self.send_response(400)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+
+		if poll_timeout:
+			# Parked on the store's condition variable until a commit or timeout
+			episodes, count = HttpGetHandler.episodes.wait_query(poll_timeout, **query)
+		else:
+			episodes, count = self.get_episodes(query)
+		
+		self.stream_episodes(episodes, count)
+
+	@classmethod
+	def parse_episodes_query(cls, query):
+		"""(poll_timeout, EpisodeStore.query() arguments), ValueError when malformed"""
 		poll_timeout = None
 		if 'poll_timeout' in query and query['poll_timeout']:
 			poll_timeout = int(query['poll_timeout'][0])
 
-		updated_at_gt = 0
+		after = 0
 		if 'updated_at_gt' in query and query['updated_at_gt']:
-			updated_at_gt = int(query['updated_at_gt'][0])
-		t1 = datetime.now()
+			after = int(query['updated_at_gt'][0])
+		# A cursor wins over updated_at_gt
+		if query.get('cursor'):
+			after = cls.decode_cursor(query['cursor'][0])
+		# Pollers of updated_at_gt alone get everything after it: a page
+		# ending inside a millisecond would make them skip the rest of it
+		limit = None
+		if query.get('cursor'):
+			limit = cls.MAX_PAGE_SIZE
+		if query.get('limit'):
+			limit = max(1, min(int(query['limit'][0]), cls.MAX_PAGE_SIZE))
+		args = {'after': after, 'limit': limit}
+		for field in ('media', 'episode_type'):
+			if query.get(field):
+				args[field] = query[field][0]
+		return poll_timeout, args
 
-		episodes = []
-		if poll_timeout:
-			while True:
-				episodes = self.get_episodes(updated_at_gt)
-				t2 = datetime.now()
-				if (t2-t1).seconds >= poll_timeout:
-					break
-				if len(episodes) > 0:
-					break
-				time.sleep(1)
-		else:
-			episodes = self.get_episodes(updated_at_gt)
-		
-		# episodes_list schema: collection_response + episodes array
-		response_data = {
-			'estimated_count': len(episodes),
-			'episodes': episodes
-		}
-		response = json.dumps(response_data, default=vars)+"\n"
-		self.wfile.write(response.encode())
+	@staticmethod
+	def encode_cursor(episode):
+		"""Opaque cursor of the position right after episode"""
+		return base64.urlsafe_b64encode(b'%d:%d' % (episode.updated_at, episode.episode_id)).rstrip(b'=').decode()
 
-	def handle_streams(self):
+	@staticmethod
+	def decode_cursor(cursor):
+		raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+		updated_at, episode_id = raw.split(b':')
+		return int(updated_at), int(episode_id)
+
+	def stream_episodes(self, episodes, estimated_count=None):
+		"""Send episodes_list from the cached wire fragments with chunked encoding.
+
+		HTTP/1.0 clients can't parse chunks, they get the whole body with a
+		Content-Length.
+		"""
+		compressor = None
+		gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+		if self.request_version == 'HTTP/1.0':
+			body = self.episodes_body(episodes, estimated_count, gzip)
+			self.send_response(200)
+			self.send_header("Content-type", "application/json")
+			if gzip:
+				self.send_header("Content-Encoding", "gzip")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+			return
 		self.send_response(200)
 		self.send_header("Content-type", "application/json")
+		self.send_header("Transfer-Encoding", "chunked")
+		if gzip:
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+			self.send_header("Content-Encoding", "gzip")
 		self.end_headers()
-		
+		for chunk in self.episodes_chunks(episodes, estimated_count):
+			self.wfile.write(self.encode_chunk(chunk, compressor))
+		if compressor:
+			self.wfile.write(self.encode_chunk(compressor.flush()))
+		self.wfile.write(b'0\r\n\r\n')
+
+	@classmethod
+	def episodes_chunks(cls, episodes, estimated_count=None):
+		"""episodes_list body in pieces of about CHUNK_SIZE bytes"""
+		# episodes_list schema: collection_response + episodes array. The
+		# cursor of the next page is left out of an empty one, clients keep
+		# theirs
+		head = b'{"estimated_count":%d,' % (len(episodes) if estimated_count is None else estimated_count)
+		if episodes:
+			head += b'"next_cursor":"%s",' % cls.encode_cursor(episodes[-1]).encode()
+		pieces = [head + b'"episodes":[']
+		size = len(pieces[0])
+		for i, episode in enumerate(episodes):
+			if i:
+				pieces.append(b',')
+			pieces.append(episode.wire)
+			size += len(episode.wire) + 1
+			if size >= cls.CHUNK_SIZE:
+				yield b''.join(pieces)
+				pieces, size = [], 0
+		pieces.append(b']}\n')
+		yield b''.join(pieces)
+
+	@classmethod
+	def episodes_body(cls, episodes, estimated_count=None, gzip=False):
+		"""Whole episodes_list body, for responses with a Content-Length"""
+		body = b''.join(cls.episodes_chunks(episodes, estimated_count))
+		if gzip:
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+			body = compressor.compress(body) + compressor.flush()
+		return body
+
+	@staticmethod
+	def encode_chunk(data, compressor=None):
+		if compressor:
+			data = compressor.compress(data)
+		if not data:
+			return b''
+		return b'%x\r\n%s\r\n' % (len(data), data)
+
+	def handle_streams(self):
+		self.send_json(self.streams_data())
+
+	@classmethod
+	def streams_data(cls):
 		streams = []
-		if HttpGetHandler.manager:
-			for stream in HttpGetHandler.manager.streams:
+		if cls.manager:
+			for stream in cls.manager.streams:
 				if not stream.to_delete:
 					# stream_config schema: at minimum requires 'name'
-					streams.append({
+					entry = {
 						'name': stream.name
-					})
+					}
+					# Cores of process() and admission state, for rebalancing across nodes
+					entry['admission'] = stream.admission
+					entry['analytics'] = cls.manager.analytics.analytics(stream)
+					entry['load'] = round(stream.load, 4)
+					if stream.capture:
+						entry['analysis_fps'] = stream.capture.analysis_fps
+						# connecting, playing, stalled or stopped
+						entry['state'] = stream.capture.state
+						entry['stats'] = stream.capture.stats()
+					streams.append(entry)
 		
 		# streams_list schema: collection_response + openmetrics_labels + streams array
-		response_data = {
+		data = {
 			'estimated_count': len(streams),
 			'streams': streams
 		}
-		response = json.dumps(response_data)+"\n"
-		self.wfile.write(response.encode())
+		if cls.manager:
+			data['cpu'] = cls.manager.admission.stats()
+			data['analytics'] = cls.manager.analytics.stats()
+		return data
 
 	def handle_liveness(self):
-		self.send_response(200)
-		self.send_header("Content-type", "application/json")
-		self.end_headers()
-		
+		self.send_json(self.liveness_data())
+
+	@classmethod
+	def liveness_data(cls):
 		# vision_server_info schema
 		now_ms = int(time.time() * 1000)
-		started_at = HttpGetHandler.started_at  # already in seconds (utc)
+		started_at = cls.started_at  # already in seconds (utc)
 		
-		response_data = {
-			'server_version': HttpGetHandler.server_version,
-			'build': HttpGetHandler.build,
+		return {
+			'server_version': cls.server_version,
+			'build': cls.build,
 			'now': now_ms,
 			'started_at': started_at
 		}
-		
-		response = json.dumps(response_data)+"\n"
-		self.wfile.write(response.encode())
 
-	def get_episodes(self, updated_at_gt):
-		return [e for e in HttpGetHandler.episodes if e.updated_at > updated_at_gt]
+	def handle_dispatcher(self):
+		self.send_json(self.dispatcher_data())
+
+	@classmethod
+	def dispatcher_data(cls):
+		# Frame dispatcher internals: workers, per batch size latency/throughput
+		if cls.dispatcher:
+			return cls.dispatcher.stats()
+		return {}
+
+	def handle_metrics(self):
+		self.send_body(self.metrics_data(), OpenMetricsWriter.CONTENT_TYPE)
+
+	@classmethod
+	def metrics_data(cls):
+		# Per-stream hot path timings and counters for Prometheus
+		captures = []
+		if cls.manager:
+			captures = [stream.capture for stream in cls.manager.streams if stream.capture and not stream.to_delete]
+		return render_openmetrics(captures, cls.episodes, cls.snapshots)
+
+	def handle_preview(self, endpoint):
+		status, body, headers = self.preview_data(endpoint, self.headers.get('If-None-Match'))
+		if status == 404:
+			self.send_not_found()
+			return
+		self.send_response(status)
+		for name, value in headers:
+			self.send_header(name, value)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	@classmethod
+	def preview_data(cls, endpoint, if_none_match=None):
+		"""(status, body, headers) of /episodes/{id}/preview, the JPEG snapshot of an episode"""
+		parts = endpoint.split('/')
+		if cls.snapshots is None or len(parts) != 4:
+			return 404, b'', []
+		try:
+			found = cls.snapshots.get(int(parts[2]))
+		except ValueError:
+			found = None
+		if found is None:
+			return 404, b'', []
+		jpeg, etag = found
+		headers = [("ETag", etag), ("Cache-Control", f"private, max-age={cls.PREVIEW_MAX_AGE}")]
+		if if_none_match == etag:
+			return 304, b'', headers
+		return 200, jpeg, [("Content-type", "image/jpeg")] + headers
+
+	def get_episodes(self, query):
+		return HttpGetHandler.episodes.query(**query)
+
+
+class AsyncHTTPServer(object):
+	"""asyncio HTTP/1.1 server for the endpoints of HttpGetHandler.
+
+	Drop-in for ThreadingHTTPServer: run_http(..., server_class=AsyncHTTPServer).
+	Connections are keep-alive and cost a coroutine instead of a thread.
+	Waiting /episodes polls are parked on a future that is resolved from the
+	episode store on every commit. Response bodies come from the same
+	handler_class builders as the threaded server.
+	"""
+
+	def __init__(self, server_address, handler_class):
+		self.server_address = server_address
+		self.handler = handler_class
+		self._loop = None
+		self._server = None
+		self._commit = None
+
+	def serve_forever(self):
+		asyncio.run(self._serve())
+
+	def server_close(self):
+		if self._loop and self._server:
+			self._loop.call_soon_threadsafe(self._server.close)
+
+	async def _serve(self):
+		self._loop = asyncio.get_running_loop()
+		self._commit = self._loop.create_future()
+		self.handler.episodes.add_listener(self._on_commit)
+		host, port = self.server_address
+		self._server = await asyncio.start_server(self._connection, host or None, port, backlog=4096)
+		async with self._server:
+			await self._server.serve_forever()
+
+	def _on_commit(self):
+		# Called by the episode store from capture threads
+		self._loop.call_soon_threadsafe(self._wake)
+
+	def _wake(self):
+		commit, self._commit = self._commit, self._loop.create_future()
+		commit.set_result(None)
+
+	async def _connection(self, reader, writer):
+		try:
+			while True:
+				try:
+					head = await reader.readuntil(b'\r\n\r\n')
+				except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+					break
+				lines = head.decode('latin-1').split('\r\n')
+				try:
+					method, target, version = lines[0].split(' ', 2)
+				except ValueError:
+					self._respond(writer, 400, close=True)
+					break
+				headers = {}
+				for line in lines[1:]:
+					if ':' in line:
+						k, v = line.split(':', 1)
+						headers[k.strip().lower()] = v.strip()
+				length = int(headers.get('content-length') or 0)
+				if length:
+					await reader.readexactly(length)
+				connection = headers.get('connection', '').lower()
+				keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+				await self._request(method, target, headers, writer, keep_alive, version)
+				await writer.drain()
+				if not keep_alive:
+					break
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except Exception as e:
+			print(f"[EpisodesServer] Error in connection: {type(e).__name__}: {e}")
+		finally:
+			writer.close()
+
+	def _write_head(self, writer, status, headers, close):
+		lines = [f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}"] + headers
+		if close:
+			lines.append("Connection: close")
+		writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+	def _respond(self, writer, status, body=b'', close=False, content_type="application/json"):
+		headers = [f"Content-Length: {len(body)}"]
+		if body:
+			headers.insert(0, f"Content-type: {content_type}")
+		self._write_head(writer, status, headers, close)
+		writer.write(body)
+
+	async def _request(self, method, target, headers, writer, keep_alive, version='HTTP/1.1'):
+		close = not keep_alive
+		if method != 'GET':
+			self._respond(writer, 501, close=close)
+			return
+		parsed_path = urlparse(target)
+		path = parsed_path.path
+		if not path.startswith(self.handler.API_PREFIX):
+			self._respond(writer, 404, close=close)
+			return
+		endpoint = path[len(self.handler.API_PREFIX):]
+
+		if endpoint == "/episodes":
+			try:
+				poll_timeout, query = self.handler.parse_episodes_query(parse_qs(parsed_path.query))
+			except ValueError:
+				self._respond(writer, 400, close=close)
+				return
+			episodes, count = await self._wait_episodes(query, poll_timeout)
+			gzip = 'gzip' in headers.get('accept-encoding', '')
+			if version == 'HTTP/1.0':
+				# No chunked encoding before HTTP/1.1
+				body = self.handler.episodes_body(episodes, count, gzip)
+				head = ["Content-type: application/json", f"Content-Length: {len(body)}"]
+				if gzip:
+					head.append("Content-Encoding: gzip")
+				self._write_head(writer, 200, head, close)
+				writer.write(body)
+				return
+			compressor = None
+			head = ["Content-type: application/json", "Transfer-Encoding: chunked"]
+			if gzip:
+				compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+				head.append("Content-Encoding: gzip")
+			self._write_head(writer, 200, head, close)
+			for chunk in self.handler.episodes_chunks(episodes, count):
+				writer.write(self.handler.encode_chunk(chunk, compressor))
+				await writer.drain()
+			if compressor:
+				writer.write(self.handler.encode_chunk(compressor.flush()))
+			writer.write(b'0\r\n\r\n')
+			return
+
+		if endpoint == "/streams":
+			response_data = self.handler.streams_data()
+		elif endpoint == "/monitoring/liveness":
+			response_data = self.handler.liveness_data()
+		elif endpoint == "/monitoring/dispatcher":
+			response_data = self.handler.dispatcher_data()
+		elif endpoint == "/monitoring/metrics":
+			self._respond(writer, 200, self.handler.metrics_data(), close=close, content_type=OpenMetricsWriter.CONTENT_TYPE)
+			return
+		elif endpoint.startswith("/episodes/") and endpoint.endswith("/preview"):
+			status, body, head = self.handler.preview_data(endpoint, headers.get('if-none-match'))
+			head = [f"{name}: {value}" for name, value in head] + [f"Content-Length: {len(body)}"]
+			self._write_head(writer, status, head, close)
+			writer.write(body)
+			return
+		else:
+			self._respond(writer, 404, close=close)
+			return
+		self._respond(writer, 200, (json.dumps(response_data)+"\n").encode(), close=close)
 
+	async def _wait_episodes(self, query, poll_timeout):
+		deadline = self._loop.time() + (poll_timeout or 0)
+		while True:
+			# Take the future before querying, so a commit in between isn't missed
+			commit = self._commit
+			store = self.handler.episodes
+			result = store.query_memory(**query)
+			if result is None:
+				# Reading the journal would block the event loop for all connections
+				result = await self._loop.run_in_executor(None, lambda: store.query(**query))
+			episodes, count = result
+			remaining = deadline - self._loop.time()
+			if episodes or remaining <= 0:
+				return episodes, count
+			try:
+				await asyncio.wait_for(asyncio.shield(commit), remaining)
+			except asyncio.TimeoutError:
+				pass
 
 
-def run_http(episodes, port, manager=None, server_version="1.0.0", build=1, server_class=ThreadingHTTPServer, handler_class=HttpGetHandler):
+def run_http(episodes, port, manager=None, server_version="1.0.0", build=1, server_class=ThreadingHTTPServer, handler_class=HttpGetHandler, dispatcher=None, snapshots=None):
 	HttpGetHandler.episodes = episodes
+	HttpGetHandler.snapshots = snapshots
 	HttpGetHandler.manager = manager
+	HttpGetHandler.dispatcher = dispatcher
 	HttpGetHandler.server_version = server_version
 	HttpGetHandler.build = build
 	HttpGetHandler.started_at = int(time.time())
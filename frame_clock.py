@@ -0,0 +1,91 @@
+import collections
+import datetime as dt
+
+# Seconds from the NTP epoch (1900) to the Unix epoch (1970)
+NTP_EPOCH_DELTA = 2208988800
+NTP_EPOCH_DELTA_NS = NTP_EPOCH_DELTA * 10**9
+
+
+def ntp_to_utc_ns(ntp_ns):
+	"""Unix nanoseconds of an NTP timestamp in nanoseconds, exact in integers"""
+	return int(ntp_ns) - NTP_EPOCH_DELTA_NS
+
+
+def utc_datetime(utc_ns):
+	"""Aware datetime of Unix nanoseconds, only build it where it is printed or serialized"""
+	utc_ns = int(utc_ns)
+	return dt.datetime.fromtimestamp(utc_ns // 10**9, tz=dt.timezone.utc).replace(microsecond=utc_ns % 10**9 // 1000)
+
+
+class FrameClock(object):
+	"""Per-stream mapping of buffer PTS to UTC.
+
+	rtspsrc attaches the NTP reference timestamp only once the camera has sent
+	an RTCP sender report, and some cameras leave it out now and then. Frames
+	with it are samples of a least squares line utc = base_utc + rate *
+	(pts - base_pts) over the last window of them, frames without it get
+	their time from the line. Times stay integer nanoseconds, the fit works
+	on offsets from the latest sample, which float64 holds exactly.
+
+	The fit is only computed when a frame without reference timestamp asks
+	for it. A sample more than max_residual seconds off the line (the camera
+	clock stepped) starts it over, reset() does for a new pipeline.
+	"""
+
+	def __init__(self, window=64, max_residual=0.5):
+		self.samples = collections.deque(maxlen=window)
+		self.max_residual_ns = int(max_residual * 1e9)
+		self.base_pts = None
+		self.base_utc = None
+		self.rate = 1.0
+		self._fitted = False
+		self.exact = 0
+		self.interpolated = 0
+		self.resets = 0
+
+	def reset(self):
+		self.samples.clear()
+		self.base_pts = self.base_utc = None
+		self.rate = 1.0
+		self._fitted = False
+
+	def observe(self, pts, utc_ns):
+		"""Record a frame that carries a reference timestamp"""
+		self.exact += 1
+		if self.samples:
+			last_pts, last_utc = self.samples[-1]
+			if abs(last_utc + self.rate * (pts - last_pts) - utc_ns) > self.max_residual_ns:
+				self.reset()
+				self.resets += 1
+		self.samples.append((pts, utc_ns))
+		self._fitted = False
+
+	def utc_ns(self, pts):
+		"""UTC of a frame without reference timestamp, None before the first frame with one"""
+		if not self.samples:
+			return None
+		if not self._fitted:
+			self._fit()
+		self.interpolated += 1
+		return self.base_utc + int(round(self.rate * (pts - self.base_pts)))
+
+	def _fit(self):
+		# Loaded with GStreamer by the time frames arrive, not on import
+		import numpy as np
+		samples = np.array(self.samples, dtype=np.int64)
+		base_pts, base_utc = samples[-1]
+		x = (samples[:, 0] - base_pts).astype(np.float64)
+		y = (samples[:, 1] - base_utc).astype(np.float64)
+		rate, intercept = 1.0, 0.0
+		xm = x.mean()
+		var = np.square(x - xm).sum()
+		if var > 0:
+			slope = float(((x - xm) * (y - y.mean())).sum() / var)
+			# Camera and pipeline clocks differ by ppm, anything else is noise
+			if 0.9 < slope < 1.1:
+				rate = slope
+				intercept = float(y.mean() - rate * xm)
+		self.rate = rate
+		self.base_pts = int(base_pts)
+		self.base_utc = int(base_utc) + int(round(intercept))
+		self._fitted = True
@@ -1,134 +1,114 @@
 #!/usr/bin/env python3
 
-from capture import Capture, Episode
-from episodes_server import run_http
+# Only modules that load in milliseconds are imported here: GStreamer, numpy
+# and cv2 are loaded with the first stream, so liveness answers right away
+from capture import Capture
+from episode_journal import EpisodeJournal
+from episode_store import EpisodeStore
+from episodes_server import AsyncHTTPServer, run_http
 import threading
-import cv2
-import datetime as dt
+import json
 import os
 
+from batching import BatchScheduler
 from manager import Manager
+from snapshots import SnapshotStore
 
-detector = cv2.QRCodeDetector()
-qr_codes = {}
-
-
-class QrRecognizer(Capture):
-	def __init__(self, spec):
-		super().__init__(spec)
-		self.started = False
-		# Track active QR codes: {qr_data: {'opened_at': timestamp_ms, 'first_seen_at': timestamp_ms}}
-		# Episodes are created only when QR code disappears
-		self.active_qr_codes = {}
-
-	def preprocess_image(self, image):
-		"""Preprocess image to improve QR code detection"""
-		# Convert to grayscale if needed
-		if len(image.shape) == 3:
-			gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-		else:
-			gray = image
-		
-		# Apply adaptive thresholding to improve contrast
-		# This helps with QR codes in varying lighting conditions
-		adaptive = cv2.adaptiveThreshold(
-			gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-			cv2.THRESH_BINARY, 11, 2
-		)
-		
-		return gray, adaptive
-
-	def process(self, image, utc_ns):
-		timestamp = dt.datetime.fromtimestamp(utc_ns/1e9, tz=dt.UTC)
-		if not self.started:
-			print(f"[{self.name}] First frame arrived on {timestamp}, image shape: {image.shape}")
-			self.started = True
-
-		gray, adaptive = self.preprocess_image(image)
-		retval, decoded_info, points, _ = detector.detectAndDecodeMulti(image)
-
-		if hasattr(self, '_qr_check_count'):
-			self._qr_check_count += 1
-		else:
-			self._qr_check_count = 1
-
-		# Log QR detection attempts more frequently for debugging
-		if self._qr_check_count == 1:
-			print(f"[{self.name}] Starting QR code detection, image shape: {image.shape}")
-		elif self._qr_check_count % 30 == 0:
-			print(f"[{self.name}] QR detection attempt #{self._qr_check_count}, retval={retval}, decoded_info count={len(decoded_info) if decoded_info else 0}")
-		
-		if not retval or not decoded_info or len(decoded_info) == 0:
-			retval, decoded_info, points, _ = detector.detectAndDecodeMulti(gray)
-
-		if not retval or not decoded_info or len(decoded_info) == 0:
-			retval, decoded_info, points, _ = detector.detectAndDecodeMulti(adaptive)
-
-		current_frame_qr_codes = set()
-		if retval and decoded_info:
-			valid_qr_codes = [qr for qr in decoded_info if qr and qr.strip()]
-			if valid_qr_codes:
-				print(f"[{self.name}] Found {len(valid_qr_codes)} QR code(s): {valid_qr_codes}")
-			for qr_data in valid_qr_codes:
-				current_frame_qr_codes.add(qr_data)
-
-				if qr_data not in self.active_qr_codes:
-					# New QR code detected - track it but don't create episode yet
-					opened_at_ms = int(utc_ns/1e6)
-					self.active_qr_codes[qr_data] = {
-						'opened_at': opened_at_ms,
-						'first_seen_at': opened_at_ms
-					}
-					qr_codes[qr_data] = (qr_data, timestamp)
-					print(f"[{self.name}] NEW QR CODE DETECTED: {qr_data} at {timestamp}")
-
-		# Check for disappeared QR codes - create episodes when they disappear
-		disappeared_qr_codes = set(self.active_qr_codes.keys()) - current_frame_qr_codes
-		if disappeared_qr_codes:
-			for qr_data in disappeared_qr_codes:
-				qr_info = self.active_qr_codes[qr_data]
-				opened_at_ms = qr_info['opened_at']
-				closed_at_ms = int(utc_ns/1e6)
-				episode_id = int(utc_ns/1e3)
-				
-				# Create episode when QR code disappears
-				episode = Episode(
-					episode_id=episode_id,
-					media=self.name,
-					opened_at=opened_at_ms,
-					started_at=opened_at_ms,  # started_at = opened_at
-					closed_at=closed_at_ms,
-					updated_at=closed_at_ms,
-					episode_type=Episode.QR_CODE,
-					payload={'qr_url': qr_data}
-				)
-				print(f"[{self.name}] QR CODE DISAPPEARED: {qr_data} at {timestamp}, created episode {episode_id} (opened: {opened_at_ms}, closed: {closed_at_ms})")
-				
-				# Remove from active QR codes
-				del self.active_qr_codes[qr_data]
-				
-				return episode
-
-		return None
 
 class MyManager(Manager):
 	def __init__(self, url):
 		super().__init__(url)
-
-	def launch(self, spec):
-		return QrRecognizer(spec)
-
-
-print("[Main] Starting inference node...")
-config_external = os.environ.get('CONFIG_EXTERNAL')
-if not config_external:
-	print("[Main] ERROR: CONFIG_EXTERNAL environment variable is not set!")
-	exit(1)
-print(f"[Main] CONFIG_EXTERNAL: {config_external}")
-
-manager = MyManager(config_external)
-print("[Main] Manager created, starting manager thread...")
-t1 = threading.Thread(target=manager.run, args=())
-t1.start()
-print("[Main] Manager thread started, starting HTTP server on port 8020...")
-run_http(Capture.episodes, 8020, manager=manager)
+		# Streams select their Capture class with "analytics", QR codes by default
+		self.analytics.register('qr_code', 'qr_recognizer:QrRecognizer')
+		self.analytics.register('qr_code_aruco', 'qr_recognizer:ArucoQrRecognizer')
+		self.analytics.default = 'qr_code'
+
+
+# Inference worker processes re-import this module, so the node itself is
+# only started when it is run as a script
+if __name__ == "__main__":
+	print("[Main] Starting inference node...")
+	config_external = os.environ.get('CONFIG_EXTERNAL')
+	# Streams of a scenario file on local sources instead of Central and cameras
+	simulation = os.environ.get('SIMULATION')
+	if not config_external and not simulation:
+		print("[Main] ERROR: CONFIG_EXTERNAL environment variable is not set!")
+		exit(1)
+	print(f"[Main] CONFIG_EXTERNAL: {config_external}" if not simulation else f"[Main] SIMULATION: {simulation}")
+
+	# One store is shared by all captures and the HTTP server
+	journal = None
+	episodes_journal = os.environ.get('EPISODES_JOURNAL')
+	if episodes_journal:
+		# Keep episodes on disk, so a restart doesn't lose what Central hasn't polled yet
+		journal = EpisodeJournal(episodes_journal,
+			max_bytes=int(os.environ.get('EPISODES_JOURNAL_MAX_MB', '1024')) << 20,
+			max_age=float(os.environ.get('EPISODES_JOURNAL_MAX_AGE_HOURS', '168')) * 3600)
+	episodes = EpisodeStore(limit=Capture.episodes_limit, journal=journal)
+	Capture.episodes = episodes
+
+	snapshots_mb = os.environ.get('EPISODE_SNAPSHOTS_MB')
+	if snapshots_mb:
+		# JPEG previews of episodes at /episodes/{id}/preview
+		Capture.snapshots = SnapshotStore(max_bytes=int(snapshots_mb) << 20,
+			workers=int(os.environ.get('EPISODE_SNAPSHOTS_WORKERS', '1')))
+		print(f"[Main] Episode previews: up to {snapshots_mb} MB")
+
+	inference_processes = os.environ.get('INFERENCE_PROCESSES')
+	inference_workers = os.environ.get('INFERENCE_WORKERS')
+	inference_batch = os.environ.get('INFERENCE_BATCH')
+	if inference_batch and inference_processes:
+		# Batches run on threads of this process, one of the two would be silently ignored
+		print("[Main] ERROR: INFERENCE_BATCH and INFERENCE_PROCESSES can't be combined, set one of them")
+		exit(1)
+	if inference_batch:
+		# Frames of all streams are batched into Capture.process_batch() calls
+		Capture.dispatcher = BatchScheduler(
+			max_batch=int(inference_batch),
+			max_wait=float(os.environ.get('INFERENCE_BATCH_WAIT_MS', '20')) / 1000,
+			workers=int(inference_workers or 1))
+		print(f"[Main] Inference batches: up to {Capture.dispatcher.max_batch} frames")
+	elif inference_processes:
+		# Run process() in worker processes, frames go through shared memory
+		from workers import ProcessDispatcher
+		Capture.dispatcher = ProcessDispatcher(processes=int(inference_processes))
+		print(f"[Main] Inference processes: {Capture.dispatcher.processes}")
+	else:
+		if inference_workers:
+			Capture.dispatcher.workers = int(inference_workers)
+		print(f"[Main] Inference workers: {Capture.dispatcher.workers}")
+
+	main_loops = os.environ.get('CAPTURE_MAIN_LOOPS')
+	if main_loops:
+		# Pipelines are driven by a few shared GLib loops instead of a thread each
+		from mainloop import MainLoopPool
+		Capture.main_loops = MainLoopPool(size=int(main_loops))
+		print(f"[Main] Capture main loops: {Capture.main_loops.size}")
+
+	if simulation:
+		from simulation import Scenario, simulated_manager
+		manager = simulated_manager(MyManager, Scenario.load(simulation))
+	else:
+		manager = MyManager(config_external)
+	cpu_budget = os.environ.get('PROCESS_CPU_BUDGET')
+	if cpu_budget:
+		# Cores process() of all streams may use, streams are throttled and rejected beyond
+		manager.admission.budget = float(cpu_budget)
+		print(f"[Main] CPU budget: {manager.admission.budget} cores")
+	print("[Main] Manager created, starting HTTP server on port 8020...")
+	http_kwargs = {}
+	if os.environ.get('EPISODES_SERVER', 'threading') == 'async':
+		http_kwargs['server_class'] = AsyncHTTPServer
+	# The HTTP server comes up first, the manager then loads GStreamer and
+	# the detectors of the streams it launches
+	t1 = threading.Thread(target=run_http, args=(episodes, 8020), name='http', daemon=True,
+		kwargs=dict(manager=manager, dispatcher=Capture.dispatcher, snapshots=Capture.snapshots, **http_kwargs))
+	t1.start()
+	print("[Main] HTTP server thread started, running manager...")
+	# Runs forever, a simulation returns its report at the end of the scenario
+	report = manager.run()
+	simulation_report = os.environ.get('SIMULATION_REPORT')
+	if simulation and simulation_report:
+		with open(simulation_report, 'w') as f:
+			json.dump(report, f, indent=1)
+		print(f"[Main] Simulation report written to {simulation_report}")
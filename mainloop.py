@@ -0,0 +1,84 @@
+import threading
+
+from gi.repository import GLib
+
+
+class MainLoopThread(object):
+	"""A GLib main context of its own and the thread that runs it.
+
+	Bus watches added from callbacks running on the thread attach to its
+	context, call_soon() and call_later() schedule work on it from any thread.
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.context = GLib.MainContext.new()
+		self.loop = GLib.MainLoop.new(self.context, False)
+		self.thread = None
+		# Captures driven by this loop
+		self.captures = 0
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		# bus.add_signal_watch() attaches to the thread default context
+		self.context.push_thread_default()
+		try:
+			self.loop.run()
+		finally:
+			self.context.pop_thread_default()
+
+	def call_soon(self, callback, *args):
+		"""Run callback(*args) once on the loop thread"""
+		return self._attach(GLib.idle_source_new(), callback, args)
+
+	def call_later(self, delay, callback, *args):
+		"""Run callback(*args) on the loop thread after delay seconds and again every delay while it returns True.
+
+		Returns the source, source.destroy() cancels it.
+		"""
+		return self._attach(GLib.timeout_source_new(max(0, int(delay * 1000))), callback, args)
+
+	def _attach(self, source, callback, args):
+		source.set_callback(lambda *_: bool(callback(*args)))
+		source.attach(self.context)
+		return source
+
+	def stop(self):
+		self.loop.quit()
+
+
+class MainLoopPool(object):
+	"""A few main loop threads that drive the pipelines of all captures.
+
+	Set Capture.main_loops to a pool and Capture.start() plays the stream
+	without a thread of its own: building, bus messages, the frame watchdog,
+	reconnect backoff and teardown all run as callbacks on the least busy
+	loop. Frames still come from the appsink callback on the GStreamer
+	streaming thread of the pipeline, which only enqueues them.
+	"""
+
+	def __init__(self, size=1):
+		self.size = size
+		self.loops = []
+		self.lock = threading.Lock()
+
+	def assign(self):
+		"""Least busy loop, the loops are started on first use"""
+		with self.lock:
+			if not self.loops:
+				self.loops = [MainLoopThread(f"mainloop{i}") for i in range(self.size)]
+				for loop in self.loops:
+					loop.start()
+			loop = min(self.loops, key=lambda l: l.captures)
+			loop.captures += 1
+			return loop
+
+	def release(self, loop):
+		with self.lock:
+			loop.captures -= 1
+
+	def stats(self):
+		return [{'name': loop.name, 'captures': loop.captures} for loop in self.loops]
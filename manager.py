@@ -1,15 +1,27 @@
-import threading
+import concurrent.futures
 
-from capture import Capture
+from admission import AdmissionController, AdmissionPolicy
+from detectors import DetectorRegistry
+from metrics import RateLimitedLog
 import time
-import urllib3
 import json
 import hashlib
 from urllib.parse import urlparse, urlunparse, ParseResult
 
 
+class ConfigError(ValueError):
+	"""Central answered /streams with an error or a config that can't be used"""
+
+
+def config_key(config):
+	"""Normalized form of a stream config, equal for configs that only differ in key order"""
+	return json.dumps(config, sort_keys=True, separators=(',', ':'))
+
+
 class Stream(object):
 	def __init__(self, config):
+		self.config = config
+		self.config_key = config_key(config)
 		self.name = config['name']
 		# Extract URL from inputs[*].url structure
 		if 'inputs' in config and len(config['inputs']) > 0:
@@ -22,19 +34,25 @@ class Stream(object):
 		self.thread = None
 		self.capture = None
 		self.to_delete = False
+		self.policy = AdmissionPolicy.from_spec(self)
+		# admitted, throttled, overloaded or rejected (not running), see AdmissionController
+		self.admission = 'admitted'
+		# Cores of process() and analysed fps, measured by AdmissionController
+		self.load = 0.0
+		self.fps = 0.0
+		self.load_sample = None
 	
 	def get_url(self):
 		"""Get the URL for this stream"""
 		return self.url
 	
 	def config_matches(self, config):
-		"""Check if the given config matches this stream's configuration"""
-		config_url = None
-		if 'inputs' in config and len(config['inputs']) > 0:
-			config_url = config['inputs'][0]['url']
-		elif 'url' in config:
-			config_url = config['url']
-		return config_url == self.url
+		"""Check if the given config matches this stream's configuration.
+
+		The whole config is compared, not only the URL: launch() also reads
+		pipeline, sampling, tracking, admission and analytics from it.
+		"""
+		return config_key(config) == self.config_key
 
 
 class Manager(object):
@@ -47,7 +65,20 @@ class Manager(object):
 		print(f"[Manager] Parsed URL: {self.config_external_url}, API token: {'***' if self.api_token else 'None'}")
 		self.streams = []
 		self.last_config_hash = None
-		self.last_status_log_time = time.time()
+		self.etag = None
+		# One pool for the life of the manager, so the connection is kept alive.
+		# Created by the first fetch, urllib3 takes longer to import than the
+		# HTTP server to start
+		self.http = None
+		# Streams started or stopped at the same time on a reconfig
+		self.parallel = 32
+		self.log = RateLimitedLog('Manager', 10.0)
+		# CPU budget of process() over all streams, off until admission.budget is set
+		self.admission = AdmissionController()
+		# Capture class of a stream by the "analytics" field of its config,
+		# plain Capture without one unless a subclass registers a default
+		self.analytics = DetectorRegistry(default='none')
+		self.analytics.register('none', 'capture:Capture')
 
 	def _parse_url(self, url):
 		"""Parse URL and extract API token from user@host format"""
@@ -74,135 +105,191 @@ class Manager(object):
 
 		while True:
 			self.reconfigure()
+			self.rebalance()
 			time.sleep(3)
 
+	def fetch_config(self):
+		"""Fetch /streams, returns (hash, etag, config) or None if unchanged, raises ConfigError if invalid"""
+		headers = {}
+		if self.api_token:
+			headers['Authorization'] = f'Bearer {self.api_token}'
+		# Central answers 304 without a body while the config is the same
+		if self.etag:
+			headers['If-None-Match'] = self.etag
+
+		url = self.config_external_url + "/streams"
+		if self.last_config_hash is None:
+			print(f"[Manager] Fetching config from config_external: {url}")
+
+		if self.http is None:
+			import urllib3
+			self.http = urllib3.PoolManager(num_pools=1, maxsize=1)
+		r = self.http.request('GET', url, headers=headers, timeout=5.0)
+
+		if r.status == 304:
+			return None
+		if r.status != 200:
+			raise ConfigError(f"HTTP {r.status}, response: {r.data.decode('utf-8', errors='ignore')[:200]}")
+
+		# Unchanged body, nothing to parse or reconcile
+		config_hash = hashlib.md5(r.data).hexdigest()
+		if config_hash == self.last_config_hash:
+			return None
+
+		response_text = r.data.decode('utf-8')
+
+		try:
+			config = json.loads(response_text)
+		except json.JSONDecodeError as e:
+			raise ConfigError(f"JSON decode error: {e}, response: {response_text[:500]}")
+
+		if not isinstance(config, dict):
+			raise ConfigError(f"config is {type(config).__name__}, not an object")
+
+		if 'streams' not in config:
+			raise ConfigError(f"'streams' key not found in config. Keys: {list(config.keys())}")
+
+		if not isinstance(config['streams'], list):
+			raise ConfigError(f"'streams' is not a list, type: {type(config['streams'])}")
+
+		# Log config details only when config changes or on first fetch
+		if self.last_config_hash is None:
+			print(f"[Manager] Initial config fetched: {len(config['streams'])} stream(s)")
+		else:
+			print(f"[Manager] Config changed: {len(config['streams'])} stream(s)")
+		print(f"[Manager] Config content: {response_text[:500]}")
+		return config_hash, r.headers.get('ETag'), config
+
 	def reconfigure(self):
 		try:
-			http = urllib3.PoolManager()
-			headers = {}
-			if self.api_token:
-				headers['Authorization'] = f'Bearer {self.api_token}'
-			
-			url = self.config_external_url + "/streams"
-			print(f"[Manager] Fetching config from config_external: {url}")
-			
-			r = http.request('GET', url, headers=headers, timeout=5.0)
-			
-			if r.status != 200:
-				print(f"[Manager] Error: HTTP {r.status}, response: {r.data.decode('utf-8', errors='ignore')[:200]}")
-				return
-			
-			response_text = r.data.decode('utf-8')
-			
 			try:
-				config = json.loads(response_text)
-			except json.JSONDecodeError as e:
-				print(f"[Manager] JSON decode error: {e}, response: {response_text[:500]}")
-				return
-			
-			if config is None:
-				print(f"[Manager] Error: config is None")
-				return
-			
-			if 'streams' not in config:
-				print(f"[Manager] Error: 'streams' key not found in config. Keys: {list(config.keys()) if isinstance(config, dict) else 'not a dict'}")
+				fetched = self.fetch_config()
+			except ConfigError as e:
+				# Streams keep running on the last good config
+				self.log('config_error', reason=e, streams=len(self.streams))
 				return
-			
-			if not isinstance(config['streams'], list):
-				print(f"[Manager] Error: 'streams' is not a list, type: {type(config['streams'])}")
+			if fetched is None:
+				# Log brief status on each successful fetch (but less frequently)
+				self.log('config_ok', streams=len(self.streams))
 				return
-			
-			# Calculate config hash to detect changes
-			config_hash = hashlib.md5(response_text.encode()).hexdigest()
-			
-			# Log config details only when config changes or on first fetch
-			if self.last_config_hash is None:
-				print(f"[Manager] Initial config fetched: {len(config['streams'])} stream(s)")
-				print(f"[Manager] Config content: {response_text[:500]}")
-			elif config_hash != self.last_config_hash:
-				print(f"[Manager] Config changed: {len(config['streams'])} stream(s)")
-				print(f"[Manager] Config content: {response_text[:500]}")
+			config_hash, etag, config = fetched
+			# A stream that failed to launch is retried with the next fetch
+			if self.reconcile(config['streams']):
+				self.last_config_hash = config_hash
+				self.etag = etag
 			else:
-				# Log brief status on each successful fetch (but less frequently)
-				current_time = time.time()
-				if current_time - self.last_status_log_time >= 10.0:
-					active_streams = [s.name for s in self.streams if not s.to_delete]
-					print(f"[Manager] Config OK: {len(config['streams'])} stream(s) in config, {len(active_streams)} active")
-					self.last_status_log_time = current_time
-			
-			self.last_config_hash = config_hash
-			
-			for s in self.streams:
-				s.to_delete = True
-			for n in config['streams']:
-				stream_name = n['name']
-				found_existing = False
-				for o in self.streams:
-					if stream_name == o.name:
-						o.to_delete = False
-						found_existing = True
-						# Check if configuration changed (e.g., URL changed)
-						if not o.config_matches(n):
-							print(f"[Manager] Configuration changed for stream: {stream_name}, restarting...")
-							# Stop old capture
-							if o.capture:
-								try:
-									o.capture.stop()
-								except Exception as e:
-									print(f"[Manager] Error stopping capture for {stream_name}: {e}")
-							# Wait a bit for thread to finish
-							if o.thread and o.thread.is_alive():
-								o.thread.join(timeout=2.0)
-							# Create new capture with new config
-							try:
-								# Update stream URL
-								if 'inputs' in n and len(n['inputs']) > 0:
-									o.url = n['inputs'][0]['url']
-								elif 'url' in n:
-									o.url = n['url']
-								# Launch new capture
-								o.capture = self.launch(o)
-								o.thread = threading.Thread(target=o.capture.run, args=())
-								o.thread.start()
-								print(f"[Manager] Restarted stream: {stream_name} with new configuration")
-							except Exception as e:
-								print(f"[Manager] Error restarting stream {stream_name}: {e}")
-								import traceback
-								traceback.print_exc()
-						break
-				
-				if not found_existing:
-					# New stream - create it
-					try:
-						stream = Stream(n)
-						stream.capture = self.launch(stream)
-						stream.thread = threading.Thread(target=stream.capture.run, args=())
-						self.streams.append(stream)
-						stream.thread.start()
-						print(f"[Manager] Launch new stream: {stream.name}")
-					except Exception as e:
-						print(f"[Manager] Error launching stream {n.get('name', 'unknown')}: {e}")
-						import traceback
-						traceback.print_exc()
-
-			# Remove deleted streams
-			for o in self.streams:
-				if o.to_delete:
-					print(f"[Manager] Delete old stream: {o.name}")
-					if o.capture:
-						try:
-							o.capture.stop()
-						except Exception as e:
-							print(f"[Manager] Error stopping capture for {o.name}: {e}")
-					if o.thread and o.thread.is_alive():
-						o.thread.join(timeout=2.0)
-			self.streams = [o for o in self.streams if not o.to_delete]
+				self.last_config_hash = self.etag = None
 		except Exception as e:
 			print(f"[Manager] Exception in reconfigure: {type(e).__name__}: {e}")
 			import traceback
 			traceback.print_exc()
 
+	def reconcile(self, configs):
+		"""Start, restart and stop streams to match configs, True if all launched"""
+		current = {o.name: o for o in self.streams}
+		wanted = {}
+		for n in configs:
+			wanted[n['name']] = n
+
+		to_stop = []
+		for name, o in current.items():
+			if name not in wanted:
+				print(f"[Manager] Delete old stream: {name}")
+				to_stop.append(o)
+		to_start = []
+		for name, n in wanted.items():
+			o = current.get(name)
+			if o is None:
+				to_start.append((None, n))
+			elif not o.config_matches(n):
+				# Check if configuration changed (URL, pipeline, analytics, ...)
+				print(f"[Manager] Configuration changed for stream: {name}, restarting...")
+				to_stop.append(o)
+				to_start.append((o, n))
+
+		# Streams admitted last time are measured by now
+		self.admission.pending = 0.0
+		# Stops wait for their capture thread, so a big reconfig runs them side by side
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as pool:
+			list(pool.map(self._stop_stream, to_stop))
+			started = list(pool.map(lambda item: self._start_stream(*item), to_start))
+
+		streams = {o.name: o for o in self.streams if o.name in wanted}
+		for (o, n), stream in zip(to_start, started):
+			if stream is not None:
+				streams[stream.name] = stream
+			elif o is not None:
+				# Stopped and failed to restart, launched as a new stream next time
+				del streams[o.name]
+		# Keep config order, the list is read by the HTTP server without a lock
+		self.streams = [streams[name] for name in wanted if name in streams]
+		return all(stream is not None for stream in started)
+
+	def _stop_stream(self, o):
+		if o.capture:
+			try:
+				o.capture.stop()
+			except Exception as e:
+				print(f"[Manager] Error stopping capture for {o.name}: {e}")
+		# Wait a bit for the pipeline to stop
+		if o.capture:
+			o.capture.join(timeout=2.0)
+
+	def rebalance(self):
+		"""Fit running streams to the CPU budget, start rejected ones that fit now"""
+		try:
+			self.admission.update(self.streams)
+			rejected = [s for s in self.streams if s.admission == 'rejected']
+			for stream in sorted(rejected, key=lambda s: -s.policy.priority):
+				if not self.admission.admit(stream, self.streams):
+					break
+				self._launch(stream)
+				print(f"[Manager] Admitted stream: {stream.name}")
+			self.admission.pending = 0.0
+		except Exception as e:
+			print(f"[Manager] Exception in rebalance: {type(e).__name__}: {e}")
+
+	def _launch(self, stream):
+		stream.capture = self.launch(stream)
+		stream.admission = 'admitted'
+		stream.load_sample = None
+		# A thread per stream, or none on Capture.main_loops
+		stream.capture.start()
+		stream.thread = stream.capture.thread
+
+	def _start_stream(self, o, n):
+		"""Launch a capture for config n, into stream o when restarting, returns the stream or None"""
+		try:
+			if o is None:
+				stream = Stream(n)
+			else:
+				stream = o
+				# Update stream config and URL
+				stream.config = n
+				stream.config_key = config_key(n)
+				stream.policy = AdmissionPolicy.from_spec(stream)
+				if 'inputs' in n and len(n['inputs']) > 0:
+					stream.url = n['inputs'][0]['url']
+				elif 'url' in n:
+					stream.url = n['url']
+			# A restart keeps the place of a running stream
+			if (o is None or o.capture is None) and not self.admission.admit(stream, self.streams):
+				stream.capture = None
+				stream.admission = 'rejected'
+				print(f"[Manager] Rejected stream {stream.name}: CPU budget of {self.admission.budget} cores is used up")
+				return stream
+			self._launch(stream)
+			if o is None:
+				print(f"[Manager] Launch new stream: {stream.name}")
+			else:
+				print(f"[Manager] Restarted stream: {stream.name} with new configuration")
+			return stream
+		except Exception as e:
+			print(f"[Manager] Error launching stream {n.get('name', 'unknown')}: {e}")
+			import traceback
+			traceback.print_exc()
+			return None
 
 	def launch(self, spec):
-		return Capture(spec)
+		return self.analytics.resolve(spec)(spec)
 
@@ -0,0 +1,213 @@
+import bisect
+import time
+
+
+# Upper bounds in seconds, shared by all duration histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Distance between wall clock and the frame's NTP timestamp
+SKEW_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0, 60.0)
+
+
+class Histogram(object):
+	"""Fixed bucket histogram.
+
+	Counts are preallocated, observe() only bumps integers. It takes no lock:
+	each histogram is written by one thread at a time (the streaming thread of
+	its pipeline or the worker running the stream), scrapes may read a
+	sample that is one observation behind.
+	"""
+	__slots__ = ('bounds', 'counts', 'sum', 'count')
+
+	def __init__(self, bounds):
+		self.bounds = tuple(bounds)
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+class StreamMetrics(object):
+	"""Hot path timings of one Capture, exported by /monitoring/metrics"""
+
+	def __init__(self, queue_size=1):
+		# Pipeline running time when the appsink callback got the frame minus
+		# the frame's running time: depayload, decode and convert
+		self.decode_latency = Histogram(DURATION_BUCKETS)
+		self.process = Histogram(DURATION_BUCKETS)
+		# Frames waiting for a worker right after a submit
+		self.queue_depth = Histogram(range(queue_size + 1))
+		# OpenMetrics histograms can't have negative buckets, so the histogram
+		# is of the absolute skew and the sign is in the last value
+		self.ntp_skew = Histogram(SKEW_BUCKETS)
+		self.ntp_skew_last = 0.0
+		# Detection passes of process(), created once per pass name
+		self.stages = {}
+		self.fps = 0.0
+		self._fps_frames = 0
+		self._fps_since = None
+
+	def stage(self, name):
+		"""Histogram of one detection pass, look it up once and keep it"""
+		histogram = self.stages.get(name)
+		if histogram is None:
+			histogram = self.stages[name] = Histogram(DURATION_BUCKETS)
+		return histogram
+
+	def observe_skew(self, skew):
+		"""Wall clock minus NTP time of a frame, negative when the camera runs ahead"""
+		self.ntp_skew_last = skew
+		self.ntp_skew.observe(abs(skew))
+
+	def count_frame(self, now):
+		"""Called per received frame with time.monotonic(), fps is updated every second"""
+		if self._fps_since is None:
+			self._fps_since = now
+		self._fps_frames += 1
+		elapsed = now - self._fps_since
+		if elapsed >= 1.0:
+			self.fps = self._fps_frames / elapsed
+			self._fps_frames = 0
+			self._fps_since = now
+
+
+class RateLimitedLog(object):
+	"""Structured log lines of one component, each event at most once per interval.
+
+	Lines look like "[tag] event key=value ..." and carry the number of
+	suppressed occurrences since the last line of the event. On hot paths
+	check due() first, so the fields are only computed for lines that are
+	printed:
+
+		if self.log.due('frames'):
+			self.log.emit('frames', received=...)
+	"""
+
+	def __init__(self, tag, interval=5.0):
+		self.tag = tag
+		self.interval = interval
+		self._last = {}
+		self._suppressed = {}
+
+	def due(self, event):
+		now = time.monotonic()
+		last = self._last.get(event)
+		if last is not None and now - last < self.interval:
+			self._suppressed[event] = self._suppressed.get(event, 0) + 1
+			return False
+		self._last[event] = now
+		return True
+
+	def emit(self, event, **fields):
+		suppressed = self._suppressed.pop(event, 0)
+		if suppressed:
+			fields['suppressed'] = suppressed
+		line = " ".join(f"{k}={self._format(v)}" for k, v in fields.items())
+		print(f"[{self.tag}] {event} {line}".rstrip())
+
+	def __call__(self, event, **fields):
+		if self.due(event):
+			self.emit(event, **fields)
+
+	@staticmethod
+	def _format(value):
+		if isinstance(value, float):
+			return f"{value:.3f}"
+		value = str(value)
+		if not value or any(c in value for c in ' "='):
+			return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+		return value
+
+
+def _labels(labels):
+	return ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+
+
+def _number(value):
+	return repr(value) if isinstance(value, float) else str(value)
+
+
+class OpenMetricsWriter(object):
+	"""Builds an OpenMetrics text exposition, one family at a time"""
+	CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+	def __init__(self):
+		self.lines = []
+
+	def family(self, name, kind, help, unit=None):
+		self.lines.append(f"# TYPE {name} {kind}")
+		if unit:
+			self.lines.append(f"# UNIT {name} {unit}")
+		self.lines.append(f"# HELP {name} {help}")
+
+	def sample(self, name, labels, value):
+		self.lines.append(f"{name}{{{_labels(labels)}}} {_number(value)}" if labels else f"{name} {_number(value)}")
+
+	def histogram(self, name, labels, histogram):
+		cumulative = 0
+		for bound, count in zip(histogram.bounds, histogram.counts):
+			cumulative += count
+			self.sample(name + "_bucket", labels + (('le', _number(float(bound))),), cumulative)
+		self.sample(name + "_bucket", labels + (('le', '+Inf'),), histogram.count)
+		self.sample(name + "_sum", labels, histogram.sum)
+		self.sample(name + "_count", labels, histogram.count)
+
+	def render(self):
+		return ("\n".join(self.lines) + "\n# EOF\n").encode()
+
+
+def render_openmetrics(captures, episodes=None, snapshots=None):
+	"""OpenMetrics text of the per-stream metrics of captures"""
+	out = OpenMetricsWriter()
+	captures = [c for c in captures if getattr(c, 'metrics', None) is not None]
+
+	counters = (
+		('vision_frames_received', 'Frames delivered by the appsink', 'received'),
+		('vision_frames_processed', 'Frames handed to process()', 'processed'),
+		('vision_frames_dropped', 'Frames dropped because process() was busy', 'dropped'),
+	)
+	for name, help, attr in counters:
+		out.family(name, 'counter', help)
+		for capture in captures:
+			out.sample(name + "_total", (('stream', capture.name),), getattr(capture.frames, attr))
+
+	out.family('vision_stream_fps', 'gauge', 'Frames per second delivered by the appsink')
+	for capture in captures:
+		out.sample('vision_stream_fps', (('stream', capture.name),), round(capture.metrics.fps, 3))
+
+	out.family('vision_ntp_skew_last_seconds', 'gauge', 'Wall clock minus the NTP timestamp of the last frame', unit='seconds')
+	for capture in captures:
+		out.sample('vision_ntp_skew_last_seconds', (('stream', capture.name),), capture.metrics.ntp_skew_last)
+
+	histograms = (
+		('vision_decode_latency_seconds', 'Pipeline running time from frame to appsink callback', 'decode_latency'),
+		('vision_process_seconds', 'Duration of process()', 'process'),
+		('vision_ntp_skew_seconds', 'Distance between wall clock and the NTP timestamp of the frame', 'ntp_skew'),
+	)
+	for name, help, attr in histograms:
+		out.family(name, 'histogram', help, unit='seconds')
+		for capture in captures:
+			out.histogram(name, (('stream', capture.name),), getattr(capture.metrics, attr))
+
+	out.family('vision_queue_depth', 'histogram', 'Frames of the stream waiting for a worker after a submit')
+	for capture in captures:
+		out.histogram('vision_queue_depth', (('stream', capture.name),), capture.metrics.queue_depth)
+
+	out.family('vision_detect_seconds', 'histogram', 'Duration of one detection pass of process()', unit='seconds')
+	for capture in captures:
+		for stage, histogram in sorted(capture.metrics.stages.items()):
+			out.histogram('vision_detect_seconds', (('stream', capture.name), ('stage', stage)), histogram)
+
+	if episodes is not None:
+		out.family('vision_episodes', 'gauge', 'Episodes kept in memory')
+		out.sample('vision_episodes', (), len(episodes))
+	if snapshots is not None:
+		stats = snapshots.stats()
+		out.family('vision_snapshot_bytes', 'gauge', 'JPEG episode previews kept in memory', unit='bytes')
+		out.sample('vision_snapshot_bytes', (), stats['bytes'])
+		out.family('vision_snapshots_dropped', 'counter', 'Previews not taken because the encode queue was full')
+		out.sample('vision_snapshots_dropped_total', (), stats['dropped'])
+	return out.render()
@@ -0,0 +1,225 @@
+import time
+
+import cv2
+
+from capture import Capture, Episode
+from detectors import DetectorPool
+from frame_clock import utc_datetime
+from sampling import SamplingPolicy
+from tracking import CodeTracker
+
+
+class QrRecognizer(Capture):
+	# cv2.QRCodeDetector keeps state between calls, every worker thread
+	# running process() gets its own
+	detectors = DetectorPool(cv2.QRCodeDetector)
+	# Codes are located on a copy downscaled to this width and decoded from
+	# full resolution crops around them, with a margin relative to code size
+	detect_width = 960
+	roi_margin = 0.15
+	# Episode previews show the code and this much of its surroundings on
+	# each side, relative to code size. None previews the whole frame
+	snapshot_margin = 1.0
+	# Seconds between updated_at bumps of the episode of a code in view
+	update_interval = 1.0
+
+	def __init__(self, spec, **kwargs):
+		super().__init__(spec, **kwargs)
+		self.started = False
+		# Codes in view: {qr_data: {'episode_id', 'opened_at', 'updated_at'}}. The
+		# episode is opened when a code shows up, updated while it stays and
+		# closed when it disappears
+		self.active_qr_codes = {}
+		self.sampling = SamplingPolicy.from_spec(spec)
+		self.tracker = CodeTracker.from_spec(spec)
+		self.detect_count = 0
+		self.locate_time = self.metrics.stage('locate')
+		self.decode_time = self.metrics.stage('decode')
+		self.track_time = self.metrics.stage('track')
+		# A detector for every thread that may run process() of this stream
+		self.detectors.warm(getattr(Capture.dispatcher, 'workers', 0))
+
+	def stats(self):
+		stats = super().stats()
+		stats['frames_analysed'] = self.sampling.analysed
+		stats['frames_skipped'] = self.sampling.skipped
+		stats['frames_tracked'] = self.tracker.verified
+		return stats
+
+	def preprocess_image(self, image):
+		"""Preprocess image to improve QR code detection"""
+		# Convert to grayscale if needed
+		if len(image.shape) == 3:
+			gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+		else:
+			gray = image
+		
+		# Apply adaptive thresholding to improve contrast
+		# This helps with QR codes in varying lighting conditions
+		adaptive = cv2.adaptiveThreshold(
+			gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+			cv2.THRESH_BINARY, 11, 2
+		)
+		
+		return gray, adaptive
+
+	def locate_codes(self, image):
+		"""Stage 1: find QR code quads on a downscaled grayscale copy.
+
+		Returns quads in full resolution coordinates.
+		"""
+		height, width = image.shape[:2]
+		scale = min(1.0, self.detect_width / width)
+		small = image
+		if scale < 1.0:
+			small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+		if len(small.shape) == 3:
+			small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+		detector = self.detectors.get()
+		retval, points = detector.detectMulti(small)
+		if not retval or points is None:
+			# detectMulti misses some single codes that detect() finds
+			retval, points = detector.detect(small)
+			if not retval or points is None:
+				return []
+		return [quad / scale for quad in points]
+
+	def decode_roi(self, image, quad):
+		"""Stage 2: decode a located code from a full resolution crop around it.
+
+		Tries the color crop, then grayscale, then adaptive threshold; the
+		preprocessing only runs on the crop and only when it is needed.
+		Returns (data, corners, modules per side or None) of every code.
+		"""
+		height, width = image.shape[:2]
+		x0, y0 = quad.min(axis=0)
+		x1, y1 = quad.max(axis=0)
+		margin = max(x1 - x0, y1 - y0) * self.roi_margin
+		x0, y0 = max(0, int(x0 - margin)), max(0, int(y0 - margin))
+		x1, y1 = min(width, int(x1 + margin) + 1), min(height, int(y1 + margin) + 1)
+		roi = image[y0:y1, x0:x1]
+
+		candidates = [roi]
+		if len(roi.shape) == 3:
+			candidates.append(lambda: cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY))
+		candidates.append(lambda: self.preprocess_image(roi)[1])
+		detector = self.detectors.get()
+		for candidate in candidates:
+			if callable(candidate):
+				candidate = candidate()
+			retval, decoded_info, points, straight = detector.detectAndDecodeMulti(candidate)
+			if retval and decoded_info:
+				# The rectified codes have a pixel per module
+				if straight is None or len(straight) != len(decoded_info):
+					straight = [None] * len(decoded_info)
+				modules = [code.shape[0] if code is not None and code.size else None for code in straight]
+				found = [(qr, pts + (x0, y0), n) for qr, pts, n in zip(decoded_info, points, modules) if qr and qr.strip()]
+				if found:
+					return found
+		return []
+
+	def snapshot_roi(self, image, quad):
+		"""(x0, y0, x1, y1) of the preview of the code at quad, None for the whole frame"""
+		if self.snapshot_margin is None:
+			return None
+		height, width = image.shape[:2]
+		x0, y0 = quad.min(axis=0)
+		x1, y1 = quad.max(axis=0)
+		margin = max(x1 - x0, y1 - y0) * self.snapshot_margin
+		return (max(0, int(x0 - margin)), max(0, int(y0 - margin)),
+			min(width, int(x1 + margin) + 1), min(height, int(y1 + margin) + 1))
+
+	def detect_codes(self, image, utc_ns=None):
+		"""Returns {qr_data: quad} of the codes decoded in the image.
+
+		With utc_ns the codes of the last full pass are confirmed by the
+		tracker when they are still in place, without locating or decoding.
+		"""
+		if utc_ns is not None:
+			t1 = time.perf_counter()
+			codes = self.tracker.verify(image, utc_ns)
+			self.track_time.observe(time.perf_counter() - t1)
+			if codes is not None:
+				return codes
+
+		codes = {}
+		tracked = {}
+		t1 = time.perf_counter()
+		quads = self.locate_codes(image)
+		t2 = time.perf_counter()
+		self.locate_time.observe(t2 - t1)
+		for quad in quads:
+			for qr_data, points, modules in self.decode_roi(image, quad):
+				codes[qr_data] = points
+				# Every code is tracked by its own corners and module grid
+				fingerprint = None
+				if self.tracker.enabled and modules:
+					fingerprint = self.tracker.fingerprint(image, points, modules)
+				tracked[qr_data] = (points, fingerprint)
+			t1, t2 = t2, time.perf_counter()
+			self.decode_time.observe(t2 - t1)
+		if utc_ns is not None:
+			self.tracker.update(tracked, utc_ns)
+		return codes
+
+	def process(self, image, utc_ns):
+		if not self.started:
+			print(f"[{self.name}] First frame arrived on {utc_datetime(utc_ns)}, image shape: {image.shape}")
+			self.started = True
+
+		# Static scene and nothing in view: skip the detector cascade
+		if not self.sampling.should_process(image, utc_ns, active=bool(self.active_qr_codes)):
+			return None
+
+		codes = self.detect_codes(image, utc_ns)
+
+		self.detect_count += 1
+		if self.log.due('detect'):
+			self.log.emit('detect', attempts=self.detect_count, decoded=len(codes), shape=image.shape)
+
+		# Integer math, utc_ns is beyond the exact range of a float
+		now_ms = int(utc_ns) // 10**6
+		opened = []
+		if codes and self.log.due('found'):
+			self.log.emit('found', count=len(codes), codes=list(codes))
+		for qr_data in codes:
+			qr_info = self.active_qr_codes.get(qr_data)
+			if qr_info is None:
+				# New QR code detected - open its episode right away, so
+				# Central learns about it without waiting for it to disappear.
+				# The id is unique across all streams of the node
+				episode_id = Capture.new_episode_id(utc_ns)
+				self.active_qr_codes[qr_data] = {
+					'episode_id': episode_id,
+					'opened_at': now_ms,
+					'updated_at': now_ms,
+				}
+				opened.append(Episode(
+					episode_id=episode_id,
+					media=self.name,
+					opened_at=now_ms,
+					started_at=now_ms,  # started_at = opened_at
+					updated_at=now_ms,
+					episode_type=Episode.QR_CODE,
+					payload={'qr_url': qr_data}
+				))
+				# Preview for Central, encoded in the background
+				Capture.snapshot_episode(episode_id, image, self.snapshot_roi(image, codes[qr_data]))
+				print(f"[{self.name}] NEW QR CODE DETECTED: {qr_data} at {utc_datetime(utc_ns)}, opened episode {episode_id}")
+			elif now_ms - qr_info['updated_at'] >= self.update_interval * 1000:
+				# Still in view: bump updated_at, at most every update_interval
+				qr_info['updated_at'] = now_ms
+				Capture.update_episode(qr_info['episode_id'], updated_at=now_ms)
+
+		# Close the episodes of all codes that disappeared in this frame
+		for qr_data in [qr_data for qr_data in self.active_qr_codes if qr_data not in codes]:
+			qr_info = self.active_qr_codes.pop(qr_data)
+			Capture.update_episode(qr_info['episode_id'], closed_at=now_ms, updated_at=now_ms)
+			print(f"[{self.name}] QR CODE DISAPPEARED: {qr_data} at {utc_datetime(utc_ns)}, closed episode {qr_info['episode_id']} (opened: {qr_info['opened_at']}, closed: {now_ms})")
+
+		return opened
+
+
+class ArucoQrRecognizer(QrRecognizer):
+	"""QrRecognizer on cv2.QRCodeDetectorAruco, which finds codes by their finder patterns"""
+	detectors = DetectorPool(cv2.QRCodeDetectorAruco)
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+
+
+class SamplingPolicy(object):
+	"""Decides which frames of a stream are worth running detection on.
+
+	Two gates are applied while nothing is detected:
+
+	* fps cap: at most idle_fps frames per second are analysed
+	* motion gate: a frame is skipped when its tiny grayscale thumbnail has
+	  fewer than min_changed pixels differing by more than pixel_threshold
+	  from the thumbnail of the last analysed frame
+
+	Every keepalive seconds a frame is analysed regardless of motion. While
+	something is active (e.g. a QR code is in view) the cap is raised to
+	active_fps (0 means every frame) and the motion gate is off, so close
+	times stay accurate.
+
+	All options can be set per stream with the "sampling" object of the stream
+	config, {"sampling": {"enabled": false}} turns the policy off.
+	"""
+
+	def __init__(self, enabled=True, idle_fps=5.0, active_fps=0, thumb_width=80,
+			pixel_threshold=20, min_changed=3, keepalive=1.0):
+		self.enabled = enabled
+		self.idle_interval_ns = int(1e9 / idle_fps) if idle_fps else 0
+		self.active_interval_ns = int(1e9 / active_fps) if active_fps else 0
+		self.thumb_width = thumb_width
+		self.pixel_threshold = pixel_threshold
+		self.min_changed = min_changed
+		self.keepalive_ns = int(keepalive * 1e9)
+		self.last_ns = None
+		self.last_thumb = None
+		self.analysed = 0
+		self.skipped = 0
+
+	@classmethod
+	def from_spec(cls, spec):
+		config = getattr(spec, 'config', None) or {}
+		return cls(**config.get('sampling', {}))
+
+	def thumbnail(self, image):
+		height, width = image.shape[:2]
+		size = (self.thumb_width, max(1, self.thumb_width * height // width))
+		# Nearest neighbour only touches the sampled pixels, so this is cheap
+		# even on full resolution frames
+		thumb = cv2.resize(image, size, interpolation=cv2.INTER_NEAREST)
+		if thumb.ndim == 3:
+			thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+		return thumb
+
+	def should_process(self, image, utc_ns, active=False):
+		if not self.enabled:
+			self.analysed += 1
+			return True
+		if self.last_ns is not None:
+			elapsed = utc_ns - self.last_ns
+			# Timestamps going backwards mean the source restarted
+			if 0 <= elapsed < (self.active_interval_ns if active else self.idle_interval_ns):
+				self.skipped += 1
+				return False
+		else:
+			elapsed = None
+
+		thumb = self.thumbnail(image)
+		if not active and self.last_thumb is not None and elapsed is not None \
+				and 0 <= elapsed < self.keepalive_ns and self.last_thumb.shape == thumb.shape:
+			changed = np.count_nonzero(cv2.absdiff(thumb, self.last_thumb) > self.pixel_threshold)
+			if changed < self.min_changed:
+				self.skipped += 1
+				return False
+
+		self.last_ns = utc_ns
+		self.last_thumb = thumb
+		self.analysed += 1
+		return True
@@ -0,0 +1,452 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+import capture
+
+# Pipelines of all simulated captures, so every appearance of a code is unique
+_generations = itertools.count(1)
+
+
+def rss_bytes():
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def os_threads():
+	with open('/proc/self/status') as f:
+		for line in f:
+			if line.startswith('Threads:'):
+				return int(line.split()[1])
+	return 0
+
+
+def percentile(values, p):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class SourceOptions(object):
+	"""Local source of a simulated stream, the "simulation" object of its config.
+
+	source is "qr" (generated frames, a new QR code shows for qr_for seconds
+	every qr_every seconds), "videotestsrc", a video file (replayed at its
+	frame rate, end of file reconnects and starts over) or an rtsp:// URL
+	played as usual, e.g. of a local RTSP server.
+	"""
+
+	def __init__(self, source='qr', width=640, height=360, fps=10, qr_every=10.0, qr_for=3.0, qr_offset=2.0, pattern='ball'):
+		self.source = source
+		self.width = width
+		self.height = height
+		self.fps = fps
+		self.qr_every = qr_every
+		self.qr_for = qr_for
+		self.qr_offset = qr_offset
+		self.pattern = pattern
+
+	@classmethod
+	def from_spec(cls, spec):
+		config = getattr(spec, 'config', None) or {}
+		return cls(**config.get('simulation', {}))
+
+	def caps(self):
+		return f'video/x-raw, width=(int){int(self.width)}, height=(int){int(self.height)}, framerate=(fraction){int(self.fps)}/1'
+
+	def occurrence(self, pts_ns):
+		"""Index of the code shown at pts, None when none is"""
+		t = pts_ns / 1e9
+		if self.source != 'qr' or not self.qr_for or not self.qr_offset <= t % self.qr_every < self.qr_offset + self.qr_for:
+			return None
+		return int(t // self.qr_every)
+
+
+class SimulatedSource(object):
+	"""Mixed in front of the launched Capture class, plays a local source instead of the camera.
+
+	Frames get the wall clock as their NTP time, like a camera with a
+	perfect clock. The first frame of every pipeline and the time every
+	generated code first shows are recorded for the report.
+	"""
+
+	def __init__(self, spec, **kwargs):
+		super().__init__(spec, **kwargs)
+		self.source = SourceOptions.from_spec(spec)
+		if self.source.source not in ('qr', 'videotestsrc'):
+			self.rtsp_url = self.source.source
+		self.generation = 0
+		self.pushed = 0
+		self.first_frame_at = None
+		# QR code text -> utc_ns of the first frame showing it
+		self.appeared = {}
+		self._background = None
+		self._shown = (None, None)
+
+	def source_chain(self):
+		source = self.source
+		if source.source == 'qr':
+			return (f'appsrc name=feed is-live=true format=time caps="{source.caps()}, format=(string)BGR" ! '
+				f'identity sync=true ! {self.pipeline_config.convert_chain()}')
+		if source.source == 'videotestsrc':
+			return f'videotestsrc is-live=true pattern={source.pattern} ! {source.caps()} ! {self.pipeline_config.convert_chain()}'
+		if source.source.startswith('rtsp://'):
+			return super().source_chain()
+		return f'filesrc name=ingress ! decodebin ! identity sync=true ! {self.pipeline_config.convert_chain()}'
+
+	def build_pipeline(self):
+		pipeline = super().build_pipeline()
+		if pipeline is not None:
+			self.generation = next(_generations)
+			self.pushed = 0
+			feed = pipeline.get_by_name('feed')
+			if feed is not None:
+				feed.connect('need-data', self.on_need_data)
+		return pipeline
+
+	def code_text(self, occurrence):
+		return f"sim:{self.name}:{self.generation}:{occurrence}"
+
+	def on_need_data(self, feed, length):
+		Gst = capture.Gst
+		duration = Gst.SECOND // int(self.source.fps)
+		pts = self.pushed * duration
+		self.pushed += 1
+		buffer = Gst.Buffer.new_wrapped(self.render(self.source.occurrence(pts)))
+		buffer.pts = pts
+		buffer.duration = duration
+		feed.emit('push-buffer', buffer)
+
+	def render(self, occurrence):
+		"""Frame bytes showing the code of occurrence, the background for None"""
+		if self._background is None:
+			rng = np.random.default_rng(int(hashlib.md5(self.name.encode()).hexdigest()[:8], 16))
+			frame = np.full((int(self.source.height), int(self.source.width), 3), 120, dtype=np.uint8)
+			frame += rng.integers(0, 16, frame.shape, dtype=np.uint8)
+			self._background = frame
+			self._shown = (None, frame.tobytes())
+		key = (self.generation, occurrence)
+		if self._shown[0] != key:
+			frame = self._background
+			if occurrence is not None:
+				frame = frame.copy()
+				code = cv2.QRCodeEncoder.create().encode(self.code_text(occurrence))
+				size = max(1, min(frame.shape[0], frame.shape[1]) // 2 // code.shape[0])
+				code = cv2.resize(code, (code.shape[1] * size, code.shape[0] * size), interpolation=cv2.INTER_NEAREST)
+				code = cv2.copyMakeBorder(code, 4 * size, 4 * size, 4 * size, 4 * size, cv2.BORDER_CONSTANT, value=255)
+				y, x = (frame.shape[0] - code.shape[0]) // 2, (frame.shape[1] - code.shape[1]) // 2
+				frame[y:y + code.shape[0], x:x + code.shape[1]] = code[:, :, None]
+			self._shown = (key, frame.tobytes())
+		return self._shown[1]
+
+	def frame_timestamp(self, buffer):
+		utc_ns = time.time_ns()
+		if self.first_frame_at is None:
+			self.first_frame_at = time.monotonic()
+		occurrence = self.source.occurrence(buffer.pts)
+		if occurrence is not None:
+			self.appeared.setdefault(self.code_text(occurrence), utc_ns)
+		return utc_ns
+
+
+class Scenario(object):
+	"""Streams added, removed and changed over time, read from a JSON file.
+
+	{"duration": 90, "poll_interval": 0.5,
+	 "defaults": {"source": "qr", "fps": 10},
+	 "events": [
+		{"at": 0, "add": [{"name": "cam1", "config": {"analytics": "qr_code"}}]},
+		{"at": 10, "add": {"prefix": "load", "count": 16, "source": "videotestsrc"}},
+		{"at": 30, "change": {"names": ["cam1"], "fps": 25}},
+		{"at": 60, "remove": {"prefix": "load"}}]}
+
+	Streams are given as a list of objects with a name, or as count streams
+	named prefix0, prefix1... (from start). Their other fields are
+	SourceOptions, config is merged into the stream config Manager gets.
+	remove takes a list of names or a prefix, change also a list of names
+	and the fields to set. Manager restarts a changed stream, as its config differs.
+	"""
+
+	def __init__(self, events, duration=None, poll_interval=0.5, defaults=None):
+		self.events = sorted(events, key=lambda e: e.get('at', 0))
+		self.duration = duration if duration is not None else (self.events[-1].get('at', 0) + 30 if self.events else 30)
+		self.poll_interval = poll_interval
+		self.defaults = defaults or {}
+		self.streams = {}
+		self.applied = 0
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as f:
+			return cls(**json.load(f))
+
+	def names(self, selector):
+		if isinstance(selector, list):
+			return [s if isinstance(s, str) else s['name'] for s in selector]
+		if 'names' in selector:
+			return list(selector['names'])
+		if 'count' in selector:
+			start = selector.get('start', 0)
+			return [f"{selector['prefix']}{i}" for i in range(start, start + selector['count'])]
+		return [name for name in self.streams if name.startswith(selector['prefix'])]
+
+	def fields(self, selector, name):
+		if isinstance(selector, list):
+			for s in selector:
+				if not isinstance(s, str) and s['name'] == name:
+					return {k: v for k, v in s.items() if k != 'name'}
+			return {}
+		return {k: v for k, v in selector.items() if k not in ('names', 'prefix', 'count', 'start')}
+
+	def advance(self, elapsed):
+		"""Apply the events due by elapsed seconds, the list of those applied"""
+		due = []
+		while self.applied < len(self.events) and self.events[self.applied].get('at', 0) <= elapsed:
+			event = self.events[self.applied]
+			self.applied += 1
+			for name in self.names(event.get('remove', [])):
+				self.streams.pop(name, None)
+			for name in self.names(event.get('add', [])):
+				self.streams[name] = dict(self.defaults, **self.fields(event['add'], name))
+			for name in self.names(event.get('change', [])):
+				if name in self.streams:
+					self.streams[name].update(self.fields(event['change'], name))
+			due.append(event)
+		return due
+
+	def configs(self):
+		"""Stream configs of the current state, as Central would serve them"""
+		configs = []
+		for name, fields in self.streams.items():
+			fields = dict(fields)
+			config = fields.pop('config', {})
+			configs.append(dict(config, name=name, url=f"sim://{name}", simulation=fields))
+		return configs
+
+
+class CentralPoller(object):
+	"""Long-polls /episodes of the node like Central, recording when every episode is first seen"""
+
+	def __init__(self, url, poll_timeout=2):
+		self.url = url
+		self.poll_timeout = poll_timeout
+		self.cursor = None
+		# episode_id -> (time.time_ns() first seen, episode dict)
+		self.seen = {}
+		self.polls = 0
+		self.errors = 0
+		self.should_stop = False
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='central-poller', daemon=True)
+		self.thread.start()
+		return self
+
+	def run(self):
+		while not self.should_stop:
+			url = f"{self.url}?poll_timeout={self.poll_timeout}"
+			url += f"&cursor={self.cursor}" if self.cursor else "&updated_at_gt=0"
+			try:
+				with urllib.request.urlopen(url, timeout=self.poll_timeout + 5) as r:
+					data = json.loads(r.read())
+			except (OSError, ValueError):
+				self.errors += 1
+				time.sleep(0.2)
+				continue
+			now = time.time_ns()
+			self.polls += 1
+			for episode in data.get('episodes', []):
+				self.seen.setdefault(episode['episode_id'], (now, episode))
+			self.cursor = data.get('next_cursor', self.cursor)
+
+	def stop(self):
+		self.should_stop = True
+		if self.thread is not None:
+			self.thread.join(self.poll_timeout + 5)
+
+
+class SimulatedManager(object):
+	"""Mixed in front of the node's Manager class, see simulated_manager().
+
+	Stream configs come from a Scenario instead of Central and captures play
+	local sources. run() plays the scenario once with a CentralPoller on the
+	node's HTTP API, then stops all streams and returns the report.
+	"""
+
+	def __init__(self, scenario, port=8020):
+		super().__init__('sim://scenario')
+		self.scenario = scenario
+		self.port = port
+		self.started_at = None
+		# Applied scenario events: {'at', 'event', 'applied', 'streams'}
+		self.changes = []
+		self.pending = []
+		self.samples = []
+		self.captures = []
+		self._classes = {}
+
+	def fetch_config(self):
+		self.pending.extend(self.scenario.advance(time.monotonic() - self.started_at))
+		config = {'streams': self.scenario.configs()}
+		# Unchanged unless an event was due, or a stream failed to launch last time
+		config_hash = hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+		if config_hash == self.last_config_hash:
+			return None
+		return config_hash, None, config
+
+	def reconcile(self, configs):
+		ok = super().reconcile(configs)
+		applied = time.monotonic() - self.started_at
+		for event in self.pending:
+			names = []
+			for op in ('add', 'change'):
+				names += self.scenario.names(event[op]) if op in event else []
+			self.changes.append({'at': event.get('at', 0), 'event': event, 'applied': applied, 'streams': names})
+		self.pending = []
+		for stream in self.streams:
+			if stream.capture is not None and stream.capture not in self.captures:
+				self.captures.append(stream.capture)
+		return ok
+
+	def launch(self, spec):
+		base = self.analytics.resolve(spec)
+		cls = self._classes.get(base)
+		if cls is None:
+			# Inference processes run process() of base, it can't be pickled by name
+			cls = self._classes[base] = type(f"Simulated{base.__name__}", (SimulatedSource, base), {'worker_class': base})
+		return cls(spec)
+
+	def sample(self, last):
+		now, cpu = time.monotonic(), time.process_time()
+		running = [s.capture for s in self.streams if s.capture is not None]
+		counters = (sum(c.frames.received for c in self.captures), sum(c.frames.processed for c in self.captures),
+			sum(c.frames.dropped for c in self.captures))
+		if last is not None and now > last[0]:
+			elapsed = now - last[0]
+			self.samples.append({
+				'streams': len(running),
+				'playing': sum(c.state == 'playing' for c in running),
+				'seconds': elapsed,
+				'cores': (cpu - last[1]) / elapsed,
+				'rss': rss_bytes(),
+				'threads': os_threads(),
+				'fps_received': (counters[0] - last[2][0]) / elapsed,
+				'fps_processed': (counters[1] - last[2][1]) / elapsed,
+				'dropped': counters[2] - last[2][2],
+			})
+		return now, cpu, counters
+
+	def run(self):
+		self.started_at = time.monotonic()
+		print(f"[Simulation] Playing scenario for {self.scenario.duration}s, {len(self.scenario.events)} events")
+		poller = CentralPoller(f"http://127.0.0.1:{self.port}/vision/api/v3/episodes").start()
+		last = self.sample(None)
+		while time.monotonic() - self.started_at < self.scenario.duration:
+			self.reconfigure()
+			self.rebalance()
+			last = self.sample(last)
+			time.sleep(self.scenario.poll_interval)
+		# Leave the poller time to see the episodes of the last codes
+		time.sleep(2 * poller.poll_timeout)
+		poller.stop()
+		self.reconcile([])
+		report = self.report(poller)
+		self.print_report(report)
+		return report
+
+	def report(self, poller):
+		first_frames = {}
+		appeared = {}
+		for c in self.captures:
+			if c.first_frame_at is not None:
+				first_frames.setdefault(c.name, []).append(c.first_frame_at - self.started_at)
+			appeared.update(c.appeared)
+
+		changes = []
+		for change in self.changes:
+			# A stream's first frame after the event, later ones are of later restarts
+			frames = [min(t for t in first_frames[name] if t >= change['at']) - change['at'] for name in change['streams']
+				if any(t >= change['at'] for t in first_frames.get(name, []))]
+			changes.append({
+				'at': change['at'],
+				'event': {k: v for k, v in change['event'].items() if k != 'at'},
+				'applied_ms': (change['applied'] - change['at']) * 1000,
+				'first_frame_ms_p50': None if not frames else percentile(frames, 50) * 1000,
+				'first_frame_ms_max': None if not frames else max(frames) * 1000,
+				'streams_without_frames': len(change['streams']) - len(frames),
+			})
+
+		visible = {}
+		for seen_at, episode in poller.seen.values():
+			payload = episode.get('payload')
+			code = payload.get('qr_url') if isinstance(payload, dict) else payload
+			if code in appeared:
+				visible.setdefault(code, (seen_at, episode))
+		latencies = [(visible[code][0] - utc_ns) / 1e6 for code, utc_ns in appeared.items() if code in visible]
+		detect = [visible[code][1]['opened_at'] - utc_ns / 1e6 for code, utc_ns in appeared.items() if code in visible]
+
+		by_streams = {}
+		for s in self.samples:
+			by_streams.setdefault(s['streams'], []).append(s)
+		resources = []
+		for count, samples in sorted(by_streams.items()):
+			seconds = sum(s['seconds'] for s in samples)
+			mean = lambda key: sum(s[key] * s['seconds'] for s in samples) / seconds
+			resources.append({
+				'streams': count,
+				'seconds': seconds,
+				'cores': mean('cores'),
+				'rss_mb': max(s['rss'] for s in samples) / 2**20,
+				'threads': max(s['threads'] for s in samples),
+				'fps_received': mean('fps_received'),
+				'fps_processed': mean('fps_processed'),
+				'dropped': sum(s['dropped'] for s in samples),
+			})
+		return {
+			'duration': self.scenario.duration,
+			'changes': changes,
+			'codes': {
+				'appeared': len(appeared),
+				'visible': len(latencies),
+				'appear_to_visible_ms_p50': percentile(latencies, 50),
+				'appear_to_visible_ms_p90': percentile(latencies, 90),
+				'appear_to_visible_ms_max': max(latencies) if latencies else None,
+				'appear_to_opened_ms_p50': percentile(detect, 50),
+				'polls': poller.polls,
+				'poll_errors': poller.errors,
+			},
+			'resources': resources,
+		}
+
+	@staticmethod
+	def print_report(report):
+		ms = lambda v: '-' if v is None else f"{v:.0f}"
+		print(f"[Simulation] Reconfigure latency after scenario events")
+		print(f"{'at s':>6} {'applied ms':>10} {'first frame p50 ms':>18} {'max ms':>8} {'no frames':>9}  event")
+		for c in report['changes']:
+			print(f"{c['at']:>6} {ms(c['applied_ms']):>10} {ms(c['first_frame_ms_p50']):>18} {ms(c['first_frame_ms_max']):>8} "
+				f"{c['streams_without_frames']:>9}  {json.dumps(c['event'])}")
+		codes = report['codes']
+		print(f"[Simulation] QR codes: {codes['visible']}/{codes['appeared']} seen by the poller, appearance to visible "
+			f"p50 {ms(codes['appear_to_visible_ms_p50'])} ms, p90 {ms(codes['appear_to_visible_ms_p90'])} ms, "
+			f"max {ms(codes['appear_to_visible_ms_max'])} ms, to opened_at p50 {ms(codes['appear_to_opened_ms_p50'])} ms "
+			f"({codes['polls']} polls, {codes['poll_errors']} errors)")
+		print(f"[Simulation] Resources by running streams")
+		print(f"{'streams':>7} {'seconds':>7} {'cores':>6} {'rss MB':>7} {'threads':>7} {'fps in':>7} {'fps done':>8} {'dropped':>7}")
+		for r in report['resources']:
+			print(f"{r['streams']:>7} {r['seconds']:>7.0f} {r['cores']:>6.2f} {r['rss_mb']:>7.0f} {r['threads']:>7} "
+				f"{r['fps_received']:>7.1f} {r['fps_processed']:>8.1f} {r['dropped']:>7}")
+
+
+def simulated_manager(base, scenario, port=8020):
+	"""Instance of the Manager subclass base that plays scenario"""
+	return type(f"Simulated{base.__name__}", (SimulatedManager, base), {})(scenario, port=port)
@@ -0,0 +1,131 @@
+import collections
+import queue
+import threading
+import time
+
+
+class SnapshotStore(object):
+	"""JPEG previews of episodes, encoded off the frame path, in a size-bounded LRU cache.
+
+	submit() crops and copies the frame region and queues it, it never waits:
+	when the queued copies would exceed max_queued_bytes the snapshot is
+	dropped and counted. Encoder threads downscale to max_width and encode
+	(cv2 releases the GIL while doing so), the result replaces an earlier
+	preview of the episode. Least recently used previews are evicted once the
+	cache holds more than max_bytes.
+	"""
+
+	def __init__(self, max_bytes=64 << 20, workers=1, max_queued_bytes=32 << 20, quality=80, max_width=640):
+		self.max_bytes = max_bytes
+		self.workers = workers
+		self.max_queued_bytes = max_queued_bytes
+		self.quality = quality
+		self.max_width = max_width
+		# episode_id -> (jpeg, etag), least recently used first
+		self.cache = collections.OrderedDict()
+		self.cached_bytes = 0
+		self.queued_bytes = 0
+		self.queue = queue.SimpleQueue()
+		self.lock = threading.Lock()
+		self.threads = []
+		self.version = 0
+		self.submitted = 0
+		self.encoded = 0
+		self.dropped = 0
+		self.evicted = 0
+		self.encode_time = 0.0
+
+	def options(self):
+		"""Constructor arguments, for the stand-in of worker processes"""
+		return {
+			'workers': self.workers,
+			'max_queued_bytes': self.max_queued_bytes,
+			'quality': self.quality,
+			'max_width': self.max_width,
+		}
+
+	def submit(self, episode_id, image, roi=None):
+		"""Queue a preview of image, or of its roi (x0, y0, x1, y1), False when dropped"""
+		if roi is not None:
+			x0, y0, x1, y1 = (int(v) for v in roi)
+			image = image[max(0, y0):max(0, y1), max(0, x0):max(0, x1)]
+		if image.size == 0:
+			return False
+		with self.lock:
+			if self.queued_bytes + image.nbytes > self.max_queued_bytes:
+				self.dropped += 1
+				return False
+			self.queued_bytes += image.nbytes
+			self.submitted += 1
+			if not self.threads:
+				self._start()
+		# Frames are only valid until process() returns
+		self.queue.put((episode_id, image.copy()))
+		return True
+
+	def _start(self):
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._encode_loop, name=f"snapshot-{i}", daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+	def _encode_loop(self):
+		while True:
+			episode_id, image = self.queue.get()
+			t1 = time.perf_counter()
+			try:
+				jpeg = self.encode(image)
+			except Exception as e:
+				print(f"[Snapshots] Error encoding preview of episode {episode_id}: {type(e).__name__}: {e}")
+				jpeg = None
+			with self.lock:
+				self.queued_bytes -= image.nbytes
+				self.encode_time += time.perf_counter() - t1
+			if jpeg is not None:
+				self.put(episode_id, jpeg)
+
+	def encode(self, image):
+		# Not imported with the module, the node starts without cv2
+		import cv2
+		height, width = image.shape[:2]
+		if self.max_width and width > self.max_width:
+			image = cv2.resize(image, (self.max_width, max(1, height * self.max_width // width)), interpolation=cv2.INTER_AREA)
+		ok, jpeg = cv2.imencode('.jpg', image, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+		if not ok:
+			raise ValueError("imencode failed")
+		return jpeg.tobytes()
+
+	def put(self, episode_id, jpeg):
+		with self.lock:
+			self.version += 1
+			old = self.cache.pop(episode_id, None)
+			if old is not None:
+				self.cached_bytes -= len(old[0])
+			self.cache[episode_id] = (jpeg, f'"{episode_id}-{self.version}"')
+			self.cached_bytes += len(jpeg)
+			self.encoded += 1
+			while self.cached_bytes > self.max_bytes and self.cache:
+				_, (evicted, _) = self.cache.popitem(last=False)
+				self.cached_bytes -= len(evicted)
+				self.evicted += 1
+
+	def get(self, episode_id):
+		"""(jpeg, etag) of the episode's preview or None"""
+		with self.lock:
+			found = self.cache.get(episode_id)
+			if found is not None:
+				self.cache.move_to_end(episode_id)
+			return found
+
+	def stats(self):
+		with self.lock:
+			return {
+				'previews': len(self.cache),
+				'bytes': self.cached_bytes,
+				'queued_bytes': self.queued_bytes,
+				'submitted': self.submitted,
+				'encoded': self.encoded,
+				'dropped': self.dropped,
+				'evicted': self.evicted,
+				'encode_time': round(self.encode_time, 3),
+			}
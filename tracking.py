@@ -0,0 +1,98 @@
+import collections
+
+import cv2
+import numpy as np
+
+
+class CodeTracker(object):
+	"""Per-stream cache of decoded codes, keyed by a fingerprint of their region.
+
+	After a full detection pass every decoded code is kept with its corners
+	and a fingerprint at module resolution: the dark/light value of the
+	center of each of its modules x modules cells, as many as the decoder
+	found. On the following frames the codes of the last pass are confirmed
+	by sampling the same cells again, which costs a warp of a tiny patch
+	instead of locating and decoding. The tracker asks for a full pass when a
+	code fails the check (it moved, was covered, swapped or is gone) and at
+	least every refresh seconds, so new codes are found within refresh
+	seconds. A located region is always decoded, data is never reused for it.
+
+	Two codes with nearly the same data still differ in about 5% of their
+	modules (their error correction differs), and a code shifted by a sixth of
+	a module still matches all of its own, so presence_threshold is the share
+	of modules that must agree.
+
+	At most limit codes are cached, the least recently seen are evicted. All
+	options can be set per stream with the "tracking" object of the stream
+	config, {"tracking": {"enabled": false}} decodes every analysed frame.
+	"""
+
+	def __init__(self, enabled=True, limit=32, presence_threshold=0.98, refresh=1.0):
+		self.enabled = enabled
+		self.limit = limit
+		self.presence_threshold = presence_threshold
+		self.refresh_ns = int(refresh * 1e9)
+		# data -> (quad, fingerprint), least recently seen first
+		self.codes = collections.OrderedDict()
+		# data of the codes found by the last full pass
+		self.active = ()
+		self.full_pass_ns = None
+		self.verified = 0
+		self.full_passes = 0
+
+	@classmethod
+	def from_spec(cls, spec):
+		config = getattr(spec, 'config', None) or {}
+		return cls(**config.get('tracking', {}))
+
+	def fingerprint(self, image, quad, modules):
+		"""modules x modules booleans, True for dark modules of the code at the quad, None for a flat region"""
+		# 3x3 pixels per module, the center one is sampled
+		size = modules * 3
+		corners = np.float32([[0, 0], [size, 0], [size, size], [0, size]])
+		m = cv2.getPerspectiveTransform(np.float32(quad), corners)
+		patch = cv2.warpPerspective(image, m, (size, size), flags=cv2.INTER_LINEAR)
+		if patch.ndim == 3:
+			patch = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+		cells = patch[1::3, 1::3].astype(np.float32)
+		if cells.std() < 8.0:
+			return None
+		return cells < cells.mean()
+
+	@staticmethod
+	def similarity(a, b):
+		"""Share of modules that agree"""
+		return float(np.mean(a == b))
+
+	def verify(self, image, utc_ns):
+		"""{data: quad} of the codes of the last full pass if all are still in place, None when a full pass is needed"""
+		if not self.enabled or not self.active or self.full_pass_ns is None:
+			return None
+		if not 0 <= utc_ns - self.full_pass_ns < self.refresh_ns:
+			return None
+		codes = {}
+		for data in self.active:
+			quad, cached = self.codes[data]
+			fingerprint = self.fingerprint(image, quad, cached.shape[0])
+			if fingerprint is None or self.similarity(fingerprint, cached) < self.presence_threshold:
+				return None
+			codes[data] = quad
+		self.verified += 1
+		return codes
+
+	def update(self, codes, utc_ns):
+		"""Record a full pass, codes is {data: (quad, fingerprint)}"""
+		self.full_passes += 1
+		self.full_pass_ns = utc_ns
+		complete = True
+		for data, (quad, fingerprint) in codes.items():
+			if fingerprint is None:
+				complete = False
+				continue
+			self.codes.pop(data, None)
+			self.codes[data] = (quad, fingerprint)
+		while len(self.codes) > self.limit:
+			if self.codes.popitem(last=False)[0] in codes:
+				complete = False
+		# verify() can only vouch for the pass when it can check every code of it
+		self.active = tuple(codes) if complete else ()
@@ -0,0 +1,337 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from snapshots import SnapshotStore
+
+
+class EpisodeChannel(object):
+	"""Stands in for the episode store inside a worker process.
+
+	Capture.append_episode()/update_episode() called by process() in the
+	worker are forwarded to the parent, which commits them to the real store.
+	"""
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def append(self, episode):
+		self.conn.send(('append', episode))
+
+	def update(self, episode_id, **kwargs):
+		self.conn.send(('update', episode_id, kwargs))
+		return None
+
+
+class SnapshotChannel(SnapshotStore):
+	"""Stands in for the snapshot cache inside a worker process.
+
+	Previews are encoded by threads of the worker like in the parent, the
+	worker loop sends them to the parent's cache after each round of frames.
+	"""
+
+	def __init__(self, **options):
+		super().__init__(**options)
+		self.outbox = queue.SimpleQueue()
+
+	def put(self, episode_id, jpeg):
+		self.outbox.put((episode_id, jpeg))
+
+	def flush(self, conn):
+		while True:
+			try:
+				episode_id, jpeg = self.outbox.get_nowait()
+			except queue.Empty:
+				return
+			conn.send(('snapshot', episode_id, jpeg))
+
+
+class SharedFrameRing(object):
+	"""Fixed number of frame slots of one stream in a shared memory segment.
+
+	generation is in every message about the ring, so a worker and the
+	dispatcher drop frames and done slots of a ring that was replaced.
+	"""
+
+	def __init__(self, shape, slots, generation):
+		self.shape = shape
+		self.generation = generation
+		self.slots = slots
+		self.slot_size = int(np.prod(shape))
+		self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size * slots)
+		self.free = list(range(slots))
+		self.writers = 0
+		self.closed = False
+
+	def view(self, slot):
+		return np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.slot_size)
+
+	def release(self):
+		self.shm.close()
+		self.shm.unlink()
+		self.shm = None
+
+
+def worker_main(index, conn, snapshots=None, id_slots=1):
+	"""Entry point of an inference worker process, snapshots are the options of the parent's SnapshotStore"""
+	from capture import Capture
+	from episode_store import EpisodeIds
+	from manager import Stream
+
+	Capture.episodes = EpisodeChannel(conn)
+	# Slot 0 is the parent's, so ids of all processes are distinct
+	Capture.episode_ids = EpisodeIds(index + 1, id_slots)
+	# process() only runs on this thread, detector pools warm one instance for it
+	Capture.dispatcher.workers = 1
+	Capture.snapshots = SnapshotChannel(**snapshots) if snapshots is not None else None
+	streams = {}
+	print(f"[Worker {index}] Started")
+	while True:
+		messages = [conn.recv()]
+		while conn.poll():
+			messages.append(conn.recv())
+
+		# Latest wins: of all frames queued for a stream only the newest one
+		# is processed, older slots are handed back as dropped
+		latest = {}
+		for msg in messages:
+			op = msg[0]
+			if op == 'frame':
+				name = msg[1]
+				if name in latest:
+					conn.send(('done', name, latest[name][2], latest[name][3], False, 0.0))
+				latest[name] = msg
+			elif op == 'open':
+				_, name, capture_class, config, shm_name, shape, slots, generation = msg
+				if name in streams:
+					streams.pop(name)[1].close()
+				try:
+					shm = shared_memory.SharedMemory(name=shm_name)
+				except FileNotFoundError:
+					# Replaced and released already, its open message follows
+					continue
+				streams[name] = (capture_class(Stream(config)), shm, shape, int(np.prod(shape)), generation)
+			elif op == 'close':
+				name = msg[1]
+				if name in streams:
+					streams.pop(name)[1].close()
+			elif op == 'exit':
+				return
+
+		for name, (_, _, generation, slot, utc_ns) in latest.items():
+			# Slots of a replaced ring don't point into the current one
+			if name not in streams or streams[name][4] != generation:
+				conn.send(('done', name, generation, slot, False, 0.0))
+				continue
+			capture, shm, shape, slot_size, _ = streams[name]
+			t1 = time.perf_counter()
+			try:
+				img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=slot * slot_size)
+				episodes = capture.process(img, utc_ns)
+				del img
+				Capture.append_episodes(episodes)
+			except Exception as e:
+				print(f"[Worker {index}] [{name}] Error processing frame: {type(e).__name__}: {e}")
+			conn.send(('done', name, generation, slot, True, time.perf_counter() - t1))
+		if Capture.snapshots is not None:
+			Capture.snapshots.flush(conn)
+
+
+class ProcessDispatcher(object):
+	"""Runs process() of streams in a pool of worker processes.
+
+	Drop-in replacement for FrameDispatcher as Capture.dispatcher. Decoding stays
+	in this process; each frame is copied once into a per-stream shared memory
+	ring and only (slot, utc_ns) goes over the pipe. Episodes come back over the
+	same pipe into the local episode store. A new stream is placed on the
+	worker with the lowest measured process() load, a crashed worker is
+	restarted and gets its streams back.
+	"""
+
+	def __init__(self, processes=None, slots=3):
+		self.processes = processes or multiprocessing.cpu_count()
+		self.slots = slots
+		self._ctx = multiprocessing.get_context('spawn')
+		self._lock = threading.Lock()
+		self._workers = []
+		self._generations = itertools.count(1)
+
+	def submit(self, capture, frame):
+		sample, utc_ns = frame
+		queue = capture.frames
+		with capture.mapped_frame(sample) as img:
+			if img is None:
+				return
+			with self._lock:
+				if not self._workers:
+					self._start()
+				queue.received += 1
+				ring = getattr(capture, '_ring', None)
+				if ring is None or ring.shape != img.shape:
+					ring = self._open(capture, img.shape)
+				if not ring.free:
+					queue.dropped += 1
+					return
+				slot = ring.free.pop()
+				generation = ring.generation
+				ring.writers += 1
+				capture.metrics.queue_depth.observe(ring.slots - len(ring.free))
+			# Copy outside of the lock so streams don't serialize on memcpy
+			try:
+				ring.view(slot)[...] = img
+			finally:
+				with self._lock:
+					ring.writers -= 1
+					closed = ring.closed
+					if closed:
+						self._release(ring)
+		if closed:
+			return
+		worker = self._workers[queue.worker]
+		worker.send(('frame', capture.name, generation, slot, utc_ns))
+
+	def cancel(self, capture):
+		with self._lock:
+			ring = getattr(capture, '_ring', None)
+			if ring is None:
+				return
+			worker = self._workers[capture.frames.worker]
+			worker.captures.pop(capture.name, None)
+			capture._ring = None
+			ring.closed = True
+			self._release(ring)
+		worker.send(('close', capture.name))
+
+	def _release(self, ring):
+		# A frame still being copied into the ring keeps it alive
+		if ring.writers == 0 and ring.shm is not None:
+			ring.release()
+
+	def stats(self):
+		with self._lock:
+			return {
+				'processes': self.processes,
+				'workers': [{
+					'pid': w.process.pid,
+					'streams': len(w.captures),
+					'load': round(w.load(), 3),
+				} for w in self._workers],
+			}
+
+	def _start(self):
+		from capture import Capture
+		from episode_store import EpisodeIds
+		Capture.episode_ids = EpisodeIds(0, self.processes + 1)
+		for i in range(self.processes):
+			self._workers.append(_WorkerHandle(self, i))
+		print(f"[Dispatcher] Started {self.processes} inference process(es)")
+
+	def _open(self, capture, shape):
+		"""Place the stream on the least loaded worker and allocate its ring"""
+		queue = capture.frames
+		old = getattr(capture, '_ring', None)
+		if old is not None:
+			self._workers[queue.worker].captures.pop(capture.name, None)
+			old.closed = True
+			self._release(old)
+		worker = min(self._workers, key=lambda w: w.load())
+		queue.worker = worker.index
+		capture._ring = SharedFrameRing(shape, self.slots, next(self._generations))
+		worker.captures[capture.name] = capture
+		worker.send(self._open_message(capture))
+		print(f"[{capture.name}] Placed on inference process {worker.index}")
+		return capture._ring
+
+	def _open_message(self, capture):
+		ring = capture._ring
+		# Classes made at runtime (simulation) name a class workers can import
+		cls = getattr(capture, 'worker_class', None) or type(capture)
+		return ('open', capture.name, cls, capture.spec.config, ring.shm.name, ring.shape, ring.slots, ring.generation)
+
+	def _done(self, worker, name, generation, slot, processed, duration):
+		with self._lock:
+			capture = worker.captures.get(name)
+			# A late slot of a replaced ring would be freed twice in the new one
+			if capture is None or capture._ring is None or capture._ring.generation != generation:
+				return
+			capture._ring.free.append(slot)
+			queue = capture.frames
+			if processed:
+				queue.processed += 1
+				capture.process_time += duration
+				capture.metrics.process.observe(duration)
+			else:
+				queue.dropped += 1
+
+
+class _WorkerHandle(object):
+	"""Parent side of one worker process: pipe, reader thread, restarts"""
+
+	def __init__(self, dispatcher, index):
+		self.dispatcher = dispatcher
+		self.index = index
+		self.captures = {}
+		self.send_lock = threading.Lock()
+		self._spawn()
+		threading.Thread(target=self._read, name=f"inference-reader-{index}", daemon=True).start()
+
+	def _spawn(self):
+		from capture import Capture
+		snapshots = Capture.snapshots.options() if Capture.snapshots is not None else None
+		self.conn, child_conn = self.dispatcher._ctx.Pipe()
+		id_slots = self.dispatcher.processes + 1
+		self.process = self.dispatcher._ctx.Process(target=worker_main, args=(self.index, child_conn, snapshots, id_slots),
+			name=f"inference-{self.index}", daemon=True)
+		self.process.start()
+		child_conn.close()
+
+	def load(self):
+		"""Seconds of process() per second of wall time summed over streams"""
+		return sum(c.process_load() for c in self.captures.values()) + len(self.captures) * 1e-6
+
+	def send(self, msg):
+		with self.send_lock:
+			try:
+				self.conn.send(msg)
+			except (OSError, EOFError):
+				# Reader thread notices the dead worker and restarts it
+				pass
+
+	def _read(self):
+		while True:
+			try:
+				msg = self.conn.recv()
+			except (OSError, EOFError):
+				self._restart()
+				continue
+			op = msg[0]
+			if op == 'done':
+				self.dispatcher._done(self, *msg[1:])
+			else:
+				from capture import Capture
+				if op == 'append':
+					Capture.append_episode(msg[1])
+				elif op == 'update':
+					Capture.update_episode(msg[1], **msg[2])
+				elif op == 'snapshot' and Capture.snapshots is not None:
+					Capture.snapshots.put(msg[1], msg[2])
+
+	def _restart(self):
+		self.process.join(timeout=1.0)
+		print(f"[Dispatcher] Inference process {self.index} died with exit code {self.process.exitcode}, restarting")
+		time.sleep(1.0)
+		with self.dispatcher._lock:
+			with self.send_lock:
+				self._spawn()
+			for capture in self.captures.values():
+				# Frames that were in flight in the dead worker are lost, a
+				# new generation drops frames sent to it before the restart
+				ring = capture._ring
+				ring.free = list(range(ring.slots))
+				ring.generation = next(self.dispatcher._generations)
+				self.send(self.dispatcher._open_message(capture))